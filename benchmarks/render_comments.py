@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+'''Compare the old recursive comments_html with januslib.render.render_comments on deep and wide threads.
+
+Run from the repository root:  PYTHONPATH=src python3 benchmarks/render_comments.py'''
+
+import html
+import sys
+import timeit
+
+from januslib.render import render_comments
+
+def legacy_comments_html(comments):
+    'The recursive renderer from januslib.fusiontables, before render_comments replaced it'
+    s = ['<ul>', ]
+    for com in comments:
+        s.append('<li><b>{}</b> (+{}): {}'.format(html.escape(com['from']['name']),
+                                                    com['like_count'],
+                                                    html.escape(com['message'])
+                                                    )
+                )
+        if 'comments' in com:
+            #recurse into nested comment
+            s.append(legacy_comments_html(com['comments']['data']))
+        s.append('</li>')
+    s.append('</ul>')
+    return ''.join(s)
+
+def comment(i):
+    return {'from': {'name': 'Commenter <{}>'.format(i)}, 'like_count': i % 17, 'message': 'Dette er kommentar nr {} & mer'.format(i) * 3}
+
+def deep_thread(depth):
+    'one long chain of replies'
+    root = node = comment(0)
+    for i in range(1, depth):
+        child = comment(i)
+        node['comments'] = {'data': [child]}
+        node = child
+    return [root]
+
+def wide_thread(width, replies):
+    'lots of top level comments, each with a few replies'
+    thread = []
+    for i in range(width):
+        com = comment(i)
+        com['comments'] = {'data': [comment(j) for j in range(replies)]}
+        thread.append(com)
+    return thread
+
+def bench(name, thread, number):
+    cases = [('legacy recursive', lambda: legacy_comments_html(thread)),
+             ('render_comments', lambda: render_comments(thread)),
+             ('render_comments 32KiB', lambda: render_comments(thread, max_bytes=32*1024)),
+             ('render_comments text', lambda: render_comments(thread, 'text')),
+             ]
+    print('== {} =='.format(name))
+    for label, fn in cases:
+        try:
+            size = len(fn().encode('utf-8'))
+            t = min(timeit.repeat(fn, number=number, repeat=3)) / number
+            print('{:>24}: {:9.3f} ms  {:>10} bytes'.format(label, t * 1000, size))
+        except RecursionError:
+            print('{:>24}: RecursionError'.format(label))
+
+if __name__ == '__main__':
+    sys.setrecursionlimit(10000)
+    bench('deep (500 levels)', deep_thread(500), 50)
+    bench('very deep (20000 levels)', deep_thread(20000), 3)
+    bench('wide (5000 x 5 replies)', wide_thread(5000, 5), 3)
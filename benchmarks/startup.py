@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+'''Measure the cold start of janus.py: the time to import everything it needs before the first prompt,
+and check that no service client (facebook, requests, the google api stack) gets imported up front.
+
+Run from the repository root:  python3 benchmarks/startup.py [runs]
+Exits non-zero if the median is above janus.JANUS_STARTUP_TARGET, or a lazy module was imported'''
+
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TARGET = 1.0 # keep in sync with JANUS_STARTUP_TARGET in janus.py
+LAZY = ('facebook', 'requests', 'apiclient', 'googleapiclient', 'oauth2client', 'httplib2', 'fusionclient')
+
+# janus.py parses sys.argv and starts the console when run as a script, so import it as a module
+PROBE = '''
+import sys, time
+t0 = time.perf_counter()
+sys.argv = ['janus.py']
+import janus
+elapsed = time.perf_counter() - t0
+lazy = [ m for m in sys.modules if m.split('.')[0] in {lazy!r} ]
+print(elapsed, ','.join(sorted(lazy)))
+'''.format(lazy=LAZY)
+
+def run_once():
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.join(ROOT, 'src'), ROOT]), PYTHONDONTWRITEBYTECODE='1')
+    out = subprocess.run([sys.executable, '-c', PROBE], cwd=ROOT, env=env, check=True,
+                         stdout=subprocess.PIPE, universal_newlines=True).stdout.strip().splitlines()[-1]
+    elapsed, _, lazy = out.partition(' ')
+    return float(elapsed), [ m for m in lazy.split(',') if m ]
+
+def slowest_imports(top=15):
+    'Cumulative import times from python -X importtime, slowest first'
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.join(ROOT, 'src'), ROOT]))
+    err = subprocess.run([sys.executable, '-X', 'importtime', '-c', "import sys; sys.argv=['janus.py']; import janus"],
+                         cwd=ROOT, env=env, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, universal_newlines=True).stderr
+    rows = []
+    for line in err.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = [ f.strip() for f in line[len('import time:'):].split('|') ]
+        rows.append( (int(cumulative), name) )
+    return sorted(rows, reverse=True)[:top]
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    times, lazy = [], set()
+    for _ in range(runs):
+        elapsed, imported = run_once()
+        times.append(elapsed)
+        lazy.update(imported)
+    median = statistics.median(times)
+    print('startup: median {:.3f}s, min {:.3f}s, max {:.3f}s over {} runs (target {:.2f}s)'.format(median, min(times), max(times), runs, TARGET))
+    print('slowest imports (cumulative):')
+    for usec, name in slowest_imports():
+        print('  {:8.1f} ms  {}'.format(usec / 1000, name))
+    if lazy:
+        print('imported at startup, should be lazy: {}'.format(', '.join(sorted(lazy))))
+    sys.exit(1 if median > TARGET or lazy else 0)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+'''Measure how post formatting for the Fusion and CSV sinks scales with januslib.transform workers.
+
+Writes a cache of synthetic posts with comment threads to a temporary directory, then formats
+all of them in this process and with 1, 2, 4 .. cpu_count workers, like a cached replay does.
+
+Run from the repository root:  python3 benchmarks/transform.py [posts]'''
+
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+from januslib.fb import JanusFBCached
+from januslib.fusiontables import format_post_row
+from januslib.filesinks import csv_post_row
+from januslib.transform import JanusTransformStage
+
+def fake_post(i):
+    def comment(depth):
+        c = {'id': str(random.getrandbits(40)), 'from': {'name': 'Kari <Nordmann>'}, 'like_count': random.randint(0, 50),
+             'created_time': '2017-01-31T12:{:02d}:00+0000'.format(i % 60), 'message': 'Hei & hå\n' * random.randint(1, 20)}
+        if depth < 2 and random.random() < 0.3:
+            c['comments'] = {'data': [ comment(depth + 1) for _ in range(random.randint(1, 5)) ]}
+        return c
+    comments = [ comment(0) for _ in range(random.randint(0, 30)) ]
+    return {'id': '123_{}'.format(i), 'created_time': '2017-01-31T12:00:00+0000', 'from': {'name': 'NRK'},
+            'message': 'Melding <b>{}</b>\n'.format(i) * 10, 'type': 'link', 'link': 'https://example.com/{}'.format(i),
+            'likes': {'data': [], 'summary': {'total_count': i}}, 'shares': {'count': i % 7},
+            'comments': {'data': comments, 'summary': {'total_count': len(comments)}}}
+
+def run(source, transforms, workers):
+    t0 = time.perf_counter()
+    if workers == 0:
+        n = 0
+        for post in source:
+            for func, args in transforms:
+                func(post, *args)
+            n += 1
+    else:
+        n = sum(1 for _ in JanusTransformStage(workers).map(iter(source), transforms))
+    return n, time.perf_counter() - t0
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    tmp = tempfile.mkdtemp()
+    try:
+        os.makedirs(os.path.join(tmp, 'page'))
+        for i in range(count):
+            with open(os.path.join(tmp, 'page', '{}.json'.format(i)), 'w') as f:
+                json.dump(fake_post(i), f)
+        source = JanusFBCached('page', tmp, None)
+        transforms = [ (format_post_row, (True,)), (csv_post_row, ()) ]
+        workers = [0] + sorted(set([1, 2, 4, 8, os.cpu_count() or 1]) & set(range(1, (os.cpu_count() or 1) + 1)))
+        base = None
+        for w in workers:
+            n, elapsed = run(source, transforms, w)
+            base = base or elapsed
+            print('{:>2} workers: {:7.0f} posts/s, {:5.2f}x'.format(w, n / elapsed, base / elapsed))
+    finally:
+        shutil.rmtree(tmp)
@@ -7,7 +7,6 @@ import time
 import html
 import os
 from datetime import datetime
-import requests
 import json
 from clint.textui import colored, puts, indent
 from pprint import pprint
@@ -21,6 +20,9 @@ import logging
 #logging.basicConfig(level=logging.INFO)
 
 import fusionclient
+from januslib.render import render_comments
+from januslib.graphcache import JanusCachedGraph
+from januslib.fb import _next_cursor
 
 def datestring(string):
     try:
@@ -46,6 +48,7 @@ argp.add_argument('fusiontable')
 argp.add_argument('--since', type=datestring, help='Date in YYYY-MM-DD [HH:MM:SS] format')
 argp.add_argument('--until', type=datestring, help='Date in YYYY-MM-DD [HH:MM:SS] format')
 argp.add_argument('--store', action="store_true", default=False, help='Keep a copy of the FB post in .data/ as JSON file')
+argp.add_argument('--cache', action="store_true", default=False, help='Answer Graph reads from the response cache when it is fresh')
 argp.add_argument('--loglevel', type=lvl, default=logging.INFO, help='Set log level')
 
 args = argp.parse_args()
@@ -55,7 +58,8 @@ logging.basicConfig(level=args.loglevel)
 
 fusion = fusionclient.Fusion()
 
-graph = facebook.GraphAPI(access_token=os.environ.get('FB_APP_TOKEN'), version='2.8')
+graph = JanusCachedGraph(facebook.GraphAPI(access_token=os.environ.get('FB_APP_TOKEN'), version='2.8'))
+graph.cache.enabled = args.cache
 
 params = {'fields': 'from,id,message,created_time,status_type,comments{from,id,like_count,message,comments{from,like_count,created_time,message,comments{from,like_count,created_time,message}},created_time},likes{name},shares,type,source,picture,link,permalink_url'
             }
@@ -74,11 +78,7 @@ def simplify_timestamp(datestring):
 
 def comments_html(comments):
     'Turn a json list of comments into an html string'
-    s = ['<ul>', ]
-    for com in comments:
-        s.append('<li><b>{}</b> (+{}): {}</li>'.format(html.escape(com['from']['name']), com['like_count'], html.escape(com['message'])))
-    s.append('</ul>')
-    return ''.join(s)
+    return render_comments(comments, 'html', max_bytes=32*1024)
 
 def store_post(post, keep_disk_copy=None):
     #pprint(post)
@@ -133,6 +133,7 @@ cont = True
 while cont == True:
     if len(feed['data']) == 0: # no posts (left)
         puts(colored.green('Finished. Go grab a beer'))
+        puts(colored.yellow(str(graph.cache)))
         break
     puts(colored.magenta('Trawling through {} posts:'.format(len(feed['data']))))
     try:
@@ -154,12 +155,16 @@ while cont == True:
                 luck = repr(status)
             puts(colored.green(luck))
         # Attempt to make a request to the next page of data, if it exists.
-        feed = requests.get(feed['paging']['next']).json()
-    except KeyError:
-        # When there are no more pages (['paging']['next']), break from the
-        # loop and end the script.
-        raise
-        break
+        # Page feeds are paged by time, the cursor is in the `next` url
+        cursor = _next_cursor(feed.get('paging', {}))
+        if cursor is None: # no more pages
+            puts(colored.green('Finished. Go grab a beer'))
+            puts(colored.yellow(str(graph.cache)))
+            break
+        for key in ('after', 'until', '__paging_token'): # dont mix cursors from different pages
+            params.pop(key, None)
+        params.update(cursor)
+        feed = graph.request('/{}/feed'.format(args.pagename), params)
     except KeyboardInterrupt:
         print('\n')
         break
@@ -2,6 +2,8 @@
 # -*- encoding: utf-8 -*-
 
 import sys
+import time
+JANUS_STARTED = time.perf_counter() # to measure cold start, see JANUS_STARTUP_TARGET
 import io
 import fnmatch
 import collections
@@ -22,12 +24,35 @@ from dotenv import load_dotenv, find_dotenv, set_key
 import console # TODO: replace with python-prompt-toolkit
 
 from januslib import JanusPost, JanusException
-from januslib.fb import JanusFB, JanusFBCached, fb_authenticate, fb_run_oauth_endpoint
+from januslib.fb import JanusFB, JanusFBCached, fb_authenticate, fb_run_oauth_endpoint, FB_PAGE_LIMIT_MAX
+from januslib.fbcomments import JanusFBComments
 from januslib.fusiontables import *
-from januslib.filesinks import JanusFileSink, JanusCSVSink
+from januslib.filesinks import JanusFileSink, JanusCSVSink, JanusParquetSink, PARQUET_ROWGROUP
 from januslib.stats import JanusStatsSink
+from januslib.aggregate import JanusAggregate
+from januslib.history import JanusHistory, JanusHistorySink
+from januslib.graphcache import graph_cache
+from januslib.filters import compile_filter
+from januslib.transform import JanusTransformStage, default_workers
+from januslib.refresh import REFRESH_BUDGET
+from januslib.webhook import JanusWebhookIngest, JanusWebhookReceiver, run_webhook_server, simulate_subscribe, simulate_event, WEBHOOK_PATH
+from januslib.failures import JanusFailureLog, load_post
+from januslib.table import JanusPostTable, write_csv, POST_HEADER, GROUP_HEADER
+from januslib.httpserve import run_static_server
+from januslib.labelling import JanusLabelService, JanusLabelAPI
+from januslib.metrics import metrics, sinklabel
+from januslib.profiling import JanusProfiler
+from januslib.progress import JanusProgress
+from januslib.logutil import setup_file_logging
 
 JANUS_CACHEDIR='./data'
+JANUS_STATICDIR=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+JANUS_FEEDDIR=os.path.join(JANUS_STATICDIR, 'feeds') # aggregate feeds for the dashboards
+JANUS_HISTORYDIR=os.path.join(JANUS_CACHEDIR, 'history') # engagement history, see januslib.history
+JANUS_FAILURES=os.path.join(JANUS_CACHEDIR, 'failures.jsonl') # posts a sink failed on, see retry_errors
+JANUS_FAILURES_SPOOL=os.path.join(JANUS_CACHEDIR, 'failed') # raw posts for the failures that are not in the cache
+JANUS_REFRESH_STATE=os.path.join(JANUS_CACHEDIR, 'refresh-state.json') # what each post refresh found, see januslib.refresh
+JANUS_STARTUP_TARGET=1.0 # seconds from start to first prompt. Service clients are imported lazily to stay below it
 
 def datestring(string):
     'Take a isoformatted string, Y-m-d or Y-m-d H:M:S, and return datetime.datetime'
@@ -64,17 +89,23 @@ def lvl(string):
 
 argp = argparse.ArgumentParser()
 argp.add_argument('--loglevel', type=lvl, default=logging.INFO, help='Set log level')
+argp.add_argument('--fileloglevel', type=lvl, default=logging.DEBUG, help='Set log level of the log file, /tmp/janus.log')
 #argp.add_argument('--fbpage', help='Set Facebook page name')
 argp.add_argument('--cached', action='store_true', default=False, help='Use CACHED posts: Dont pull them from online, but from disk')
 argp.add_argument('--add_sink', action='append', nargs='*', help='Add output sink to chain')
 argp.add_argument('--since', help='Date in YYYY-MM-DD [HH:MM:SS] format')
 argp.add_argument('--until', help='Date in YYYY-MM-DD [HH:MM:SS] format')
+argp.add_argument('--quiet', action='store_true', default=False, help='Show a progress line instead of per post output. Details go to the log file')
 
 args = argp.parse_args()
 
 logging.basicConfig(level=args.loglevel)
 
 logger = logging.getLogger('Janus')
+# let the handlers decide what to show, but dont even create records that no handler wants
+logger.setLevel(min(args.loglevel, args.fileloglevel))
+logger.propagate = False # we have our own console handler, dont print everything twice
+postlogger = logging.getLogger('Janus.posts') # once per post, rate limited in the log file
 
 colorout = colorlog.StreamHandler()
 colorout.setFormatter(colorlog.ColoredFormatter(
@@ -82,10 +113,8 @@ colorout.setFormatter(colorlog.ColoredFormatter(
 colorout.setLevel(args.loglevel)
 logger.addHandler(colorout)
 
-fileout = logging.handlers.RotatingFileHandler('/tmp/janus.log', maxBytes=5*1024*1024, backupCount=5)
-fileout.setLevel(logging.DEBUG)
-fileout.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
-logger.addHandler(fileout)
+# written by a background thread, with per post chatter rate limited
+setup_file_logging(logger, '/tmp/janus.log', args.fileloglevel)
 
 def ask_iterator(ques, it):
     l = list(it)
@@ -121,6 +150,14 @@ class Janus:
         self.filter = None # a filter for the source, see .set_filter()
         self.source = None
         self.errors = []
+        self.failures = JanusFailureLog(JANUS_FAILURES, JANUS_FAILURES_SPOOL) # self.errors, persisted
+        self.quiet = False # show a progress line instead of per post output
+        self.table = None # JanusPostTable, see .command_load_table()
+        self.table_view = None # self.table, filtered
+        self.httpd = None # the static file server, see .command_serve()
+        self.labels = None # the labelling service behind static/binarysort.html
+        self.workers = 0 # processes formatting posts for the sinks in command_pull_posts. 0 formats in this process
+        self.webhook = None # (httpd, JanusWebhookReceiver) while receiving webhooks, see .command_webhook()
 
     def format_prompt(self):
         ps1 = colored.magenta(self.source)
@@ -132,6 +169,11 @@ class Janus:
             ps1 += '|{}↦{}| '.format(self.since.isoformat(' ') if self.since else '∞', self.until.isoformat(' ') if self.until else '∞')
         ps1 += colored.yellow('({} cached) '.format(self.count_cached_files()))
         ps1 += colored.red('*{} errors* '.format(len(self.errors)))
+        if self.filter is not None:
+            ps1 += colored.cyan('?{{{}}} '.format(self.filter))
+        if self.quiet:
+            ps1 += colored.cyan('(quiet) ')
+        ps1 += colored.yellow('({}) '.format(graph_cache()))
         ps1 += '\n > '
         sys.ps1 = ps1
 
@@ -147,11 +189,14 @@ class Janus:
         if self.source is not None:
             self.source.set_until(self.until)
 
-    def command_set_source_filter(self, filterstring):
-        'Set filter on current source. The format of filterstring is dependent on the source. Args: `filterstring`'
-        self.filter = filterstring
+    def command_set_source_filter(self, *expression):
+        'Filter the posts of the current source, e.g. likes > 100 and created between 2017-01-01 and 2017-01-31. No args removes the filter. See januslib.filters'
+        # the console split the expression on spaces and took the quotes, put them back
+        text = ' '.join(e if not any(c.isspace() for c in e) else '"{}"'.format(e.replace('"', '\\"')) for e in expression)
+        self.filter = compile_filter(text)
         if self.source is not None:
-            self.source.set_filter(filterstring)
+            self.source.set_filter(self.filter)
+        self.format_prompt()
 
     def command_set_page(self, pagename):
         'Set the Facebook Page that we are pulling data from (replacing any previous source).'
@@ -164,6 +209,51 @@ class Janus:
             self.source.set_filter(self.filter)
         self.format_prompt()
 
+    def command_set_comment_threads(self, concurrency='4'):
+        'Fetch complete comment threads for each post from the current Facebook Page. Args: concurrency (optional, posts at a time, 0 turns it off)'
+        if not isinstance(self.source, JanusFB):
+            raise JanusException('Need a Facebook Page as source for full comment threads')
+        self.source.set_threads(int(concurrency))
+
+    def command_set_field_profile(self, profile):
+        'Choose how much the current Facebook Page source asks Graph for. Args: profile (minimal|counts|full|full_threads)'
+        if not isinstance(self.source, JanusFB):
+            raise JanusException('Need a Facebook Page as source for field profiles')
+        self.source.set_field_profile(profile)
+
+    def command_set_graph_cache(self, state='on'):
+        'Answer Graph reads from the on disk response cache, or not. It starts off. Args: state (on|off|clear)'
+        cache = graph_cache()
+        if state == 'clear':
+            puts(colored.yellow('Removed {} cached Graph responses'.format(cache.clear())))
+        elif state in ('on', 'off'):
+            cache.enabled = state == 'on'
+        else:
+            raise JanusException('Graph cache can be on, off or clear, not {!r}'.format(state))
+        self.format_prompt()
+
+    def command_set_page_limit(self, limit='auto'):
+        'Posts per Graph feed page for the current Facebook Page source. Args: limit (a number, or auto to adapt it as we go)'
+        if not isinstance(self.source, JanusFB):
+            raise JanusException('Need a Facebook Page as source for a page limit')
+        if limit == 'auto':
+            self.source.set_page_limit(None)
+            return
+        try:
+            n = int(limit)
+        except ValueError:
+            raise JanusException('Page limit must be a number or auto, not {!r}'.format(limit))
+        if not 0 < n <= FB_PAGE_LIMIT_MAX:
+            raise JanusException('Page limit must be between 1 and {}'.format(FB_PAGE_LIMIT_MAX))
+        self.source.set_page_limit(n)
+
+    def command_set_comments_source(self):
+        'Turn the current source into a source of comments: one record per comment or reply, on each post'
+        if not isinstance(self.source, (JanusFB, JanusFBCached)):
+            raise JanusException('Need a Facebook Page (online or cached) as source for comments')
+        self.source = JanusFBComments(self.source, self.output)
+        self.format_prompt()
+
     def command_set_page_cached(self, pagename, cachedir=None):
         'Set the Facebook Page name that we will be pulling CACHED posts from (replacing any previous source).'
         if cachedir is None:
@@ -188,10 +278,11 @@ class Janus:
 
     def command_add_outsink_by_name(self, sinkname, *args):
         'Add a sink to send each post to. You may add several sinks'
+        self._require_idle()
         logger.debug('command_add_outsink: sinkname=%r, *args=%r', sinkname, args)
         _sink = '_outsink__{}'.format(sinkname)
         if hasattr(self, _sink): 
-            self.enabledsinks.append(getattr(self, _sink)(*args))
+            self.enabledsinks.append(self._make_sink(sinkname, args))
             self.format_prompt()
         else:
             puts(colored.red('No such sink found: {}. Use `all_sinks` to list available sinks'.format(sinkname)))
@@ -199,18 +290,25 @@ class Janus:
 
     def command_disable_outsink(self):
         'Get a list of enabled sinks and disable one of them'
+        self._require_idle()
         sink = ask_iterator('Choose which sink you want to disable?', self.enabledsinks)
         self.enabledsinks.remove(sink)
         self.format_prompt()
 
     def command_add_outsink(self, *args):
         'List all possible outsinks'
+        self._require_idle()
         logger.debug('self.outsinks: %r', self.outsinks)
         sinkname, desc = ask_iterator('Which sink will you add?', [ (nm, getattr(self, '_outsink__'+nm).__doc__) for nm in self.outsinks ])
-        _sink = '_outsink__{}'.format(sinkname)
-        self.enabledsinks.append(getattr(self, _sink)(*args))
+        self.enabledsinks.append(self._make_sink(sinkname, args))
         self.format_prompt()
 
+    def _make_sink(self, sinkname, args):
+        'Create an outsink, remembering how, so retry_errors can make it again'
+        sink = getattr(self, '_outsink__{}'.format(sinkname))(*args)
+        sink.spec = (sinkname, list(args))
+        return sink
+
     def command_list_enabled_outsinks(self):
         'List all enabled outsinks'
         logger.debug('enabledsinks: %r', self.enabledsinks)
@@ -223,33 +321,215 @@ class Janus:
             puts(colored.magenta(' ( use `all_sinks` to show all possible sinks ) '))
             return False
 
+    def _require_idle(self):
+        'Refuse to touch the sinks, the errors or the outbox while the webhook thread is pushing through them'
+        if self.webhook is not None:
+            raise JanusException('Receiving webhooks, the sinks are busy. Use `stop_webhook` first')
+
+    def _push(self, post, rows=None):
+        '''Push `post` to every enabled sink, recording errors. `rows` maps sinks to rows formatted
+        by a JanusTransformStage. Returns False if interrupted'''
+        rows = rows or {}
+        for sink in self.enabledsinks:
+            try:
+                with metrics.timer('janus_sink_push_seconds', sink=sinklabel(sink)):
+                    row = rows.get(sink)
+                    if row is None:
+                        sink.push(post)
+                    elif isinstance(row, Exception): # formatting failed in the worker
+                        raise row
+                    else:
+                        sink.push_row(post, row)
+            except KeyboardInterrupt:
+                return False
+            except Exception as e:
+                metrics.inc('janus_sink_errors_total', sink=sinklabel(sink), error=e.__class__.__name__)
+                self.errors.append( (post, e) )
+                self.failures.record(post, sink, e)
+        return True
+
     def command_pull_posts(self):
         'Pull posts from current FB Page (cache or online), respecting Until and Since if they are set'
+        self._require_idle()
         # cache receivers
         self._assert_sinks() # make sure someone receives this
         i = 0
         self.errors = []
         stop = False
-        for post in self.source: # iterate through source, get JanusPost (or derivative)
+        source = str(self.source)
+        self.source.set_verbose(not self.quiet)
+        for sink in self.enabledsinks:
+            sink.set_verbose(not self.quiet)
+        progress = JanusProgress(self.output, self.source.estimate_count()) if self.quiet else None
+        # iterate through source, get JanusPost (or derivative)
+        posts = metrics.timed_iter(self.source, 'janus_source_next_seconds', source=source)
+        formatters = [ sink for sink in self.enabledsinks if sink.transform is not None ]
+        if self.workers and formatters: # format posts for these sinks in a process pool, see januslib.transform
+            posts = JanusTransformStage(self.workers).map(posts, [ sink.transform for sink in formatters ])
+        else:
+            posts = ( (post, None) for post in posts )
+        for post, rows in posts:
             if stop == True: break
-            puts(colored.blue('Handling post # {} @ {}'.format(post.id, post.datetime_created.isoformat()), self.output))
-            for sink in self.enabledsinks:
+            rows = dict(zip(formatters, rows)) if rows is not None else {}
+            metrics.inc('janus_source_posts_total', source=source)
+            if progress is None and rows:
+                puts(colored.blue('Handling post # {}'.format(post.id), self.output)) # the date would parse the post here, the workers did that already
+            elif progress is None:
+                puts(colored.blue('Handling post # {} @ {}'.format(post.id, post.datetime_created.isoformat()), self.output))
+            else:
+                postlogger.debug('Handling post # %s', post.id)
+            stop = not self._push(post, rows)
+            i = i+1
+            if progress is not None:
+                progress.update(i, len(self.errors), self.enabledsinks)
+        posts.close() # if we stopped early, this stops the transform workers too
+        for sink in self.enabledsinks:
+            with metrics.timer('janus_sink_finished_seconds', sink=sinklabel(sink)):
+                sink.finished() # let sinks clean up and empty their queues
+        if progress is not None:
+            progress.finish(i, len(self.errors), self.enabledsinks)
+        puts(colored.blue('Finished pulling {} posts from {}'.format(i, self.source), self.output))
+        if self.source.skipped:
+            puts(colored.blue('{} posts did not pass the filter'.format(self.source.skipped), self.output))
+            self.source.skipped = 0
+        self.command_show_last_errors()
+        self.format_prompt()
+
+    def command_retry_errors(self):
+        'Push the posts that sinks failed on again, to only the sinks that failed, reading them from disk when we can'
+        self._require_idle()
+        groups = self.failures.by_sink()
+        if not groups:
+            puts(colored.green('No failed posts on record. yay'))
+            return
+        left = []
+        self.errors = []
+        stop = False
+        for spec, failures in groups.items():
+            if stop:
+                left.extend(failures)
+                continue
+            if spec is None:
+                puts(colored.red('{} failures are from sinks that cannot be made again, skipping them'.format(len(failures))))
+                left.extend(failures)
+                continue
+            name, args = spec
+            # reuse an enabled sink with the same spec, so we dont get two of them writing to the same place
+            sink = next((s for s in self.enabledsinks if s.spec == (name, list(args))), None)
+            if sink is None:
                 try:
-                    sink.push(post)
+                    sink = self._make_sink(name, args)
+                except Exception as e:
+                    puts(colored.red('Could not make sink {} {}: {}'.format(name, ' '.join(args), e)))
+                    left.extend(failures)
+                    continue
+            sink.set_verbose(not self.quiet)
+            done = 0
+            for rec in failures:
+                try:
+                    post = load_post(rec['raw'], rec['post'])
+                    with metrics.timer('janus_sink_push_seconds', sink=sinklabel(sink)):
+                        sink.push(post)
+                    done += 1
                 except KeyboardInterrupt:
+                    left.extend(failures[failures.index(rec):])
                     stop = True
                     break
                 except Exception as e:
-                    self.errors.append( (post, e) )
-            i = i+1
-        for sink in self.enabledsinks:
-            sink.finished() # let sinks clean up and empty their queues
-        puts(colored.blue('Finished pulling {} posts from {}'.format(i, self.source), self.output))
-        self.command_show_last_errors()
+                    metrics.inc('janus_sink_errors_total', sink=sinklabel(sink), error=e.__class__.__name__)
+                    rec.update(error=e.__class__.__name__, message=str(e)[:500], ts=time.time())
+                    left.append(rec)
+            with metrics.timer('janus_sink_finished_seconds', sink=sinklabel(sink)):
+                sink.finished()
+            puts(colored.blue('{}: {} of {} posts pushed again'.format(sink, done, len(failures))))
+        self.failures.replace(left)
+        if left:
+            puts(colored.red('{} posts still failing, see {}'.format(len(left), self.failures.path)))
+        else:
+            puts(colored.green('All failed posts pushed. yay'))
         self.format_prompt()
 
+    def command_profile_pull(self, outdir='./profiles', interval='5'):
+        'Run `pull` under cProfile, with tracemalloc snapshots every `interval` seconds. Args: outdir (optional), interval (optional)'
+        profiler = JanusProfiler(outdir, float(interval))
+        profiler.run(self.command_pull_posts)
+        puts(colored.green('Wrote profile to {} (open with `python -m pstats`) and allocation report to {}'.format(profiler.pstats_path, profiler.report_path)))
+        return profiler.summary()
+
+    def command_set_workers(self, workers='auto'):
+        'Format posts for the Fusion and CSV sinks in this many processes when pulling. Args: workers (a number, auto for one per core, 0 to turn it off)'
+        if workers == 'auto':
+            self.workers = default_workers()
+        else:
+            try:
+                self.workers = int(workers)
+            except ValueError:
+                raise JanusException('Workers must be a number or auto, not {!r}'.format(workers))
+        puts(colored.blue('Formatting posts in {}'.format('{} processes'.format(self.workers) if self.workers else 'this process')))
+
+    def command_set_quiet(self, onoff='on'):
+        'Replace per post output with a single progress line, sending details to the log file only. Args: `on` (default) or `off`'
+        self.quiet = onoff.lower() in ('on', 'yes', 'true', '1')
+        self.format_prompt()
+
+    def command_load_table(self, pagename=None, cachedir=None):
+        'Load a cached page into memory as columns, for fast ad hoc questions. Args: pagename (optional, defaults to current source), cachedir (optional)'
+        self._require_idle() # the file sink may be writing this cache
+        if pagename is None:
+            if self.source is None:
+                raise JanusException('Need a page name, or a source to take it from')
+            pagename = self.source.id
+        path = os.path.join(cachedir or JANUS_CACHEDIR, pagename)
+        if not os.path.isdir(path):
+            raise JanusException('No cache of {} in {}. Pull it with the file sink first'.format(pagename, path))
+        npz = '{}.npz'.format(path)
+        t0 = time.perf_counter()
+        if os.path.exists(npz) and os.path.getmtime(npz) >= os.path.getmtime(path):
+            self.table = JanusPostTable.load(npz)
+        else:
+            self.table = JanusPostTable.from_cache(path)
+            self.table.save(npz)
+        self.table_view = self.table
+        puts(colored.green('Loaded {} posts from {} in {:.2f}s'.format(len(self.table), path, time.perf_counter() - t0)))
+
+    def _assert_table(self):
+        if self.table is None:
+            raise JanusException('No table loaded. Use `load_table` first')
+
+    def command_table_filter(self, *conditions):
+        'Filter the loaded table, on top of earlier filters. Args: conditions like likes>10, author=NRK, created>=2017-01-01, or `reset`'
+        self._assert_table()
+        if conditions == ('reset',):
+            self.table_view = self.table
+        else:
+            t0 = time.perf_counter()
+            self.table_view = self.table_view.filter(*conditions)
+            logger.debug('table filter %r took %.4fs', conditions, time.perf_counter() - t0)
+        return '{} of {} posts match'.format(len(self.table_view), len(self.table))
+
+    def command_table_groupby(self, by, filename=None, top='20'):
+        'Group the (filtered) table by `author` or hour|day|week|month. Args: by, filename (optional, write all groups to CSV), top (optional, rows to show)'
+        self._assert_table()
+        t0 = time.perf_counter()
+        rows = self.table_view.groupby(by)
+        elapsed = time.perf_counter() - t0
+        if filename is not None:
+            write_csv(filename, GROUP_HEADER, rows)
+            puts(colored.green('Wrote {} groups to {}'.format(len(rows), filename)))
+        lines = ['\t'.join(GROUP_HEADER)]
+        lines.extend('{}\t{}\t{}\t{}\t{}\t{:.1f}'.format(*r) for r in rows[:int(top)])
+        lines.append('{} groups in {:.4f}s'.format(len(rows), elapsed))
+        return '\n'.join(lines)
+
+    def command_table_to_csv(self, filename):
+        'Write the posts in the (filtered) table to CSV. Args: filename'
+        self._assert_table()
+        write_csv(filename, POST_HEADER, self.table_view.rows())
+        puts(colored.green('Wrote {} posts to {}'.format(len(self.table_view), filename)))
+
     def command_update_fusiontable(self):
         'Run through all posts in current page disk cache, and update fusiontable with any posts that are missing'
+        self._require_idle()
 
     def _outsink__file(self, path=None):
         'Store post JSON to a file on disk. Args: path (optional, defaults to JANUS_CACHEDIR)'
@@ -258,21 +538,80 @@ class Janus:
         self.cachepath = '{}/{}'.format(path, self.source.id)
         return JanusFileSink(self.cachepath, self.output)
 
-    def _outsink__date_count(self):
-        'Create a table of posts created per date (looking at `created_date`)'
-        return JanusStatsSink('date_count', self.output)
-
-    def _outsink__date_count_field_true(self, field):
-        'Create a table of posts created per date, where post.`field` is True. Args: field'
-        s = JanusStatsSink('date_count', self.output)
-        s.set_filter(lambda x: getattr(x, field) == True)
+    def _outsink__parquet(self, path, partition=None, rowgroup=None):
+        'Write posts to a Parquet dataset in the directory `path`. Args: path, partition (optional, page|month|page,month, `-` for none), rowgroup (optional, posts per row group)'
+        if partition == '-':
+            partition = None
+        return JanusParquetSink(path, self.output, partition, int(rowgroup) if rowgroup else PARQUET_ROWGROUP)
+
+    def _publishdir(self, publish):
+        'Where to publish feeds: `yes` means the default, JANUS_FEEDDIR'
+        if publish is None or publish.lower() == 'no':
+            return None
+        return JANUS_FEEDDIR if publish.lower() == 'yes' else publish
+
+    def _outsink__date_count(self, publish=None):
+        'Create a table of posts created per date (looking at `created_date`). Args: publish (optional, `yes` or a directory to publish a json feed in)'
+        return JanusStatsSink('date_count', self.output, publish=self._publishdir(publish))
+
+    def _outsink__date_count_field_true(self, field, publish=None):
+        'Create a table of posts created per date, where post.`field` is True. Args: field, publish (optional, `yes` or a directory to publish a json feed in)'
+        s = JanusStatsSink('date_count', self.output, publish=self._publishdir(publish), feedname='date_count_{}'.format(field))
+        s.set_filter(compile_filter(field))
         return s
 
-    def _outsink__fusiontable_update(self, columns=None):
-        'Update each post in the current Fusiontable source with live data from Facebook. Args: columns (optional, comma separated list of columns)'
+    def _outsink__aggregate(self, groupby=None, bucket='day', persist=None, publish=None):
+        'Count, sum, average and sketch percentiles of likes, shares and comments, with distinct authors, per time bucket. Args: groupby (optional, post field, `-` for none), bucket (optional, hour|day|week|month), persist (optional, file to add this run to, `-` for none), publish (optional, `yes` or a directory to publish a json feed in)'
+        if groupby == '-':
+            groupby = None
+        if persist == '-':
+            persist = None
+        return JanusStatsSink('aggregate', self.output, JanusAggregate(groupby, bucket), persist,
+                              publish=self._publishdir(publish), feedname='aggregate_{}_{}'.format(bucket, groupby or 'all'))
+
+    def _outsink__history(self, path=None):
+        'Record likes, shares and comments of each post, keeping only what changed since the last run. Args: path (optional, defaults to JANUS_HISTORYDIR)'
+        return JanusHistorySink(path or JANUS_HISTORYDIR, self.output)
+
+    def command_history_curve(self, postid, path=None):
+        'Show how likes, shares and comments of a post evolved. Args: postid, path (optional, history store)'
+        lines = ['time\tlikes\tshares\tcomments']
+        lines.extend('{:%Y-%m-%d %H:%M}\t{}\t{}\t{}'.format(*r) for r in JanusHistory(path or JANUS_HISTORYDIR).curve(postid))
+        return '\n'.join(lines)
+
+    def command_history_risers(self, hours='24', counter='likes', top='10', path=None):
+        'Show the posts that grew the most lately. Args: hours (optional), counter (optional, likes|shares|comments), top (optional), path (optional, history store)'
+        rows = JanusHistory(path or JANUS_HISTORYDIR).risers(float(hours), counter, int(top))
+        lines = ['post\t+{}\t{}'.format(counter, counter)]
+        lines.extend('{}\t{}\t{}'.format(*r) for r in rows)
+        return '\n'.join(lines)
+
+    def command_merge_stats(self, outfile, *infiles):
+        'Merge persisted aggregates, e.g. from sharded or parallel runs. Args: outfile, infile [infile ...]'
+        if not infiles:
+            raise JanusException('Need at least one aggregate file to merge')
+        merged = JanusAggregate.load(infiles[0])
+        for path in infiles[1:]:
+            merged.merge(JanusAggregate.load(path))
+        merged.save(outfile)
+        puts(colored.green('Merged {} aggregates ({} posts) into {}'.format(len(infiles), merged.counted, outfile)))
+
+    def _outsink__fusiontable_update(self, columns=None, budget=None):
+        'Update posts in the current Fusiontable source with live data from Facebook, the ones most likely to have changed first. Args: columns (optional, comma separated list of columns, `-` for the default), budget (optional, Graph calls per run, or `all`)'
         if not isinstance(self.source, JanusFusiontablesSource):
             raise JanusException('Need a Fusion Table as source for this sink')
-        s = JanusFusiontablesFacebookUpdateSink(self.source.table, columns, self.output)
+        if columns == '-':
+            columns = None
+        if budget is None:
+            budget = REFRESH_BUDGET
+        elif budget == 'all':
+            budget = None
+        else:
+            try:
+                budget = int(budget)
+            except ValueError:
+                raise JanusException('Budget must be a number or all, not {!r}'.format(budget))
+        s = JanusFusiontablesFacebookUpdateSink(self.source.table, columns, self.output, budget, JANUS_REFRESH_STATE)
         self.format_prompt()
         return s
 
@@ -293,13 +632,132 @@ class Janus:
         except FileNotFoundError:
             return -1
 
-    def _outsink__fusiontables(self, tableid):
-        'Push Post data to Google Fusion Tables. Args:  tableid'
-        return JanusFusiontablesSink(tableid, self.output)
+    def _outsink__fusiontables(self, tableid, comments_tableid=None, comments_html='yes'):
+        'Push Post data to Google Fusion Tables. Args:  tableid, comments_tableid (optional, table for comment records), comments_html (optional, `no` to leave out the `Kommentarer` column)'
+        return JanusFusiontablesSink(tableid, self.output, comments_tableid, comments_html.lower() != 'no')
+
+    def _outsink__csv(self, filename, separator=None, append='no'):
+        'Push Post data to a CSV file, replacing it. Comment records go to <filename>.comments.csv. Args: filename, separator(optional, defaults to ,), append (optional, `yes` to add to the files instead)'
+        return JanusCSVSink(filename, separator, self.output, append=append.lower() == 'yes')
+
+    def command_show_stats(self, reset=None):
+        'Show timers and counters collected so far. Args: reset (optional, `reset` to clear them afterwards)'
+        summary = metrics.summary()
+        if reset == 'reset':
+            metrics.reset()
+        return summary if summary else 'No stats collected yet'
+
+    def command_export_stats(self, filename, fmt='prometheus'):
+        'Write timers and counters to a file. Args: filename, format (optional, `prometheus` (default) or `json`)'
+        try:
+            metrics.write(filename, fmt)
+        except ValueError as e:
+            puts(colored.red(str(e)))
+            return False
+        puts(colored.green('Wrote {} stats to {}'.format(fmt, filename)))
+
+    def command_serve(self, port='8000', root=None):
+        'Serve the dashboards in static/ (and published feeds) over http, in the background, with the labelling api for binarysort.html. Args: port (optional), root (optional)'
+        if self.httpd is not None:
+            raise JanusException('Already serving. Use `stop_serving` first')
+        self.labels = JanusLabelService()
+        api = JanusLabelAPI(self.labels)
+        _, self.httpd = run_static_server(root or JANUS_STATICDIR, int(port), routes={api.prefix: api})
+        puts(colored.green('Serving {} at http://127.0.0.1:{}/'.format(self.httpd.root, port)))
+
+    def command_stop_serving(self):
+        'Stop the http server started with `serve`'
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+        if self.labels is not None:
+            left = self.labels.stop()
+            if left:
+                puts(colored.red('{} labels could not be written to Fusion'.format(left)))
+            self.labels = None
+
+    def _deliver_webhook_posts(self, posts):
+        'Push posts fetched for webhook events through the sinks, and hand them over at once'
+        for post in posts:
+            postlogger.debug('Handling post # %s from a webhook event', post.id)
+            metrics.inc('janus_source_posts_total', source='webhook')
+            self._push(post)
+        for sink in self.enabledsinks:
+            sink.flush()
+
+    def command_webhook(self, port='8090', addr='0.0.0.0'):
+        'Receive Facebook page webhooks in the background, pushing changed posts through the sinks as the events come. Needs FB_VERIFY_TOKEN and FB_APP_SECRET. Args: port (optional), addr (optional)'
+        if self.webhook is not None:
+            raise JanusException('Already receiving webhooks. Use `stop_webhook` first')
+        if not self.enabledsinks:
+            self._assert_sinks()
+            return
+        self.errors = []
+        ingest = JanusWebhookIngest(self._deliver_webhook_posts)
+        try:
+            receiver = JanusWebhookReceiver(os.environ.get('FB_VERIFY_TOKEN'), os.environ.get('FB_APP_SECRET'), ingest)
+            _, httpd = run_webhook_server(receiver, int(port), addr)
+        except Exception:
+            ingest.stop()
+            raise
+        self.webhook = (httpd, receiver)
+        puts(colored.green('Receiving webhooks at http://{}:{}{}'.format(addr, port, WEBHOOK_PATH)))
+
+    def command_stop_webhook(self):
+        'Stop receiving webhooks, and let the sinks finish'
+        if self.webhook is None:
+            return
+        httpd, receiver = self.webhook
+        httpd.shutdown()
+        httpd.server_close()
+        dropped = receiver.ingest.stop()
+        self.webhook = None
+        for sink in self.enabledsinks:
+            sink.finished()
+        puts(colored.blue('Pushed {} posts from {} webhook events'.format(receiver.ingest.delivered, receiver.events)))
+        if dropped:
+            puts(colored.red('{} posts from the last events were not fetched: {}'.format(len(dropped), ', '.join(dropped))))
+        self.command_show_last_errors()
 
-    def _outsink__csv(self, filename, separator=None):
-        'Push Post data to a CSV file. Args: filename, separator(optional, defaults to ,)'
-        return JanusCSVSink(filename, separator, self.output)
+    def command_webhook_simulate(self, *postids):
+        'Send signed page feed events for `postids` to our own webhook receiver, like Facebook would, and time them to the sinks. Args: post ids'
+        if self.webhook is None:
+            raise JanusException('Not receiving webhooks. Use `webhook` first')
+        if not postids:
+            raise JanusException('Which posts? Give one or more post ids')
+        httpd, receiver = self.webhook
+        url = 'http://127.0.0.1:{}{}'.format(httpd.server_address[1], WEBHOOK_PATH)
+        if not simulate_subscribe(url, receiver.verify_token):
+            raise JanusException('The receiver did not answer the subscription challenge')
+        t0 = time.perf_counter()
+        status = simulate_event(url, receiver.secret, postids)
+        if status != 200:
+            raise JanusException('The receiver answered {}'.format(status))
+        if not receiver.ingest.wait(60):
+            raise JanusException('The posts were not pushed within a minute, see the log')
+        puts(colored.green('{} posts went from event to sinks in {:.2f}s'.format(len(postids), time.perf_counter() - t0)))
+
+    def command_replay_outbox(self, retry_failed='no', timeout='600'):
+        'Send the Fusion writes left in the outbox, e.g. after a crash. Args: retry_failed (optional, `yes` to also retry writes that failed for good), timeout (optional, seconds to wait)'
+        self._require_idle()
+        outbox = fusion_outbox()
+        outbox.replay()
+        if retry_failed.lower() == 'yes':
+            outbox.retry_failed()
+        waiting = len(outbox.pending)
+        if not waiting:
+            puts(colored.green('Nothing to send in {}'.format(outbox.path)))
+            return
+        puts(colored.blue('Sending {} writes from {}'.format(waiting, outbox.path)))
+        delivered = outbox.delivered
+        outbox.start()
+        left = outbox.drain(float(timeout))
+        puts(colored.green('Sent {} writes'.format(outbox.delivered - delivered)))
+        if left:
+            puts(colored.red('{} writes still waiting, Fusion is probably rate limiting us. Try again later'.format(left)))
+        if outbox.failed:
+            puts(colored.red('{} writes failed for good, see the log'.format(len(outbox.failed))))
 
     def command_set_runlog(self, logname):
         'Set up logging to file. Everything that goes to console also goes there'
@@ -311,7 +769,7 @@ class Janus:
             puts(colored.green('No errors. yay'))
         else:
             puts(colored.red('There were {} errors:'.format(len(self.errors))))
-            for (post, ex) in self.errors:
+            for (post, ex) in list(self.errors): # the webhook thread may be adding to it
                 puts(colored.red('ID: {}, Date: {}, Author: {} -- {}'.format(post.id, post.datetime_created.isoformat(), post.name, str(ex))))
 
     def command_fb_authenticate(self):
@@ -356,22 +814,54 @@ if __name__ == '__main__':
         j.command_set_since(args.since)
     if args.until is not None:
         j.command_set_until(args.until)
+    if args.quiet:
+        j.command_set_quiet()
 
     runner = console.CommandRunner()
     runner.command('set_page', j.command_set_page)
     runner.command('set_cached_page', j.command_set_page_cached)
+    runner.command('set_comment_threads', j.command_set_comment_threads)
+    runner.command('set_comments_source', j.command_set_comments_source)
+    runner.command('set_field_profile', j.command_set_field_profile)
+    runner.command('set_page_limit', j.command_set_page_limit)
+    runner.command('set_graph_cache', j.command_set_graph_cache)
+    runner.command('set_workers', j.command_set_workers)
+    runner.command('webhook', j.command_webhook)
+    runner.command('stop_webhook', j.command_stop_webhook)
+    runner.command('webhook_simulate', j.command_webhook_simulate)
     runner.command('set_fusiontable', j.command_set_source_fusiontable)
     runner.command('set_since', j.command_set_since)
     runner.command('set_until', j.command_set_until)
     runner.command('set_filter', j.command_set_source_filter)
     runner.command('show_errors', j.command_show_last_errors)
+    runner.command('quiet', j.command_set_quiet)
     runner.command('add_sink', j.command_add_outsink)
     runner.command('add_sink_by_name', j.command_add_outsink_by_name)
     runner.command('enabled_sinks', j.command_list_enabled_outsinks)
     runner.command('disable_sink', j.command_disable_outsink)
     runner.command('pull', j.command_pull_posts)
+    runner.command('profile_pull', j.command_profile_pull)
+    runner.command('load_table', j.command_load_table)
+    runner.command('table_filter', j.command_table_filter)
+    runner.command('table_groupby', j.command_table_groupby)
+    runner.command('table_to_csv', j.command_table_to_csv)
     runner.command('fb_auth', j.command_fb_authenticate)
+    runner.command('serve', j.command_serve)
+    runner.command('stop_serving', j.command_stop_serving)
+    runner.command('stats', j.command_show_stats)
+    runner.command('export_stats', j.command_export_stats)
+    runner.command('merge_stats', j.command_merge_stats)
+    runner.command('history_curve', j.command_history_curve)
+    runner.command('history_risers', j.command_history_risers)
+    runner.command('replay_outbox', j.command_replay_outbox)
+    runner.command('retry_errors', j.command_retry_errors)
     j.format_prompt()
+    startup = time.perf_counter() - JANUS_STARTED
+    metrics.observe('janus_startup_seconds', startup)
+    if startup > JANUS_STARTUP_TARGET:
+        logger.warning('Startup took %.2fs, more than the %.2fs target. See benchmarks/startup.py', startup, JANUS_STARTUP_TARGET)
+    else:
+        logger.debug('Startup took %.2fs', startup)
     ex = console.Console(runner).run_in_main()
     sys.exit(ex)
 
@@ -17,6 +17,9 @@
 import httplib2
 import urllib.parse
 import sys,os
+import re
+import threading
+import time
 import logging
 import colorlog
 import json
@@ -24,11 +27,11 @@ from pprint import pprint
 from dotenv import load_dotenv, find_dotenv
 load_dotenv(find_dotenv())
 
-from apiclient.discovery import build
-from oauth2client import tools
-from oauth2client.file import Storage
-from oauth2client.client import AccessTokenRefreshError
-from oauth2client.client import OAuth2WebServerFlow
+# apiclient and oauth2client are slow to import, so they are imported in Fusion() and run()
+# when a source or sink actually needs them
+
+from januslib.metrics import metrics
+from januslib.logutil import abbrev
 
 logger = colorlog.getLogger('Janus.fusionclient')
 
@@ -39,20 +42,76 @@ client_secret = os.environ.get("CLIENT_SECRET")
 # The scope URL for read/write access to a user's calendar data
 scope = 'https://www.googleapis.com/auth/fusiontables'
 
-# Create a flow object. This object holds the client_id, client_secret, and
-# scope. It assists with OAuth 2.0 steps to get user authorization and
-# credentials.
-flow = OAuth2WebServerFlow(client_id, client_secret, scope)
+# The discovery document describes the api, and `build()` fetches it on every call.
+# We keep a copy on disk and build from that instead
+DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/fusiontables/v2/rest'
+DISCOVERY_CACHE = os.environ.get('JANUS_DISCOVERY_CACHE', os.path.expanduser('~/.cache/janus/fusiontables-v2.json'))
+DISCOVERY_MAX_AGE = 7*24*3600 # seconds
+METADATA_MAX_AGE = 300 # seconds to trust the cached table list and column metadata
+SCHEMA_SQL = re.compile(r'(^|;)\s*(CREATE|ALTER|DROP)\b', re.IGNORECASE) # statements that change tables or columns
+
+_flow = None
+
+def get_flow():
+    # Create a flow object. This object holds the client_id, client_secret, and
+    # scope. It assists with OAuth 2.0 steps to get user authorization and
+    # credentials.
+    global _flow
+    if _flow is None:
+        from oauth2client.client import OAuth2WebServerFlow
+        _flow = OAuth2WebServerFlow(client_id, client_secret, scope)
+    return _flow
+
+def discovery_document(http):
+    'Return the fusiontables discovery document, from the disk cache if it is fresh'
+    try:
+        if time.time() - os.path.getmtime(DISCOVERY_CACHE) < DISCOVERY_MAX_AGE:
+            with open(DISCOVERY_CACHE, encoding='utf-8') as f:
+                doc = f.read()
+            json.loads(doc) # make sure it's whole
+            return doc
+    except (OSError, ValueError) as e:
+        logger.debug('No usable discovery document in cache: %s', e)
+    with metrics.timer('janus_http_request_seconds', service='fusiontables', endpoint='discovery'):
+        response, content = http.request(DISCOVERY_URL)
+    if int(response['status']) != 200:
+        raise RuntimeError('Could not get the fusiontables discovery document: {}'.format(response['status']))
+    doc = content.decode('utf-8')
+    try:
+        os.makedirs(os.path.dirname(DISCOVERY_CACHE), exist_ok=True)
+        tmp = '{}.{}.tmp'.format(DISCOVERY_CACHE, os.getpid())
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(doc)
+        os.replace(tmp, DISCOVERY_CACHE)
+    except OSError as e:
+        logger.warning('Could not cache the discovery document in %s: %s', DISCOVERY_CACHE, e)
+    return doc
+
+_clients = {} # credentials file -> Fusion, see get_client()
+_clients_lock = threading.Lock()
+
+def get_client(credentials='credentials.dat'):
+    'Return the process wide Fusion client for `credentials`, authorizing and building it on first use'
+    with _clients_lock:
+        try:
+            return _clients[credentials]
+        except KeyError:
+            logger.debug('Creating Fusion client for %s', credentials)
+            client = _clients[credentials] = Fusion(credentials)
+            return client
 
 class Fusion:
 
-  def __init__(self):
+  def __init__(self, credentials='credentials.dat'):
+    from apiclient.discovery import build_from_document
+    from oauth2client import tools
+    from oauth2client.file import Storage
     # Create a Storage object. This object holds the credentials that your
     # application needs to authorize access to the user's data. The name of the
     # credentials file is provided. If the file does not exist, it is
     # created. This object can only hold credentials for a single user, so
     # as-written, this script can only handle a single user.
-    storage = Storage('credentials.dat')
+    storage = Storage(credentials)
 
     # The get() function returns the credentials for the Storage object. If no
     # credentials were found, None is returned.
@@ -67,25 +126,30 @@ class Fusion:
     # The new credentials are also stored in the supplied Storage object,
     # which updates the credentials.dat file.
     if credentials is None or credentials.invalid:
-        credentials = tools.run_flow(flow, storage, tools.argparser.parse_args())
+        credentials = tools.run_flow(get_flow(), storage, tools.argparser.parse_args())
 
     # Create an httplib2.Http object to handle our HTTP requests, and authorize it
     # using the credentials.authorize() function.
     http = httplib2.Http()
     http = credentials.authorize(http)
 
-    # The apiclient.discovery.build() function returns an instance of an API service
+    # The apiclient.discovery.build_from_document() function returns an instance of an API service
     # object can be used to make API calls. The object is constructed with
-    # methods specific to the calendar API. The arguments provided are:
-    #   name of the API ('calendar')
-    #   version of the API you are using ('v3')
-    #   authorized httplib2.Http() object that can be used for API calls
-    self.service = build('fusiontables', 'v2', http=http)
+    # methods specific to the fusiontables API, described by the (cached) discovery document,
+    # and uses the authorized httplib2.Http() object for API calls
+    with metrics.timer('janus_fusion_build_seconds'):
+        self.service = build_from_document(discovery_document(http), http=http)
     self.http = self.service._http
+    # httplib2 is not thread safe, and sources, sinks and the labelling service share this client
+    self._lock = threading.RLock()
+    self._tables = None # (fetched at, [table metadata]), see .tables()
 
   def run(self, request):
+        from oauth2client.client import AccessTokenRefreshError
         try:
-            response = request.execute()
+            with metrics.timer('janus_http_request_seconds', service='fusiontables', endpoint=getattr(request, 'methodId', 'api')):
+                with self._lock:
+                    response = request.execute()
             # Accessing the response like a dict object with an 'items' key
             # returns a list of item objects (events).
             #logging.debug(response)
@@ -104,11 +168,18 @@ class Fusion:
         url = '{}query'.format(self.service._baseUrl)
         logger.debug('sending request to %r', url)
         headers = {'Content-type': 'application/x-www-form-urlencoded'}
-        response, content = self.http.request(url, 
-                                              'POST', 
-                                              headers=headers, 
-                                              body=urllib.parse.urlencode({'sql':sqlstring}))
+        body = urllib.parse.urlencode({'sql':sqlstring})
+        metrics.inc('janus_http_request_bytes_total', len(body), service='fusiontables', endpoint='query')
+        with metrics.timer('janus_http_request_seconds', service='fusiontables', endpoint='query'):
+            with self._lock:
+                response, content = self.http.request(url, 
+                                                      'POST', 
+                                                      headers=headers, 
+                                                      body=body)
+        metrics.inc('janus_http_response_bytes_total', len(content), service='fusiontables', endpoint='query')
         #logger.debug('.sql got %r response: %r', response, content)
+        if SCHEMA_SQL.search(sqlstring): # the table list and its columns may have changed
+            self._tables = None
         try:
             cont = json.loads(content.decode())
         except:
@@ -117,6 +188,10 @@ class Fusion:
 
   def insertrows(self, tableid, sqlvals):
         'sqlvals is a list of OrderedDicts' 
+        return self.sql(self.insert_statement(tableid, sqlvals)) #returning tuple
+
+  def insert_statement(self, tableid, sqlvals):
+        'Return the INSERT statements for sqlvals, a list of OrderedDicts, as one string'
         kyes = sqlvals[0].keys()
         colnames = [ swrap(k) for k in kyes ]
         valblock = []
@@ -127,11 +202,11 @@ class Fusion:
                                                                 ', '.join( [ swrap(vals[v]) for v in kyes ] )
                                                                 )
                                                                 )
-        logger.debug("generated INSERT sql: %r", sql)
-        return self.sql('; '.join(sql)) #returning tuple
+        logger.debug("generated %i INSERT statements: %r", len(sql), abbrev(sql))
+        return '; '.join(sql)
 
-  def select(self, what, tableid, where=None):
-        'Run a SQL SELECT query to get `what` (a list of columns or a function) on `tableid`, optionally filtered by `where`, and return response'
+  def select(self, what, tableid, where=None, limit=None):
+        'Run a SQL SELECT query to get `what` (a list of columns or a function) on `tableid`, optionally filtered by `where` and capped at `limit` rows, and return response'
         if isinstance(what, list):
             q = 'ROWID,'+','.join(map(swrap, what))
         else:
@@ -139,10 +214,25 @@ class Fusion:
         sqlstring = "SELECT {} FROM {} ".format(q, tableid)
         if isinstance(where, list) and len(where) > 0: # where is a list of conditionals
             sqlstring = sqlstring + " WHERE {}".format(' AND '.join(where))
-        logger.debug("generated SELECT sql: %r", sqlstring)
+        if limit is not None:
+            sqlstring = sqlstring + " LIMIT {}".format(int(limit))
+        logger.debug("generated SELECT sql: %r", abbrev(sqlstring))
         req = self.service.query().sqlGet(sql=sqlstring)
         return self.run(req)
 
+  def tables(self, max_age=METADATA_MAX_AGE):
+        'Return the metadata of all tables, with columns, from cache if it is younger than `max_age` seconds'
+        cached = self._tables
+        if cached is not None and time.time() - cached[0] < max_age:
+            metrics.inc('janus_fusion_metadata_total', result='hit')
+            return cached[1]
+        metrics.inc('janus_fusion_metadata_total', result='miss')
+        response = self.run(self.service.table().list()) or {}
+        items = response.get('items', [])
+        now = time.time()
+        self._tables = (now, items)
+        return items
+
 def swrap(a):
     return ''' '{}' '''.format(a)
 
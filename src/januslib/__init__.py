@@ -6,18 +6,28 @@ import json
 import uuid
 import dateutil
 from pathlib import Path
+from clint.textui import puts
 
 logger = colorlog.getLogger('Janus.januslib')
 
 class JanusException(Exception):
     pass
 
+def report(obj, msg):
+    'Print `msg` to console if `obj` is verbose. Always send it to the log'
+    logger.debug('%s: %s', obj, getattr(msg, 's', msg)) # unwrap clint ColoredString
+    if obj.verbose:
+        puts(msg)
+
 class JanusSource:
     def __init__(self, outputchannel):
         self.output = outputchannel # duck typed file object 
         self.since = None
         self.until = None
-        self.filter = None
+        self.filter = None # a januslib.filters.JanusFilter
+        self.residual = None # the part of self.filter the server could not do for us, see ._keep()
+        self.skipped = 0 # posts the residual filter dropped
+        self.verbose = True # print progress details to console
         self.id = str(uuid.uuid4())[:4]
         # seed feed
 
@@ -33,22 +43,48 @@ class JanusSource:
     def __iter__(self):
         raise NotImplementedError
 
+    def estimate_count(self):
+        'Return the number of posts this source will yield, or None if it is not known up front'
+        return None
+
     def authenticate(self):
         raise NotImplementedError
 
+    def set_verbose(self, verbose):
+        self.verbose = verbose
+
     def set_since(self, dtobj):
         self.since = dtobj # datetime.datetime
 
     def set_until(self, dtobj):
         self.until = dtobj # datetime.datetime
 
-    def set_filter(self, filterstring):
-        'Each source will use this to filter results server side. The format is source dependant'
-        self.filter = filterstring 
+    def set_filter(self, flt):
+        '''Filter posts with a januslib.filters.JanusFilter, or None for all posts.
+        Sources override this to push what they can to the server, and leave the rest in .residual'''
+        self.filter = flt
+        self.residual = flt
+
+    def _keep(self, posts):
+        'Yield the posts that pass the residual filter'
+        if self.residual is None:
+            yield from posts
+            return
+        for post in posts:
+            if self.residual(post):
+                yield post
+            else:
+                self.skipped += 1
 
 class JanusSink:
+    # (function, args) that turns raw post data into what .push_row() takes, for sinks whose formatting
+    # is worth running in a process pool. See januslib.transform. None means posts go to .push()
+    transform = None
+
     def __init__(self, outputchannel):
         self.output = outputchannel # duck typed file object 
+        self.verbose = True # print progress details to console
+        self.spec = None # (outsink name, args) when added by Janus, so it can be made again. See retry_errors
         self.id = str(uuid.uuid4())[:4]
         # seed feed
 
@@ -64,15 +100,33 @@ class JanusSink:
     def authenticate(self):
         raise NotImplementedError
 
+    def set_verbose(self, verbose):
+        self.verbose = verbose
+
+    @property
+    def queue_depth(self):
+        'Number of posts pushed but not yet delivered'
+        return 0
+
     def push(self, post):
         raise NotImplementedError
 
+    def push_row(self, post, row):
+        'Take a post together with its row, made by .transform in a worker process'
+        raise NotImplementedError
+
+    def flush(self):
+        'Hand over what is queued so far, without ending the run. Used between webhook batches'
+        pass
+
     def finished(self):
         raise NotImplementedError
 
 class JanusPost:
     'A Janus post with a standard interface'
 
+    kind = 'post' # what sinks get pushed, `post` or `comment`
+
     @property
     def id(self):
         raise NotImplementedError
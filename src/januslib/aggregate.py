@@ -0,0 +1,300 @@
+import base64
+import colorlog
+import hashlib
+import io
+import json
+import math
+import os
+
+from . import JanusException
+
+logger = colorlog.getLogger('Janus.januslib.aggregate')
+
+AGGREGATE_VERSION = 1
+BUCKETS = ('hour', 'day', 'week', 'month')
+METRICS = ('like_count', 'share_count', 'comment_count') # JanusPost properties we sum, average and sketch
+
+def bucket_key(dt, bucket):
+    'Return the time bucket of datetime `dt` as a sortable string'
+    if bucket == 'hour':
+        return dt.strftime('%Y-%m-%dT%H')
+    elif bucket == 'day':
+        return dt.strftime('%Y-%m-%d')
+    elif bucket == 'week':
+        year, week, _ = dt.isocalendar()
+        return '{}-W{:02d}'.format(year, week)
+    elif bucket == 'month':
+        return dt.strftime('%Y-%m')
+    raise JanusException('Unknown time bucket {!r}, use one of {}'.format(bucket, ', '.join(BUCKETS)))
+
+class HyperLogLog:
+    'Approximate distinct counter in 2**p bytes. Standard error is about 1.04/sqrt(2**p), 1.6% for p=12'
+
+    def __init__(self, p=12, registers=None):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(self.m) if registers is None else bytearray(registers)
+
+    def add(self, value):
+        h = int.from_bytes(hashlib.blake2b(str(value).encode('utf-8'), digest_size=8).digest(), 'big')
+        idx = h >> (64 - self.p)
+        rest = h & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1 # position of the first 1 bit
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.m and zeros:
+            return int(round(self.m * math.log(self.m / zeros))) # linear counting for small cardinalities
+        return int(round(estimate))
+
+    def merge(self, other):
+        if other.p != self.p:
+            raise JanusException('Cannot merge HyperLogLogs of different precision')
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+    def to_dict(self):
+        return {'p': self.p, 'registers': base64.b64encode(bytes(self.registers)).decode('ascii')}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['p'], base64.b64decode(d['registers']))
+
+class TDigest:
+    'A merging t-digest: approximate quantiles in constant memory, most accurate at the tails'
+
+    def __init__(self, compression=100):
+        self.compression = compression
+        self.centroids = [] # sorted list of [mean, weight]
+        self.buffer = [] # unmerged (value, weight)
+        self.total = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value, weight=1):
+        self.buffer.append( (value, weight) )
+        self.total += weight
+        if value < self.min: self.min = value
+        if value > self.max: self.max = value
+        if len(self.buffer) > 5 * self.compression:
+            self._compress()
+
+    def _k(self, q):
+        'the k1 scale function of the t-digest paper'
+        return self.compression / (2 * math.pi) * math.asin(2 * min(q, 1.0) - 1)
+
+    def _compress(self):
+        if not self.buffer:
+            return
+        items = sorted([ tuple(c) for c in self.centroids ] + self.buffer)
+        self.buffer = []
+        merged = []
+        mean, weight = items[0]
+        before = 0 # weight of all centroids before the current one
+        k_left = self._k(0)
+        for m, w in items[1:]:
+            # a centroid may span at most 1 on the k scale, which makes them small at the tails
+            if self._k((before + weight + w) / self.total) - k_left <= 1:
+                mean = (mean * weight + m * w) / (weight + w)
+                weight += w
+            else:
+                merged.append([mean, weight])
+                before += weight
+                k_left = self._k(before / self.total)
+                mean, weight = m, w
+        merged.append([mean, weight])
+        self.centroids = merged
+
+    def quantile(self, q):
+        'Return the approximate `q` quantile (0..1), or None if empty'
+        self._compress()
+        if not self.centroids:
+            return None
+        if len(self.centroids) == 1:
+            return self.centroids[0][0]
+        target = q * self.total
+        cum = 0 # weight up to the center of the previous centroid
+        prev_mean, prev_center = self.min, 0
+        for mean, weight in self.centroids:
+            center = cum + weight / 2
+            if target <= center:
+                span = center - prev_center
+                frac = (target - prev_center) / span if span else 0
+                return prev_mean + frac * (mean - prev_mean)
+            prev_mean, prev_center = mean, center
+            cum += weight
+        span = self.total - prev_center
+        frac = (target - prev_center) / span if span else 0
+        return prev_mean + frac * (self.max - prev_mean)
+
+    def merge(self, other):
+        other._compress()
+        for mean, weight in other.centroids:
+            self.buffer.append( (mean, weight) )
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress()
+
+    def to_dict(self):
+        self._compress()
+        return {'compression': self.compression,
+                'centroids': self.centroids,
+                'min': self.min if self.total else None,
+                'max': self.max if self.total else None,
+                }
+
+    @classmethod
+    def from_dict(cls, d):
+        t = cls(d['compression'])
+        t.centroids = [ list(c) for c in d['centroids'] ]
+        t.total = sum(w for _, w in t.centroids)
+        if t.total:
+            t.min, t.max = d['min'], d['max']
+        return t
+
+class AggregateCell:
+    'Count, sums, sketches and distinct authors for one (time bucket, group)'
+
+    def __init__(self):
+        self.count = 0
+        self.sums = {m: 0 for m in METRICS}
+        self.digests = {m: TDigest() for m in METRICS}
+        self.authors = HyperLogLog()
+
+    def add(self, values, author):
+        self.count += 1
+        for m, v in values.items():
+            self.sums[m] += v
+            self.digests[m].add(v)
+        self.authors.add(author)
+
+    def merge(self, other):
+        self.count += other.count
+        for m in METRICS:
+            self.sums[m] += other.sums[m]
+            self.digests[m].merge(other.digests[m])
+        self.authors.merge(other.authors)
+
+    def to_dict(self):
+        return {'count': self.count,
+                'sums': self.sums,
+                'digests': {m: d.to_dict() for m, d in self.digests.items()},
+                'authors': self.authors.to_dict(),
+                }
+
+    @classmethod
+    def from_dict(cls, d):
+        c = cls()
+        c.count = d['count']
+        c.sums = dict(d['sums'])
+        c.digests = {m: TDigest.from_dict(v) for m, v in d['digests'].items()}
+        c.authors = HyperLogLog.from_dict(d['authors'])
+        return c
+
+def _number(v):
+    'Fusion tables hand us numbers as strings, sometimes empty'
+    try:
+        return float(v) if v not in (None, '') else 0
+    except (TypeError, ValueError):
+        return 0
+
+class JanusAggregate:
+    '''Streaming aggregate of posts, per time bucket and (optionally) per value of a post field.
+
+    Memory grows with the number of (bucket, group) cells, and the ids of the posts counted, which
+    are kept so a post pulled again is not counted twice. Aggregates with the same `groupby` and
+    `bucket` can be merged, e.g. from sharded runs.'''
+
+    def __init__(self, groupby=None, bucket='day'):
+        if bucket not in BUCKETS:
+            raise JanusException('Unknown time bucket {!r}, use one of {}'.format(bucket, ', '.join(BUCKETS)))
+        self.groupby = groupby # a JanusPost property, e.g. `name`, or a raw field, e.g. `type`
+        self.bucket = bucket
+        self.cells = {} # (bucket, group) -> AggregateCell
+        self.counted = 0
+        self.seen = set() # ids of the posts in the cells
+
+    def __str__(self):
+        return 'per {}{}'.format(self.bucket, ' and {}'.format(self.groupby) if self.groupby else '')
+
+    def _group(self, post):
+        if self.groupby is None:
+            return ''
+        try:
+            return str(getattr(post, self.groupby))
+        except (AttributeError, KeyError):
+            return str(post.post.get(self.groupby, ''))
+
+    def add(self, post):
+        'Count `post`, unless it is counted already. Returns False if it was'
+        if post.id in self.seen:
+            return False
+        key = (bucket_key(post.datetime_created, self.bucket), self._group(post))
+        try:
+            cell = self.cells[key]
+        except KeyError:
+            cell = self.cells[key] = AggregateCell()
+        cell.add({m: _number(getattr(post, m, 0)) for m in METRICS}, post.name)
+        self.seen.add(post.id)
+        self.counted += 1
+        return True
+
+    def merge(self, other):
+        if (other.groupby, other.bucket) != (self.groupby, self.bucket):
+            raise JanusException('Cannot merge aggregate {} into {}'.format(other, self))
+        overlap = len(self.seen & other.seen)
+        if overlap:
+            logger.warning('%i posts are in both aggregates, they are counted twice', overlap)
+        for key, cell in other.cells.items():
+            if key in self.cells:
+                self.cells[key].merge(cell)
+            else:
+                self.cells[key] = cell
+        self.counted += other.counted
+        self.seen |= other.seen
+
+    def rows(self, quantiles=(0.5, 0.9, 0.99)):
+        'Yield one flat dict per (bucket, group), sorted'
+        for (bucket, group), cell in sorted(self.cells.items()):
+            row = {'bucket': bucket, 'group': group, 'count': cell.count, 'distinct_authors': cell.authors.count()}
+            for m in METRICS:
+                row['sum_{}'.format(m)] = cell.sums[m]
+                row['mean_{}'.format(m)] = cell.sums[m] / cell.count if cell.count else 0
+                for q in quantiles:
+                    row['p{}_{}'.format(int(q * 100), m)] = cell.digests[m].quantile(q)
+            yield row
+
+    def to_dict(self):
+        return {'version': AGGREGATE_VERSION,
+                'groupby': self.groupby,
+                'bucket': self.bucket,
+                'counted': self.counted,
+                'cells': [ [b, g, c.to_dict()] for (b, g), c in sorted(self.cells.items()) ],
+                'seen': sorted(self.seen),
+                }
+
+    @classmethod
+    def from_dict(cls, d):
+        if d.get('version') != AGGREGATE_VERSION:
+            raise JanusException('Unsupported aggregate version: {!r}'.format(d.get('version')))
+        a = cls(d['groupby'], d['bucket'])
+        a.counted = d['counted']
+        a.cells = { (b, g): AggregateCell.from_dict(c) for b, g, c in d['cells'] }
+        a.seen = set(d.get('seen', [])) # older files did not keep them
+        return a
+
+    def save(self, path):
+        'Write the aggregate to `path`, atomically'
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with io.open(tmp, 'w') as f:
+            json.dump(self.to_dict(), f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with io.open(path) as f:
+            return cls.from_dict(json.load(f))
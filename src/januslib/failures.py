@@ -0,0 +1,121 @@
+import collections
+import colorlog
+import hashlib
+import io
+import json
+import os
+import time
+from pathlib import Path
+
+from . import JanusException
+
+logger = colorlog.getLogger('Janus.januslib.failures')
+
+class JanusFailureLog:
+    '''Posts that a sink failed on, for `retry_errors`.
+
+    Each failure is one JSON line: post id, the sink spec (outsink name and args), the error
+    class and message, and where the raw post is. Posts read from the disk cache point to their
+    cache file. Others are spooled, once, to <spooldir>/<hash>.json'''
+
+    def __init__(self, path, spooldir):
+        self.path = path
+        self.spooldir = spooldir
+
+    def _spool(self, post):
+        'Return where the raw post is, writing it to the spool if it is not on disk already'
+        path = getattr(post, 'path', None)
+        if path is not None and os.path.exists(str(path)):
+            return {'class': post.__class__.__name__, 'path': str(path)}
+        raw = {'class': post.__class__.__name__, 'post': post.post}
+        if hasattr(post, 'post_id'): # a comment record
+            raw.update(post_id=post.post_id, parent_id=post.parent_id)
+        data = json.dumps(raw, sort_keys=True).encode('utf-8')
+        spooled = os.path.join(self.spooldir, '{}.json'.format(hashlib.sha1(data).hexdigest()[:16]))
+        if not os.path.exists(spooled):
+            os.makedirs(self.spooldir, exist_ok=True)
+            tmp = '{}.{}.tmp'.format(spooled, os.getpid())
+            with io.open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, spooled)
+        return {'class': post.__class__.__name__, 'spool': spooled}
+
+    def record(self, post, sink, error):
+        'Remember that `sink` failed on `post` with `error`'
+        try:
+            raw = self._spool(post)
+        except Exception as e: # never let bookkeeping hide the original error
+            logger.warning('Could not store post %s for retrying: %s', post.id, e)
+            raw = {'class': post.__class__.__name__}
+        rec = {'post': post.id,
+               'sink': getattr(sink, 'spec', None),
+               'sinklabel': str(sink),
+               'error': error.__class__.__name__,
+               'message': str(error)[:500],
+               'raw': raw,
+               'ts': time.time(),
+               }
+        dirn = os.path.dirname(self.path)
+        if dirn:
+            os.makedirs(dirn, exist_ok=True)
+        with io.open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(rec) + '\n')
+
+    def load(self):
+        'Return all failures on record, oldest first'
+        try:
+            f = io.open(self.path, encoding='utf-8')
+        except FileNotFoundError:
+            return []
+        with f:
+            return [ json.loads(line) for line in f if line.strip() ]
+
+    def by_sink(self):
+        'Return failures grouped by sink spec: OrderedDict of (name, args) -> [failure, ...]'
+        groups = collections.OrderedDict()
+        for rec in self.load():
+            key = tuple(rec['sink']) if rec['sink'] else None
+            if key is not None:
+                key = (key[0], tuple(key[1]))
+            groups.setdefault(key, []).append(rec)
+        return groups
+
+    def replace(self, failures):
+        'Rewrite the log with `failures`, e.g. what is left after a retry'
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        with io.open(tmp, 'w', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(rec) + '\n' for rec in failures))
+        os.replace(tmp, self.path)
+        self._prune_spool(failures)
+
+    def _prune_spool(self, failures):
+        'Remove spooled posts nobody refers to any more'
+        if not os.path.isdir(self.spooldir):
+            return
+        keep = set(rec['raw'].get('spool') for rec in failures)
+        for entry in os.scandir(self.spooldir):
+            if entry.path not in keep:
+                os.remove(entry.path)
+
+def load_post(raw, postid):
+    '''Turn a failure's `raw` reference back into a post: from the cache file or the spool if we have it,
+    else from Facebook'''
+    from .fb import JanusFacebookPost, getPost
+    from .fbcomments import JanusFacebookComment
+    cls = raw.get('class')
+    if 'path' in raw and os.path.exists(raw['path']): # only cached Facebook posts have one
+        return JanusFacebookPost(Path(raw['path']))
+    if 'spool' in raw and os.path.exists(raw['spool']):
+        with io.open(raw['spool'], encoding='utf-8') as f:
+            data = json.load(f)
+        if cls == 'JanusFacebookPost':
+            return JanusFacebookPost(data['post'])
+        elif cls == 'JanusFacebookComment':
+            return JanusFacebookComment(data['post'], data['post_id'], data['parent_id'])
+        elif cls == 'JanusFusiontablePost':
+            from .fusiontables import JanusFusiontablePost
+            columns = list(data['post'])
+            return JanusFusiontablePost(columns, [ data['post'][c] for c in columns ])
+    if cls == 'JanusFacebookPost':
+        return getPost(postid) # not on disk, ask Facebook again
+    raise JanusException('Post {} is not stored anywhere'.format(postid))
@@ -3,10 +3,10 @@
 import logging
 import colorlog
 import os
+import json
+import dateutil.parser
 import html
 from pathlib import Path
-import facebook
-import requests
 from dotenv import load_dotenv, find_dotenv
 load_dotenv(find_dotenv())
 from clint.textui import colored, puts, indent
@@ -14,11 +14,71 @@ from clint.textui import colored, puts, indent
 import http.server
 import socketserver
 import threading
-import urllib
+import time
+import urllib.parse
 
 logger = logging.getLogger('Janus.januslib.fb')
 
-from . import JanusSource, JanusPost, JanusException
+from . import JanusSource, JanusPost, JanusException, report
+from .metrics import metrics
+from .fbcomments import JanusFBCommentCrawler
+from .graphcache import JanusCachedGraph
+from .render import render_comments
+
+# Graph fields to ask for, per profile. `summary(true).limit(0)` gives a total count without any payload
+FB_FIELDS_POST = 'from,id,message,created_time,status_type,shares,type,source,picture,link,permalink_url'
+FB_FIELD_PROFILES = {
+    # just enough to know what was posted, when and by whom
+    'minimal': 'from,id,message,created_time,type,permalink_url',
+    # post fields and engagement counts, no likers or comment payloads
+    'counts': FB_FIELDS_POST + ',likes.summary(true).limit(0),comments.summary(true).limit(0)',
+    # who liked, and three levels of comments inline
+    'full': FB_FIELDS_POST + ',likes.summary(true){name},comments.summary(true){from,id,like_count,message,created_time,'
+                             'comments{from,id,like_count,created_time,message,comments{from,id,like_count,created_time,message}}}',
+    # like full, but with comments as a bare count. The full threads are fetched by JanusFBCommentCrawler
+    'full_threads': FB_FIELDS_POST + ',likes.summary(true){name},comments.summary(true).limit(0)',
+}
+FB_DEFAULT_PROFILE = 'full'
+FB_THREADS_DEFAULT = 4 # posts at a time, when the full_threads profile is chosen without set_threads()
+FB_PAGE_LIMIT_START = 25 # posts per feed page, to begin with. Graph's own default
+FB_PAGE_LIMIT_MIN = 1
+FB_PAGE_LIMIT_MAX = 100 # Graph does not give more posts per feed page than this
+FB_PAGE_FAST_SECONDS = 2.0 # grow the page when it came back quicker than this
+FB_PAGE_SMALL_BYTES = 2*1024*1024 # and smaller than this
+FB_PAGE_RETRIES = 6 # shrink and retry this many times before giving up on a page
+FB_TIMEOUT = 60 # seconds
+
+def _count(edge):
+    'Total count of a Graph edge, from its summary if we asked for one (older caches have none)'
+    if not edge:
+        return 0
+    try:
+        return edge['summary']['total_count']
+    except KeyError:
+        return len(edge.get('data', []))
+
+def _too_much_data(error):
+    'Is this the GraphAPIError that asks us to reduce the amount of data?'
+    return 'reduce the amount of data' in str(error).lower()
+
+def _next_cursor(paging):
+    '''Return the params that get the page after this one, or None if this was the last.
+    Prefers the `after` cursor, else takes the cursor params out of the `next` url'''
+    if 'next' not in paging:
+        return None
+    after = paging.get('cursors', {}).get('after')
+    if after:
+        return {'after': after}
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(paging['next']).query)
+    cursor = { k: v[0] for k, v in query.items() if k in ('after', 'until', '__paging_token') }
+    return cursor or None
+
+def fields_for(profile):
+    'Return the Graph fields of a named profile'
+    try:
+        return FB_FIELD_PROFILES[profile]
+    except KeyError:
+        raise JanusException('Unknown field profile {!r}, use one of {}'.format(profile, ', '.join(sorted(FB_FIELD_PROFILES))))
 
 class JanusFB(JanusSource):
 
@@ -27,46 +87,150 @@ class JanusFB(JanusSource):
         self.pagename = facebookpage
         self.id = facebookpage
         self.graph = None
+        self.threads = 0 # fetch full comment threads, this many posts at a time. 0 means inline comments only
+        self.profile = FB_DEFAULT_PROFILE # see FB_FIELD_PROFILES
+        self.page_limit = None # posts per feed page. None adapts it, see ._adapt()
+        self._ceiling = FB_PAGE_LIMIT_MAX # largest page limit that has not failed in this pull
+        self.filter_range = (None, None) # (since, until) epoch seconds, pushed down from the filter
 
         # seed feed
-        self.params = {'fields': 'from,id,message,created_time,status_type,comments{from,id,like_count,message,comments{from,like_count,created_time,message,comments{from,like_count,created_time,message}},created_time},likes{name},shares,type,source,picture,link,permalink_url'
-        }
+        self.params = {'fields': fields_for(self.profile)}
 
     def __str__(self):
         'return pretty name'
         return '<<<FacebookPageONLINE({})'.format(self.pagename)
 
     def authenticate(self):
-        self.graph = facebook.GraphAPI(access_token=os.environ.get('FB_APP_TOKEN'), version='2.8')
+        import facebook # imported when first needed, it pulls in requests and friends
+        self.graph = JanusCachedGraph(facebook.GraphAPI(access_token=os.environ.get('FB_APP_TOKEN'), version='2.8', timeout=FB_TIMEOUT))
 
     def set_since(self, timestamp): # timestamp is datetime.datetime
-        self.params['since'] = timestamp.value() # convert to unix timestamp
+        super().set_since(timestamp)
+        self.params['since'] = int(timestamp.timestamp()) # convert to unix timestamp
 
     def set_until(self, timestamp): # timestamp is datetime.datetime
-        self.params['until'] = timestamp.value() # convert to unix timestamp
+        super().set_until(timestamp)
+        self.params['until'] = int(timestamp.timestamp()) # convert to unix timestamp
+
+    def set_filter(self, flt):
+        'Narrow the feed with since/until from the `created` conditions of `flt`. All of it is still checked locally'
+        super().set_filter(flt)
+        self.filter_range = flt.graph_range() if flt is not None else (None, None)
+
+    def _feed_params(self):
+        'The params for the first feed page: since/until from set_since/set_until and the filter, whichever is narrower'
+        params = dict(self.params, limit=self.page_limit or FB_PAGE_LIMIT_START)
+        since, until = self.filter_range
+        if since is not None:
+            params['since'] = max(params.get('since', since), since)
+        if until is not None:
+            params['until'] = min(params.get('until', until), until)
+        return params
+
+    def set_threads(self, concurrency):
+        'Fetch complete comment threads with cursor pagination, `concurrency` posts at a time. 0 turns it off'
+        self.threads = concurrency
+        if concurrency:
+            self.set_field_profile('full_threads')
+        elif self.profile == 'full_threads':
+            self.set_field_profile('full')
+
+    def set_field_profile(self, profile):
+        'Choose which Graph fields to ask for, by profile name. See FB_FIELD_PROFILES'
+        self.params['fields'] = fields_for(profile)
+        self.profile = profile
+        if profile == 'full_threads' and not self.threads:
+            self.threads = FB_THREADS_DEFAULT
+        elif profile != 'full_threads':
+            self.threads = 0 # threads go with full_threads only
+
+    def _page_posts(self, data):
+        'Yield JanusFacebookPost for each post dict in a feed page, with complete comment threads if asked for'
+        if not self.threads:
+            for post in data:
+                yield JanusFacebookPost(post)
+            return
+        crawler = JanusFBCommentCrawler(self.graph, self.threads)
+        for post, (_, tree) in zip(data, crawler.crawl([p['id'] for p in data])):
+            if tree is not None:
+                post['comments'] = tree
+            yield JanusFacebookPost(post)
+
+    def set_page_limit(self, limit):
+        'Posts per feed page: a number to keep it fixed, or None to let it adapt to how Graph copes'
+        self.page_limit = limit
+
+    def _fetch_page(self, params):
+        '''Get one feed page with params['limit'] posts, halving the limit and retrying when Graph says
+        the response is too big, or it times out. Returns (page, seconds, approximate bytes)'''
+        import facebook
+        import requests
+        retries = 0
+        while True:
+            t0 = time.perf_counter()
+            try:
+                with metrics.timer('janus_http_request_seconds', service='graph', endpoint='feed'):
+                    page = self.graph.request('/{}/feed'.format(self.pagename), params)
+            except (facebook.GraphAPIError, requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                if isinstance(e, facebook.GraphAPIError) and not _too_much_data(e):
+                    raise
+                retries += 1
+                metrics.inc('janus_graph_page_retries_total', error=e.__class__.__name__)
+                if retries > FB_PAGE_RETRIES or params['limit'] <= FB_PAGE_LIMIT_MIN:
+                    raise JanusException('Giving up on {} after {} tries, at {} posts per page: {}'.format(self.pagename, retries, params['limit'], e))
+                self._ceiling = params['limit'] - 1 # dont grow back into what just failed
+                params['limit'] = max(FB_PAGE_LIMIT_MIN, params['limit'] // 2)
+                logger.info('Graph choked on a page of %s (%s), retrying with limit=%i', self.pagename, e, params['limit'])
+                continue
+            elapsed = time.perf_counter() - t0
+            size = len(json.dumps(page)) # the sdk does not hand us the raw body, this is close enough
+            metrics.inc('janus_http_response_bytes_total', size, service='graph', endpoint='feed')
+            return page, elapsed, size
+
+    def _adapt(self, limit, elapsed, size):
+        'Grow the page limit while pages come back quick and small'
+        if self.page_limit is not None: # fixed
+            return limit
+        if elapsed < FB_PAGE_FAST_SECONDS and size < FB_PAGE_SMALL_BYTES and limit < self._ceiling:
+            grown = min(self._ceiling, limit + max(1, limit // 2))
+            logger.debug('Page of %i posts took %.2fs and %i bytes, growing limit to %i', limit, elapsed, size, grown)
+            return grown
+        return limit
 
     def __iter__(self):
         if self.graph is None:
             self.authenticate()
-        self.feed = self.graph.request('/{}/feed'.format(self.pagename), self.params)
-        # Wrap this block in a while loop so we can keep paginating requests until
-        # finished.
-        cont = True
-        while cont == True:
-            if len(self.feed['data']) == 0: # no posts (left)
-                raise StopIteration
-            puts(colored.magenta('Trawling through {} posts:'.format(len(self.feed['data']))), self.output)
-            try:
-                # Perform some action on each post in the collection we receive from
-                # Facebook.
-                for post in self.feed['data']:
-                    yield JanusFacebookPost(post)
-                # Attempt to make a request to the next page of data, if it exists.
-                self.feed = requests.get(self.feed['paging']['next']).json()
-            except KeyError:
-                # When there are no more pages (['paging']['next']), break from the
-                # loop and end the script.
-                raise StopIteration
+        params = self._feed_params()
+        self._ceiling = FB_PAGE_LIMIT_MAX
+        posts = pages = 0
+        fetching = 0.0 # seconds spent waiting for Graph
+        limits = []
+        while True:
+            self.feed, elapsed, size = self._fetch_page(params)
+            fetching += elapsed
+            data = self.feed.get('data', [])
+            limits.append(params['limit'])
+            metrics.observe('janus_graph_page_posts', len(data))
+            logger.debug('Feed page %i of %s: limit=%i, %i posts, %i bytes in %.2fs (%.0f posts/s)',
+                         pages, self.pagename, params['limit'], len(data), size, elapsed, len(data) / elapsed if elapsed else 0)
+            if len(data) == 0: # no posts (left)
+                break
+            pages += 1
+            posts += len(data)
+            report(self, colored.magenta('Trawling through {} posts:'.format(len(data))))
+            # Perform some action on each post in the collection we receive from
+            # Facebook.
+            yield from self._keep(self._page_posts(data))
+            cursor = _next_cursor(self.feed.get('paging', {}))
+            if cursor is None: # When there are no more pages, we're done
+                break
+            for key in ('after', 'until', '__paging_token'): # dont mix cursors from different pages
+                params.pop(key, None)
+            params.update(cursor)
+            params['limit'] = self._adapt(params['limit'], elapsed, size)
+        if pages:
+            logger.info('Fetched %i posts from %s in %i pages, %.1f posts/s waiting on Graph, page limit %i..%i',
+                        posts, self.pagename, pages, posts / fetching if fetching else 0, min(limits), max(limits))
 
 class JanusFBCached(JanusSource):
     'Reading Facebook posts from disk cache'
@@ -85,29 +249,51 @@ class JanusFBCached(JanusSource):
         'return pretty name'
         return '<<<FacebookPageCACHED({})'.format(self.pagename)
 
+    def estimate_count(self):
+        return len(list(self.cachepath.glob('*.json')))
+
     def __iter__(self):
-        yield from [JanusFacebookPost(p) for p in self.cachepath.glob('*.json')]
+        # one at a time, the cache may be big
+        yield from self._keep(JanusFacebookPost(p) for p in self.cachepath.glob('*.json'))
 
 class JanusFacebookPost(JanusPost):
     'A Facebook post with a standard JanusPost interface'
 
     def __init__(self, json_or_path):
+        self._post = None
         if isinstance(json_or_path, Path):
-            self.path = json_or_path
-            with json_or_path.open() as f:
-                self.post = json.loads(f.read())
+            self.path = json_or_path # read when first needed, see .post
         elif isinstance(json_or_path, dict):
-            self.post = json_or_path
+            self._post = json_or_path
             self.path = None
         elif os.path.exists(json_or_path):
             self.path = Path(json_or_path)
-            self.post = json.load(json_or_path)
         else:
-            self.post = json.loads(json_or_path)
+            self._post = json.loads(json_or_path)
             self.path = None
 
+    @property
+    def post(self):
+        'The raw Graph data. Cached posts are read on first use, sinks formatting in a worker process never need it here'
+        if self._post is None:
+            with self.path.open() as f:
+                self._post = json.load(f)
+        return self._post
+
+    def __getitem__(self, key):
+        'Let sinks read the raw Graph data, i.e. post["likes"]'
+        return self.post[key]
+
+    def __contains__(self, key):
+        return key in self.post
+
+    def get(self, key, default=None):
+        return self.post.get(key, default)
+
     @property
     def id(self):
+        if self._post is None: # the cache names files after the post id
+            return self.path.stem
         return self.post['id']
                     
     @property
@@ -122,7 +308,7 @@ class JanusFacebookPost(JanusPost):
 
     @property
     def like_count(self):
-        return self.post['likes']['summary']['total_count'] if 'likes' in self.post else 0
+        return _count(self.post.get('likes'))
 
     @property
     def share_count(self):
@@ -130,27 +316,19 @@ class JanusFacebookPost(JanusPost):
 
     @property
     def comment_count(self):
-        return self.post['comments']['summary']['total_count'] if 'comments' in self.post else 0
+        return _count(self.post.get('comments'))
 
     @property
     def comments(self):
         return self.post['comments']['data'] if 'comments' in self.post else []
 
-    def comments_html(self, comments_struct):
+    def comments_html(self, comments_struct, max_bytes=None):
         'Turn a json list of comments into an html string'
-        s = ['<ul>', ]
-        for com in comments_struct:
-            s.append('<li><b>{}</b> (+{}): {}'.format(html.escape(com['from']['name']), 
-                                                      com['like_count'], 
-                                                      html.escape(com['message'])
-                                                      )
-                    )
-            if 'comments' in com:
-                #recurse into nested comment
-                s.append(comments_html(com['comments']['data']))
-            s.append('</li>')
-        s.append('</ul>')
-        return ''.join(s)
+        return render_comments(comments_struct, 'html', max_bytes)
+
+    def comments_text(self, comments_struct, max_bytes=None):
+        'Turn a json list of comments into indented plain text'
+        return render_comments(comments_struct, 'text', max_bytes)
 
     @property
     def message(self):
@@ -178,7 +356,7 @@ class JanusFacebookPost(JanusPost):
     def media(self):
         try:
             if self.post['type'] == 'video':
-                return post['source']
+                return self.post['source']
             elif self.post['type'] == 'photo':
                 return self.post['picture']
             else:
@@ -186,18 +364,23 @@ class JanusFacebookPost(JanusPost):
         except KeyError:
             return ''
 
-def getPost(postid):
-    'Get a facebook post by its `postid`, returning JanusFacebookPost'
-
-    graph = facebook.GraphAPI(access_token=os.environ.get('FB_APP_TOKEN'), version='2.8')
-    params = {'fields': 'from,id,message,created_time,likes.summary(1),status_type,comments.summary(1),shares,type,source,picture,link,permalink_url'}
+def getPost(postid, profile='counts', cached=False):
+    '''Get a facebook post by its `postid`, with the fields of `profile`, returning JanusFacebookPost.
+    Straight from Graph, unless `cached` lets the graph cache answer (when it is on)'''
+    import facebook
+    graph = facebook.GraphAPI(access_token=os.environ.get('FB_APP_TOKEN'), version='2.8', timeout=FB_TIMEOUT)
+    if cached:
+        graph = JanusCachedGraph(graph)
+    params = {'fields': fields_for(profile)}
     try:
-        fbpost = graph.request('{}'.format(postid), params)
+        with metrics.timer('janus_http_request_seconds', service='graph', endpoint='post'):
+            fbpost = graph.request('{}'.format(postid), params)
         return JanusFacebookPost(fbpost)
     except facebook.GraphAPIError as e:
         raise JanusException(str(e))
 
 def fb_authenticate():
+    import facebook
     permissions = ['public_profile',]
     canvas_url = 'http://gulldahlpc.local:8080/'
     fb_login_url = facebook.auth_url(os.environ.get('FB_APP_ID'), canvas_url, permissions, response_type='token')
@@ -0,0 +1,171 @@
+#-*- enc: utf-8
+
+import collections
+import colorlog
+import dateutil.parser
+from concurrent.futures import ThreadPoolExecutor
+
+from . import JanusSource, JanusPost
+from .metrics import metrics
+
+logger = colorlog.getLogger('Janus.januslib.fbcomments')
+
+COMMENT_FIELDS = 'from,id,like_count,message,created_time,comment_count'
+COMMENT_PAGE_LIMIT = 100 # comments per request. Graph allows more, but then it starts complaining about the data size
+
+class JanusFBCommentCrawler:
+    'Fetch complete comment and reply trees for posts, following the paging cursors, a few posts at a time'
+
+    def __init__(self, graph, concurrency=4, limit=COMMENT_PAGE_LIMIT):
+        self.graph = graph # facebook.GraphAPI
+        self.concurrency = concurrency
+        self.limit = limit
+
+    def edge(self, objid):
+        'Get every comment directly on `objid` (a post or a comment), following the `after` cursor. Returns a list'
+        params = {'fields': COMMENT_FIELDS,
+                  'limit': self.limit,
+                  'filter': 'toplevel',
+                  'order': 'chronological',
+                  }
+        comments = []
+        while True:
+            with metrics.timer('janus_http_request_seconds', service='graph', endpoint='comments'):
+                page = self.graph.request('{}/comments'.format(objid), params)
+            comments.extend(page.get('data', []))
+            paging = page.get('paging', {})
+            if 'next' not in paging or 'after' not in paging.get('cursors', {}):
+                return comments
+            params = dict(params, after=paging['cursors']['after'])
+
+    def thread(self, postid):
+        '''Get the complete comment tree of `postid`.
+
+        Returned in the shape of the Graph `comments` edge, with replies nested the same way:
+        {'data': [{..., 'comments': {'data': [...]}}], 'summary': {'total_count': <comments and replies>}}'''
+        top = self.edge(postid)
+        total = len(top)
+        stack = [c for c in top if c.get('comment_count')]
+        while stack: # walk the tree without recursion, threads can be deep
+            com = stack.pop()
+            replies = self.edge(com['id'])
+            com['comments'] = {'data': replies}
+            total += len(replies)
+            stack.extend(r for r in replies if r.get('comment_count'))
+        logger.debug('Got %i comments for post %s', total, postid)
+        return {'data': top, 'summary': {'total_count': total}}
+
+    def _thread_or_none(self, postid):
+        try:
+            return self.thread(postid)
+        except Exception as e: # keep going, the post still has whatever came inline
+            logger.warning('Could not get comments for post %s: %r', postid, e)
+            metrics.inc('janus_comment_thread_errors_total', error=e.__class__.__name__)
+            return None
+
+    def crawl(self, postids):
+        '''Yield (postid, tree) for each of `postids`, in the same order, fetching up to
+        `concurrency` posts in parallel. `tree` is None if the thread could not be fetched'''
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            pending = collections.deque()
+            for postid in postids:
+                pending.append( (postid, pool.submit(self._thread_or_none, postid)) )
+                if len(pending) >= 2 * self.concurrency: # keep the pool busy, but dont run away
+                    pid, future = pending.popleft()
+                    yield pid, future.result()
+            while pending:
+                pid, future = pending.popleft()
+                yield pid, future.result()
+
+class JanusFacebookComment(JanusPost):
+    'A comment or reply on a Facebook post, as a flat record'
+
+    kind = 'comment'
+
+    def __init__(self, comment, postid, parentid):
+        self.post = comment # the raw Graph comment, without its replies
+        self.post_id = postid
+        self.parent_id = parentid # the post id for top level comments, else the id of the comment replied to
+
+    @property
+    def id(self):
+        return self.post.get('id', '') # inline replies in old caches came without ids
+
+    @property
+    def datetime_created(self):
+        '''Return datetetime.datetime representing the comment's `created_time` field'''
+        return dateutil.parser.parse(self.post['created_time'])
+
+    @property
+    def date_created(self):
+        '''Return datetetime.date representing the comment's `created_time` field'''
+        return self.datetime_created.date()
+
+    @property
+    def like_count(self):
+        return self.post.get('like_count', 0)
+
+    @property
+    def reply_count(self):
+        return self.post.get('comment_count', 0)
+
+    @property
+    def message(self):
+        return self.post.get('message', '')
+
+    @property
+    def name(self):
+        try:
+            return self.post['from']['name']
+        except KeyError:
+            return 'Unknown'
+
+    def record(self):
+        'Return a flat dict, ready for a sink'
+        return collections.OrderedDict([
+            ('id', self.id),
+            ('post_id', self.post_id),
+            ('parent_id', self.parent_id),
+            ('name', self.name),
+            ('like_count', self.like_count),
+            ('created_time', self.post.get('created_time', '')),
+            ('message', self.message),
+        ])
+
+def walk_comments(postid, comments):
+    'Yield a JanusFacebookComment for every comment and reply in a Graph comment tree, depth first, in order'
+    stack = [ (c, postid) for c in reversed(comments) ]
+    while stack:
+        com, parentid = stack.pop()
+        replies = com.get('comments', {}).get('data', [])
+        yield JanusFacebookComment({k:v for k, v in com.items() if k != 'comments'}, postid, parentid)
+        stack.extend( (r, com.get('id', '')) for r in reversed(replies) )
+
+class JanusFBComments(JanusSource):
+    'Every comment and reply on the posts from another source, one record each'
+
+    def __init__(self, postsource, output):
+        super().__init__(output)
+        self.source = postsource
+        self.id = postsource.id
+
+    def __str__(self):
+        'return pretty name'
+        return '<<<Comments({})'.format(self.source)
+
+    def set_since(self, dtobj):
+        self.source.set_since(dtobj)
+
+    def set_until(self, dtobj):
+        self.source.set_until(dtobj)
+
+    def set_filter(self, flt):
+        self.source.set_filter(flt) # the filter is on posts, not comments
+
+    def set_verbose(self, verbose):
+        super().set_verbose(verbose)
+        self.source.set_verbose(verbose)
+
+    def __iter__(self):
+        for post in self.source:
+            yield from walk_comments(post.id, post.comments)
@@ -1,89 +1,372 @@
 
+import collections
 import colorlog
+import csv
+import hashlib
 import io
 import json
 import os.path
+from datetime import datetime, timezone
 
-from . import JanusSink
+try:
+    import pyarrow as pa # pip install pyarrow
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+from . import JanusSink, JanusPost, JanusException, report
+from . import fb
+from .metrics import metrics
 
 logger = colorlog.getLogger('Janus.januslib.filesinks')
 
+CSV_POST_COLUMNS = ['id', 'created_time', 'name', 'likes', 'message', 'link', 'media', 'comments', 'shares', 'permalink']
+CSV_COMMENT_COLUMNS = ['id', 'post_id', 'parent_id', 'name', 'like_count', 'created_time', 'message']
+CACHE_MANIFEST = '.manifest' # no .json suffix, or cache readers would take it for a post
+PARQUET_ROWGROUP = 10000 # rows per row group, per partition
+PARQUET_MAX_BUFFERED = 50000 # flush the biggest partition buffer when all of them together hold more rows than this
+PARQUET_MAX_OPEN = 64 # open partition files. The least recently written one is closed, and a new part started if needed
+PARQUET_PARTITIONS = ('page', 'month')
+
+def canonical_json(data):
+    'Serialize `data` the same way every time, so equal posts give equal bytes'
+    return json.dumps(data, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+def _write_atomic(path, data):
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with io.open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def csv_post_row(post):
+    '''Turn raw Graph post data (a dict, or a JanusFacebookPost) into a row of CSV_POST_COLUMNS.
+    Module level and picklable, so a JanusTransformStage can run it in another process'''
+    likes = fb._count(post.get('likes'))
+    shares = post['shares']['count'] if 'shares' in post else 0
+    comments = post['comments'].get('data', []) if 'comments' in post else []
+    # the summary counts replies too, when the full threads were fetched
+    comments_count = fb._count(post.get('comments'))
+    message = post['message'] if 'message' in post else ''
+    link = post['link'] if 'link' in post else ''
+    permalink = post['permalink_url'] if 'permalink_url' in post else ''
+    try:
+        name = post['from']['name']
+    except KeyError:
+        try:
+            name = post['data']['name']
+        except KeyError:
+            name = 'Unknown'
+    try:
+        if post['type'] == 'video':
+            media = post['source']
+        elif post['type'] == 'photo':
+            media = post['picture']
+        else:
+            media = ''
+    except KeyError:
+        media = ''
+
+    fields = [
+         post['id'],
+         post['created_time'],
+         name,
+         likes,
+         message.replace('\n', ' '),
+         link,
+         media,
+         comments_count,
+         shares,
+         permalink,
+    ]
+    return fields
+
 class JanusFileSink(JanusSink):
-    
+    '''Store each post as canonical JSON in `cachepath`, writing only what changed.
+
+    A manifest of content hashes is kept in <cachepath>/.manifest, so unchanged posts cost
+    no disk writes. Files are written to a temp file and renamed, so readers never see half a post'''
+
     def __init__(self, cachepath, output):
         super().__init__(output)
         self.cachepath = cachepath
+        self.manifest_path = os.path.join(cachepath, CACHE_MANIFEST)
+        self.manifest = self._load_manifest() # path relative to cachepath -> sha1 of the canonical json
+        self.counts = collections.Counter() # new, changed, unchanged
+        self._dirty = False # manifest changed since it was last written
 
     def __str__(self):
         'return pretty name'
-        return '>>>File({})'.format(self.id, self.cachepath)
+        return '>>>File({})'.format(self.cachepath)
+
+    def _load_manifest(self):
+        try:
+            with io.open(self.manifest_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            logger.warning('Ignoring broken cache manifest %s', self.manifest_path)
+            return {}
+
+    def _hash_existing(self, path):
+        'Hash a file written before we had a manifest, or None if there is none'
+        try:
+            with io.open(path, 'rb') as f:
+                return hashlib.sha1(canonical_json(json.loads(f.read().decode('utf-8')))).hexdigest()
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            return None # broken, rewrite it
+
+    def _write(self, relpath, data):
+        body = canonical_json(data)
+        digest = hashlib.sha1(body).hexdigest()
+        path = os.path.join(self.cachepath, relpath)
+        old = self.manifest.get(relpath)
+        if old is None:
+            old = self._hash_existing(path)
+        if old == digest and os.path.exists(path): # the manifest can outlive a deleted file
+            self.counts['unchanged'] += 1
+            if self.manifest.get(relpath) != digest:
+                self.manifest[relpath] = digest
+                self._dirty = True
+            metrics.inc('janus_cache_writes_total', result='unchanged')
+            return
+        result = 'new' if old is None else 'changed'
+        dirn = os.path.dirname(path)
+        if not os.path.exists(dirn):
+            os.makedirs(dirn)
+        _write_atomic(path, body)
+        self.manifest[relpath] = digest
+        self._dirty = True
+        self.counts[result] += 1
+        metrics.inc('janus_cache_writes_total', result=result)
 
     def push(self, post):
-        if not os.path.exists(self.cachepath):
-            os.makedirs(self.cachepath)
-        with io.open('{}/{}.json'.format(self.cachepath, post['id']), 'wb') as f:
-            f.write(json.dumps(post).encode())
+        if getattr(post, 'kind', 'post') == 'comment': # comments get their own directory
+            self._write('comments/{}.json'.format(post.id), post.record())
+            return
+        data = post.post if isinstance(post, JanusPost) else post # the raw Graph dict
+        self._write('{}.json'.format(data['id']), data)
+
+    def flush(self):
+        'Write the manifest, if it changed. Webhook runs call this after every batch'
+        if self._dirty:
+            os.makedirs(self.cachepath, exist_ok=True)
+            _write_atomic(self.manifest_path, json.dumps(self.manifest, sort_keys=True).encode('utf-8'))
+            self._dirty = False
 
     def finished(self):
-        pass
+        self.flush()
+        report(self, 'Cache {}: {} new, {} changed, {} unchanged'.format(self.cachepath,
+                                                                        self.counts['new'],
+                                                                        self.counts['changed'],
+                                                                        self.counts['unchanged']))
+        self.counts.clear()
 
 class JanusCSVSink(JanusSink):
-    def __init__(self, filename, separator, output):
+    '''Posts to one CSV file, comments (if any) to another, next to it.
+    Each run starts the files over, unless `append` adds to what earlier runs wrote'''
+
+    def __init__(self, filename, separator, output, append=False):
         super().__init__(output)
         self.filename = filename
+        self.append = append
+        root, ext = os.path.splitext(filename)
+        self.comments_filename = '{}.comments{}'.format(root, ext or '.csv')
         self.separator = ',' if separator is None else separator
+        self._files = {} # kind -> (file object, csv.writer)
 
     def __str__(self):
         'return pretty name'
         return '>>>CSVFile({})'.format(self.id, self.filename)
 
-    def __format_post(self, post):
-        likes = len(post['likes']) if 'likes' in post else 0
-        shares = post['shares']['count'] if 'shares' in post else 0
-        comments = post['comments']['data'] if 'comments' in post else []
-        message = post['message'] if 'message' in post else ''
-        link = post['link'] if 'link' in post else ''
-        permalink = post['permalink_url'] if 'permalink_url' in post else ''
+    def _writer(self, kind):
+        'Get the csv writer for posts or comments, opening the file (and writing a header) on first use'
         try:
-            name = post['from']['name']
+            return self._files[kind][1]
         except KeyError:
-            try:
-                name = post['data']['name']
-            except KeyError:
-                name = 'Unknown'
+            pass
+        filename, header = (self.filename, CSV_POST_COLUMNS) if kind == 'post' else (self.comments_filename, CSV_COMMENT_COLUMNS)
+        dirn = os.path.dirname(filename)
+        if dirn and not os.path.exists(dirn):
+            os.makedirs(dirn)
+        new = not self.append or not os.path.exists(filename)
+        f = io.open(filename, 'a' if self.append else 'w', newline='', encoding='utf-8')
+        w = csv.writer(f, delimiter=self.separator)
+        if new:
+            w.writerow(header)
+        self._files[kind] = (f, w)
+        return w
+
+    def push(self, post):
+        if getattr(post, 'kind', 'post') == 'comment':
+            rec = post.record()
+            rec['message'] = rec['message'].replace('\n', ' ')
+            self._writer('comment').writerow(list(rec.values()))
+        else:
+            self.push_row(post, csv_post_row(post))
+
+    @property
+    def transform(self):
+        return (csv_post_row, ())
+
+    def push_row(self, post, row):
+        'Write a post already formatted by .transform'
+        self._writer('post').writerow(row)
+
+    def flush(self):
+        for f, _ in self._files.values():
+            f.flush()
+
+    def finished(self):
+        for f, _ in self._files.values():
+            f.close()
+        self._files = {}
+
+def _int(v):
+    'Fusion tables hand us numbers as strings, sometimes empty'
+    try:
+        return int(float(v)) if v not in (None, '') else 0
+    except (TypeError, ValueError):
+        return 0
+
+def _created(post):
+    'created_time as an aware datetime, without the cost of dateutil for the Graph format'
+    created = post.post.get('created_time') if hasattr(post, 'post') else None
+    if created is not None:
         try:
-            if post['type'] == 'video':
-                media = post['source']
-            elif post['type'] == 'photo':
-                media = post['picture']
-            else:
-                media = ''
+            return datetime.strptime(created, '%Y-%m-%dT%H:%M:%S%z')
+        except ValueError:
+            pass
+    dt = post.datetime_created
+    return dt if dt.tzinfo is not None else dt.replace(tzinfo=timezone.utc)
+
+def parquet_schema():
+    return pa.schema([('id', pa.string()),
+                      ('page_id', pa.dictionary(pa.int32(), pa.string())),
+                      ('created', pa.timestamp('s', tz='UTC')),
+                      ('author', pa.dictionary(pa.int32(), pa.string())),
+                      ('type', pa.dictionary(pa.int32(), pa.string())),
+                      ('likes', pa.int64()),
+                      ('shares', pa.int64()),
+                      ('comments', pa.int64()),
+                      ('message', pa.string()),
+                      ('link', pa.string()),
+                      ('permalink', pa.string()),
+                      ('media', pa.string()),
+                      ])
+
+class JanusParquetSink(JanusSink):
+    '''Write normalized post fields to a Parquet dataset under `path`, one row group per `rowgroup` posts.
+
+    With `partition` set to page, month or page,month, files go in hive style directories,
+    e.g. <path>/page_id=123/month=2017-01/part-<sink id>-0.parquet, which pyarrow, pandas and spark all read'''
+
+    def __init__(self, path, output, partition=None, rowgroup=PARQUET_ROWGROUP):
+        super().__init__(output)
+        if pa is None:
+            raise JanusException('The parquet sink needs pyarrow. pip install pyarrow')
+        self.path = path
+        self.partition = tuple(p for p in (partition or '').split(',') if p)
+        for p in self.partition:
+            if p not in PARQUET_PARTITIONS:
+                raise JanusException('Cannot partition by {!r}, use one or more of {}'.format(p, ', '.join(PARQUET_PARTITIONS)))
+        self.rowgroup = int(rowgroup)
+        self.schema = parquet_schema()
+        if 'page' in self.partition: # the directory name has it, and readers add it back as a column
+            self.schema = self.schema.remove(self.schema.get_field_index('page_id'))
+        self._buffers = {} # partition key -> list of row tuples
+        self._buffered = 0
+        self._writers = collections.OrderedDict() # partition key -> ParquetWriter, least recently written first
+        self._parts = collections.Counter() # partition key -> files started
+        self.rows = 0
+        self.files = 0
+        self.skipped = 0
+
+    def __str__(self):
+        'return pretty name'
+        return '>>>Parquet({})'.format(self._slugify(self.path))
+
+    @property
+    def queue_depth(self):
+        return self._buffered
+
+    def _key(self, page, created):
+        return tuple(page if p == 'page' else created.strftime('%Y-%m') for p in self.partition)
+
+    def _filename(self, key):
+        dirs = [ '{}={}'.format('page_id' if p == 'page' else p, k) for p, k in zip(self.partition, key) ]
+        return os.path.join(self.path, *dirs, 'part-{}-{}.parquet'.format(self.id, self._parts[key]))
+
+    def _writer(self, key):
+        try:
+            self._writers.move_to_end(key)
+            return self._writers[key]
         except KeyError:
-            media = ''
+            pass
+        if len(self._writers) >= PARQUET_MAX_OPEN:
+            _, old = self._writers.popitem(last=False)
+            old.close()
+        filename = self._filename(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self._parts[key] += 1
+        self.files += 1
+        w = self._writers[key] = pq.ParquetWriter(filename, self.schema, compression='snappy')
+        logger.debug('Started parquet file %s', filename)
+        return w
 
-        fields = [
-             post['id'],
-             post['created_time'],
-             name,
-             likes,
-             message.replace('\n', ' '),
-             link, 
-             media,
-             len(comments),
-             shares,
-             permalink,
-        ]
-        return self.separator.join(fields)
+    def _flush(self, key):
+        'Write the buffered rows of one partition as a row group'
+        rows = self._buffers.pop(key, None)
+        if not rows:
+            return
+        columns = list(zip(*rows))
+        if 'page' in self.partition:
+            del columns[1]
+        arrays = [ pa.array(col, type=field.type.value_type).dictionary_encode() if pa.types.is_dictionary(field.type)
+                   else pa.array(col, type=field.type)
+                   for field, col in zip(self.schema, columns) ]
+        with metrics.timer('janus_parquet_write_seconds'):
+            self._writer(key).write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+        self._buffered -= len(rows)
+        self.rows += len(rows)
 
     def push(self, post):
-        dirn = os.path.dirname(self.filename)
-        if not os.path.exists(dirn):
-            os.makedirs(dirn)
-        if not os.path.exists(self.filename):
-            pass
-        with io.open(self.filename, 'wb+') as f:
-            f.write(self.__format_post(post))
+        if post.kind != 'post':
+            self.skipped += 1 # parquet gets posts only
+            return
+        page = post.id.split('_')[0] if '_' in post.id else 'unknown'
+        created = _created(post)
+        raw = getattr(post, 'post', {})
+        row = (post.id,
+               page,
+               created,
+               post.name,
+               raw.get('type', ''),
+               _int(post.like_count),
+               _int(post.share_count),
+               _int(post.comment_count),
+               post.message,
+               post.link,
+               post.permalink,
+               post.media,
+               )
+        key = self._key(page, created)
+        buf = self._buffers.setdefault(key, [])
+        buf.append(row)
+        self._buffered += 1
+        if len(buf) >= self.rowgroup:
+            self._flush(key)
+        elif self._buffered > PARQUET_MAX_BUFFERED:
+            self._flush(max(self._buffers, key=lambda k: len(self._buffers[k])))
 
     def finished(self):
-        pass
-    
+        for key in list(self._buffers):
+            self._flush(key)
+        for w in self._writers.values():
+            w.close()
+        self._writers.clear()
+        report(self, 'Wrote {} posts in {} parquet files under {}'.format(self.rows, self.files, self.path))
+        if self.skipped:
+            logger.debug('%s skipped %i comment records', self, self.skipped)
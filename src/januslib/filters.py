@@ -0,0 +1,292 @@
+import colorlog
+import re
+from datetime import datetime, timedelta
+
+from . import JanusException
+
+logger = colorlog.getLogger('Janus.januslib.filters')
+
+# filter field -> (JanusPost property, type, Fusion table column)
+FILTER_FIELDS = {
+    'created': ('datetime_created', 'date', 'Dato'),
+    'likes': ('like_count', 'number', 'Likes'),
+    'shares': ('share_count', 'number', 'Delinger'),
+    'comments': ('comment_count', 'number', 'AntallKommentarer'),
+    'author': ('name', 'text', 'Avsender'),
+    'message': ('message', 'text', 'Melding'),
+    'id': ('id', 'text', 'ID'),
+}
+DATE_FORMATS = ('%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M')
+FUSION_DATE_FORMAT = '%Y.%m.%d' # how JanusFusiontablesSource has always compared 'Dato'
+_FUSION_OPS = ('=', '>', '>=', '<', '<=') # Fusion has no OR, and no != we can trust with empty cells
+
+TOKEN = re.compile(r'''\s*(?:(?P<op>>=|<=|!=|=|>|<|\(|\))|(?P<str>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')|(?P<word>[^\s()<>=!"']+))''')
+KEYWORDS = ('and', 'or', 'not', 'contains', 'between')
+_COMPARISONS = ('=', '!=', '<', '<=', '>', '>=')
+
+def _tokenize(text):
+    tokens, pos = [], 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = TOKEN.match(text, pos)
+        if m is None or m.end() == pos:
+            raise JanusException('Cannot read filter at {!r}'.format(text[pos:pos+20]))
+        pos = m.end()
+        if m.group('op'):
+            tokens.append( ('op', m.group('op')) )
+        elif m.group('str'):
+            tokens.append( ('str', re.sub(r'\\(.)', r'\1', m.group('str')[1:-1])) )
+        elif m.group('word').lower() in KEYWORDS:
+            tokens.append( ('kw', m.group('word').lower()) )
+        else:
+            tokens.append( ('word', m.group('word')) )
+    return tokens
+
+def parse_date(value):
+    'Return (datetime, whether only a date was given) for a filter value'
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt), fmt == DATE_FORMATS[0]
+        except ValueError:
+            pass
+    raise JanusException('{!r} is not a YYYY-MM-DD [HH:MM:SS] timestamp'.format(value))
+
+def _epoch(dt):
+    'Seconds since epoch. Naive datetimes are local time, like set_since and set_until'
+    return dt.timestamp()
+
+def _num(value):
+    'Fusion tables hand us numbers as strings, sometimes empty'
+    if isinstance(value, (int, float)):
+        return value
+    return float(value) if value not in (None, '') else 0
+
+class _Parser:
+    '''Recursive descent over the tokens. Produces a tree of tuples:
+    ('and', [nodes]), ('or', [nodes]), ('not', node), ('cmp', field, op, value) and ('truthy', field)'''
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def take(self, kind=None, value=None):
+        tok = self.peek()
+        if tok[0] is None or (kind is not None and tok[0] != kind) or (value is not None and tok[1] != value):
+            raise JanusException('Expected {} in filter, got {}'.format(value or kind, tok[1] or 'the end'))
+        self.pos += 1
+        return tok
+
+    def parse(self):
+        node = self.expr()
+        if self.pos < len(self.tokens):
+            raise JanusException('Unexpected {!r} in filter'.format(self.peek()[1]))
+        return node
+
+    def expr(self):
+        nodes = [self.conjunction()]
+        while self.peek() == ('kw', 'or'):
+            self.take()
+            nodes.append(self.conjunction())
+        return nodes[0] if len(nodes) == 1 else ('or', nodes)
+
+    def conjunction(self):
+        nodes = [self.negation()]
+        while self.peek() == ('kw', 'and'):
+            self.take()
+            nodes.append(self.negation())
+        return nodes[0] if len(nodes) == 1 else ('and', nodes)
+
+    def negation(self):
+        if self.peek() == ('kw', 'not'):
+            self.take()
+            return ('not', self.negation())
+        return self.atom()
+
+    def atom(self):
+        if self.peek() == ('op', '('):
+            self.take()
+            node = self.expr()
+            self.take('op', ')')
+            return node
+        _, field = self.take('word')
+        if not re.match(r'^[a-zA-Z]\w*$', field):
+            raise JanusException('{!r} is not a post field'.format(field))
+        kind, op = self.peek()
+        if kind == 'op' and op in _COMPARISONS:
+            self.take()
+            return ('cmp', field, op, self.value())
+        elif (kind, op) == ('kw', 'contains'):
+            self.take()
+            return ('cmp', field, 'contains', self.value())
+        elif (kind, op) == ('kw', 'between'): # inclusive at both ends
+            self.take()
+            low = self.value()
+            self.take('kw', 'and')
+            return ('and', [('cmp', field, '>=', low), ('cmp', field, '<=', self.value())])
+        return ('truthy', field) # a bare field, like `is_video`
+
+    def value(self):
+        kind, value = self.peek()
+        if kind not in ('word', 'str'):
+            raise JanusException('Expected a value in filter, got {}'.format(value or 'the end'))
+        self.pos += 1
+        return value
+
+class JanusFilter:
+    '''A filter over post fields, compiled once to a Python predicate. Call it with a post.
+
+        likes > 100 and created between 2017-01-01 and 2017-01-31
+        author = "NRK P3" or (message contains valg and not shares < 10)
+
+    Known fields are in FILTER_FIELDS; any other name is read as a post attribute.
+    Comparing `created` with a date alone covers the whole day: `created <= 2017-01-31` includes the 31st.
+    `contains` ignores case. Sources push what they can of the top level `and` to the server,
+    see .fusion_pushdown() and .graph_range()'''
+
+    def __init__(self, text):
+        self.text = text.strip()
+        self.tree = _Parser(_tokenize(self.text)).parse()
+        self.predicate = self._compile(self.tree)
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return '<JanusFilter {!r}>'.format(self.text)
+
+    def __call__(self, post):
+        return self.predicate(post)
+
+    def _compile(self, node):
+        'Turn a tree into a lambda. Values go in the namespace, never into the source'
+        ns = {'_num': _num, '_epoch': _epoch}
+        src = 'lambda post: {}'.format(self._source(node, ns))
+        logger.debug('Compiled filter %r to %s', self.text, src)
+        code = eval(compile(src, '<filter>', 'eval'), ns)
+        def predicate(post):
+            try:
+                return bool(code(post))
+            except (AttributeError, KeyError, TypeError, ValueError): # field missing on this kind of post
+                return False
+        return predicate
+
+    def _const(self, ns, value):
+        name = 'c{}'.format(len(ns))
+        ns[name] = value
+        return name
+
+    def _source(self, node, ns):
+        if node[0] in ('and', 'or'):
+            return '({})'.format(' {} '.format(node[0]).join(self._source(n, ns) for n in node[1]))
+        elif node[0] == 'not':
+            return '(not {})'.format(self._source(node[1], ns))
+        elif node[0] == 'truthy':
+            prop = FILTER_FIELDS.get(node[1], (node[1],))[0]
+            return '(post.{} == True)'.format(prop)
+        _, field, op, value = node
+        prop, kind, _ = FILTER_FIELDS.get(field, (field, None, None))
+        if kind is None: # not a known field, go by the value
+            try:
+                value, kind = float(value), 'number'
+            except ValueError:
+                kind = 'text'
+        if op == 'contains':
+            return '({} in str(post.{}).lower())'.format(self._const(ns, str(value).lower()), prop)
+        pyop = '==' if op == '=' else op
+        if kind == 'number':
+            try:
+                return '(_num(post.{}) {} {})'.format(prop, pyop, self._const(ns, _num(value)))
+            except ValueError:
+                raise JanusException('{} needs a number, not {!r}'.format(field, value))
+        elif kind == 'date':
+            start, whole_day = parse_date(value)
+            lhs = '_epoch(post.{})'.format(prop)
+            if not whole_day:
+                return '({} {} {})'.format(lhs, pyop, self._const(ns, _epoch(start)))
+            low, high = self._const(ns, _epoch(start)), self._const(ns, _epoch(start + timedelta(days=1)))
+            return {'=': '({low} <= {lhs} < {high})', '!=': '(not {low} <= {lhs} < {high})',
+                    '<': '({lhs} < {low})', '>=': '({lhs} >= {low})',
+                    '<=': '({lhs} < {high})', '>': '({lhs} >= {high})'}[op].format(lhs=lhs, low=low, high=high)
+        return '(str(post.{}) {} {})'.format(prop, pyop, self._const(ns, str(value)))
+
+    def conjuncts(self):
+        'The conditions that all must hold: the terms of a top level `and`, or the whole filter'
+        nodes, stack = [], [self.tree]
+        while stack: # flatten nested ands, like the one `between` makes
+            node = stack.pop(0)
+            if node[0] == 'and':
+                stack[:0] = node[1]
+            else:
+                nodes.append(node)
+        return nodes
+
+    def _range(self, node):
+        'Return (earliest, latest) datetimes a `created` condition allows, either may be None'
+        _, field, op, value = node
+        start, whole_day = parse_date(value)
+        end = start + timedelta(days=1) if whole_day else start
+        if op in ('>', '>='):
+            return (end if op == '>' else start), None
+        elif op in ('<', '<='):
+            return None, (start if op == '<' else end)
+        elif op == '=':
+            return start, end
+        return None, None
+
+    def graph_range(self):
+        '''Return (since, until) as epoch seconds for the Graph feed, from the `created` conditions
+        that must hold, either may be None. Graph is loose at the edges, so they are also checked locally'''
+        since = until = None
+        for node in self.conjuncts():
+            if node[0] != 'cmp' or node[1] != 'created':
+                continue
+            low, high = self._range(node)
+            if low is not None:
+                since = max(since or 0, int(_epoch(low)))
+            if high is not None:
+                high = int(_epoch(high)) + 1
+                until = high if until is None else min(until, high)
+        return since, until
+
+    def fusion_pushdown(self):
+        '''Split the filter in a Fusion WHERE and what is left for us.
+        Returns (list of conditions, predicate or None). Fusion only does `and`, so only top level
+        comparisons on known fields go. `created` goes as whole days, and is also checked locally'''
+        where, local = [], []
+        for node in self.conjuncts():
+            if node[0] != 'cmp' or node[1] not in FILTER_FIELDS or node[2] not in _FUSION_OPS + ('contains',):
+                local.append(node)
+                continue
+            _, field, op, value = node
+            _, kind, column = FILTER_FIELDS[field]
+            if kind == 'date':
+                low, high = self._range(node)
+                if low is not None:
+                    where.append(""" '{}' >= '{}' """.format(column, low.strftime(FUSION_DATE_FORMAT)))
+                if high is not None: # the day after, in case 'Dato' has times
+                    where.append(""" '{}' <= '{}' """.format(column, (high + timedelta(days=1)).strftime(FUSION_DATE_FORMAT)))
+                local.append(node)
+            elif kind == 'number':
+                try:
+                    number = float(value)
+                    where.append(""" '{}' {} {} """.format(column, op, int(number) if number.is_integer() else number))
+                except ValueError:
+                    raise JanusException('{} needs a number, not {!r}'.format(field, value))
+            else:
+                quoted = "'{}'".format(str(value).replace("'", "\\'"))
+                if op == 'contains':
+                    where.append(""" '{}' CONTAINS IGNORING CASE {} """.format(column, quoted))
+                else:
+                    where.append(""" '{}' {} {} """.format(column, op, quoted))
+        if not local:
+            return where, None
+        return where, self._compile(local[0] if len(local) == 1 else ('and', local))
+
+def compile_filter(text):
+    'Parse and compile a filter expression, see JanusFilter. Returns None for an empty one'
+    if text is None or not text.strip():
+        return None
+    return JanusFilter(text)
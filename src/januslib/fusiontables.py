@@ -2,10 +2,16 @@ import logging
 import colorlog
 import collections
 import datetime
+import os
+import threading
 import time
-import fusionclient
-from . import JanusSink, JanusSource, JanusPost, JanusException
+from . import JanusSink, JanusSource, JanusPost, JanusException, report
 from . import fb
+from .metrics import metrics, sinklabel
+from .logutil import abbrev
+from .render import render_comments
+from .outbox import JanusOutbox
+from .refresh import JanusRefreshScheduler, REFRESH_BUDGET, REFRESH_STATE
 import dateutil.parser
 import html
 from clint.textui import colored, puts, indent
@@ -13,6 +19,10 @@ from clint.textui import colored, puts, indent
 logger = colorlog.getLogger('Janus.januslib.fusiontables')
 
 FUSION_INSERT_QUEUE_MAX=25
+FUSION_COMMENTS_MAX_BYTES=32*1024 # per cell. Keeps a batch of FUSION_INSERT_QUEUE_MAX rows well below the request size limit
+FUSION_OUTBOX=os.path.join('data', 'fusion-outbox.jsonl') # every INSERT and UPDATE goes here before it is sent
+FUSION_DRAIN_TIMEOUT=300 # seconds a sink waits for the outbox in finished(). What is left can be sent with `replay_outbox`
+FUSION_RETRY_STATUS=(429, 500, 502, 503, 504) # and 403 when it says rate limit
 
 class JanusFusiontablesException(JanusException):
     pass
@@ -26,6 +36,7 @@ __all__ = ['JanusFusiontablesSink',
            'JanusFusiontablesSource', 
            'JanusFusiontablePost',
            'get_fusiontables',
+           'fusion_outbox',
            ]
 
 def fusionify_timestamp(datestring):
@@ -33,38 +44,108 @@ def fusionify_timestamp(datestring):
     yourdate = dateutil.parser.parse(datestring)
     return yourdate.strftime('%Y-%m-%d %H:%M:%S')
 
-def comments_html(comments):
-    'Turn a json list of comments into an html string'
-    s = ['<ul>', ]
-    for com in comments:
-        s.append('<li><b>{}</b> (+{}): {}'.format(html.escape(com['from']['name']), 
-                                                    com['like_count'], 
-                                                    html.escape(com['message'])
-                                                    )
-                )
-        if 'comments' in com:
-            #recurse into nested comment
-            s.append(comments_html(com['comments']['data']))
-        s.append('</li>')
-    s.append('</ul>')
-    return ''.join(s)
-
-def get_fusiontables():
-    'Get a list of all fusion tables'
-    fus = fusionclient.Fusion()
+def comments_html(comments, max_bytes=FUSION_COMMENTS_MAX_BYTES):
+    'Turn a json list of comments into an html string, of at most `max_bytes`'
+    return render_comments(comments, 'html', max_bytes)
+
+def format_post_row(post, with_comments=True):
+    '''Turn raw Graph post data (a dict, or a JanusFacebookPost) into a Fusion table row.
+    Module level and picklable, so a JanusTransformStage can run it in another process'''
+    # beat structure out of post data, which will vary from post to post
+    likes = fb._count(post.get('likes'))
+    shares = post['shares']['count'] if 'shares' in post else 0
+    comments = post['comments'].get('data', []) if 'comments' in post else []
+    comments_count = fb._count(post.get('comments'))
+    message = post['message'] if 'message' in post else ''
+    link = post['link'] if 'link' in post else ''
+    permalink = post['permalink_url'] if 'permalink_url' in post else ''
+    try:
+        name = post['from']['name']
+    except KeyError:
+        try:
+            name = post['data']['name']
+        except KeyError:
+            name = 'Unknown'
     try:
-        return [JanusFusiontable(t) for t in fus.run(fus.service.table().list())['items']]
+        if post['type'] == 'video':
+            media = post['source']
+        elif post['type'] == 'photo':
+            media = post['picture']
+        else:
+            media = ''
     except KeyError:
-        return []
+        media = ''
+
+    kwargs = collections.OrderedDict({
+        'ID': post['id'],
+        'Dato': fusionify_timestamp(post['created_time']),
+        'Avsender': html.escape(name),
+        'Likes': likes,
+        'Melding': html.escape(message.replace('\n', ' ')),
+        'Link': link, 
+        'Media': media,
+        'AntallKommentarer': comments_count,
+        'Kommentarer': comments_html(comments) if with_comments else '',
+        'Delinger': shares,
+        'Permalink': permalink,
+    })
+    return kwargs
+
+def fusion_client():
+    'Get the shared, authorized Fusion client. fusionclient (and the google api stack) is imported on first use'
+    import fusionclient
+    return fusionclient.get_client()
+
+def _cooldown(status, content):
+    'Is this error response one that goes away if we wait a bit?'
+    return status in FUSION_RETRY_STATUS or (status == 403 and 'ratelimit' in repr(content).lower())
+
+def _send_sql(payload):
+    'Send one outbox payload with the shared client. Raises JanusFusiontablesCoolDownException for errors worth retrying'
+    try:
+        status, content = fusion_client().sql(payload['sql'])
+    except Exception as e:
+        if isinstance(e, OSError) or type(e).__module__.startswith('httplib2'): # network trouble
+            raise JanusFusiontablesCoolDownException(str(e)) from e
+        raise
+    if _cooldown(status, content):
+        raise JanusFusiontablesCoolDownException('{}: {!r}'.format(status, abbrev(content)))
+    if status > 201:
+        raise JanusFusiontablesException('{}: {!r}'.format(status, abbrev(content)))
+    if isinstance(content, dict) and content.get('kind') == 'fusiontables#sqlresponse':
+        logger.debug('%s: %i rows written', payload.get('sink'), len(content.get('rows', [])))
+    return content
+
+_outboxes = {}
+_outboxes_lock = threading.Lock()
+
+def fusion_outbox(path=FUSION_OUTBOX):
+    'Get the process wide outbox for Fusion writes at `path`'
+    with _outboxes_lock:
+        try:
+            return _outboxes[path]
+        except KeyError:
+            box = _outboxes[path] = JanusOutbox(path, _send_sql, retry_on=(JanusFusiontablesCoolDownException,))
+            return box
+
+def get_fusiontables():
+    'Get a list of all fusion tables. The list is cached for a while, see fusionclient.METADATA_MAX_AGE'
+    return [JanusFusiontable(t) for t in fusion_client().tables()]
 
 class JanusFusiontablesSink(JanusSink):
 
     # https://developers.google.com/fusiontables/docs/v2/reference/
-    def __init__(self, table, output):
+    def __init__(self, table, output, comments_table=None, comments_html=True):
         super().__init__(output)
-        self.table = table
-        self.fusion = fusionclient.Fusion()
+        self.table = table # a JanusFusiontable or a table id
+        self.tableid = getattr(table, 'tableid', table)
+        # comment records go to their own table, or to the main table if this sink only gets comments
+        self.comments_tableid = getattr(comments_table, 'tableid', comments_table) or self.tableid
+        self.comments_html = comments_html # put the whole comment thread in the `Kommentarer` column of each post
+        self.fusion = fusion_client()
+        self.outbox = fusion_outbox()
         self._q = []
+        self._cq = [] # comment rows
         #self.metadata = self.fusion.run(self.fusion.service.table().get(tableId=tableid))
 
     def __str__(self):
@@ -75,115 +156,159 @@ class JanusFusiontablesSink(JanusSink):
     def autenticate(self):
         raise NotImplementedError # TODO: FIX
 
-    def __format_post(self, post):
-        # beat structure out of post data, which will vary from post to post
-        likes = post['likes']['summary']['total_count'] if 'likes' in post else 0
-        shares = post['shares']['count'] if 'shares' in post else 0
-        comments = post['comments']['data'] if 'comments' in post else []
-        comments_count = post['comments']['summary']['total_count'] if 'comments' in post else 0
-        message = post['message'] if 'message' in post else ''
-        link = post['link'] if 'link' in post else ''
-        permalink = post['permalink_url'] if 'permalink_url' in post else ''
-        try:
-            name = post['from']['name']
-        except KeyError:
-            try:
-                name = post['data']['name']
-            except KeyError:
-                name = 'Unknown'
-        try:
-            if post['type'] == 'video':
-                media = post['source']
-            elif post['type'] == 'photo':
-                media = post['picture']
-            else:
-                media = ''
-        except KeyError:
-            media = ''
-
-        kwargs = collections.OrderedDict({
-            'ID': post['id'],
-            'Dato': fusionify_timestamp(post['created_time']),
-            'Avsender': html.escape(name),
-            'Likes': likes,
-            'Melding': html.escape(message.replace('\n', ' ')),
-            'Link': link, 
-            'Media': media,
-            'AntallKommentarer': comments_count,
-            'Kommentarer': comments_html(comments),
-            'Delinger': shares,
-            'Permalink': permalink,
-        })
-        return kwargs
+    @property
+    def queue_depth(self):
+        return len(self._q) + len(self._cq) + len(self.outbox.pending)
+
+    def __format_comment(self, comment):
+        return collections.OrderedDict([
+            ('ID', comment.id),
+            ('PostID', comment.post_id),
+            ('ParentID', comment.parent_id),
+            ('Dato', fusionify_timestamp(comment.post['created_time'])),
+            ('Avsender', html.escape(comment.name)),
+            ('Likes', comment.like_count),
+            ('Melding', html.escape(comment.message.replace('\n', ' '))),
+        ])
 
     def push(self, post):
         'Take a post and prepare it for upload'
-        squeezed_post = self.__format_post(post)
-        self._q.append(squeezed_post)
+        if post.kind == 'comment':
+            self._cq.append(self.__format_comment(post))
+            if len(self._cq) == FUSION_INSERT_QUEUE_MAX:
+                self.insert_sql(self._cq, self.comments_tableid)
+                self._cq = []
+            return
+        with metrics.timer('janus_format_seconds', sink=sinklabel(self)):
+            row = format_post_row(post, self.comments_html)
+        self.push_row(post, row)
+
+    @property
+    def transform(self):
+        return (format_post_row, (self.comments_html,))
+
+    def push_row(self, post, row):
+        'Queue a post already formatted by .transform'
+        self._q.append(row)
         if len(self._q) == FUSION_INSERT_QUEUE_MAX:
             self.insert_sql(self._q)
             self._q = []
 
+    def flush(self):
+        'Send the queued rows to the outbox now, instead of waiting for a full batch'
+        if len(self._q) > 0:
+            self.insert_sql(self._q)
+            self._q = []
+        if len(self._cq) > 0:
+            self.insert_sql(self._cq, self.comments_tableid)
+            self._cq = []
+
     def finished(self):
-        'Finish off queue'
+        'Finish off queue, and wait for the outbox to deliver it'
         if len(self._q) > 0:
             self.insert_sql(self._q)
-        
-    def insert_sql(self, rowdata):
-        self.run(self.fusion.insertrows, self.table.tableid, rowdata)
-
-    def run(self, function, *args):
-        http_code, status = function(*args)
-        if http_code > 201:
-            puts(colored.red(repr(status)))
-            puts('Error detected! Cooling down for a bit might work', self.output)
-            time.sleep(2.0)
-        else:
-            if 'kind' in status and status['kind'] == 'fusiontables#sqlresponse':
-                luck = '{} rows added: {}.'.format(len(status['rows']), status['rows'])
-            else: # dont know what the format is
-                luck = repr(status)
-            puts(colored.green(luck), self.output)
+            self._q = []
+        if len(self._cq) > 0:
+            self.insert_sql(self._cq, self.comments_tableid)
+            self._cq = []
+        left = self.outbox.drain(FUSION_DRAIN_TIMEOUT)
+        if left:
+            report(self, colored.red('{} writes still waiting in {}. Use `replay_outbox` to send them'.format(left, self.outbox.path)))
+        if self.outbox.failed:
+            report(self, colored.red('{} writes failed for good, see the log. Use `replay_outbox yes` to try them again'.format(len(self.outbox.failed))))
+
+    def queue_sql(self, sql, rows=1):
+        'Put a write in the outbox. It is on disk when this returns, and sent in the background'
+        self.outbox.put({'sql': sql, 'rows': rows, 'sink': str(self)})
+
+    def insert_sql(self, rowdata, tableid=None):
+        self.queue_sql(self.fusion.insert_statement(tableid or self.tableid, rowdata), len(rowdata))
 
 class JanusFusiontablesFacebookUpdateSink(JanusFusiontablesSink):
-    'Update an existing fusion table with Facebook posts for each row'
+    '''Update an existing fusion table with Facebook posts for each row.
 
-    def __init__(self, table, columns, output):
+    Rows are only collected as they are pushed. When the source is done, a JanusRefreshScheduler picks
+    the `budget` posts whose counters most likely moved, and only those are fetched from Graph'''
+
+    transform = None # pushes UPDATEs, not formatted rows
+    # <fbpost.attribute> => <fusiontable column name>
+    _map = { 'share_count': 'Delinger', #TODO: Get rid of this
+             'comment_count': 'AntallKommentarer',
+             'like_count': 'Likes',
+             'permalink': 'Permalink',
+             'date_created': 'Dato2',
+             }
+
+    def __init__(self, table, columns, output, budget=REFRESH_BUDGET, statepath=REFRESH_STATE):
         super().__init__(table, output)
         if columns is None:
             self.updateCols = ['share_count', 'comment_count', 'like_count', 'permalink'] # which columns to update (JanusFacebookPost.<col>)
+        elif isinstance(columns, str):
+            self.updateCols = [ x.strip() for x in columns.split(',') ]
         else:
             self.updateCols = columns
+        unknown = set(self.updateCols) - set(self._map)
+        if unknown:
+            raise JanusException('Cannot update {}, use some of {}'.format(', '.join(sorted(unknown)), ', '.join(sorted(self._map))))
+        self.budget = budget # Graph calls per run, None for every row
+        self.scheduler = JanusRefreshScheduler(statepath)
+        self._rows = [] # (post id, created epoch, post)
 
     def __str__(self):
         'return pretty name'
         n = str(self.table)
         return '>>>FusiontablesFacebookUpdate({})'.format(self._slugify(n))
 
+    @property
+    def queue_depth(self):
+        return len(self._rows) + super().queue_depth
+
     def push(self, post):
-        'Take a fusiontable post and SQL UPDATE the existing table with data from live facebook'
+        'Take a fusiontable post, to be considered for a refresh when the source is done'
         try:
-            fresh_fb = fb.getPost(post.id)
-        except JanusException as e:
-            logger.exception(e)
-            puts(colored.red(repr(e)))
-            return
-        # <fbpost.attribute> => <fusiontable column name>
-        _map = { 'share_count': 'Delinger', #TODO: Get rid of this
-                 'comment_count': 'AntallKommentarer',
-                 'like_count': 'Likes',
-                 'permalink': 'Permalink',
-                 'date_created': 'Dato2',
-                 }
-        cols = [ " '{}'='{}' ".format(_map[col],getattr(fresh_fb, col)) for col in self.updateCols ]
-        q = "UPDATE {} SET {} WHERE ROWID='{}'".format(self.table.tableid, ','.join(cols), post.rowid)
-        logger.debug('about to UPDATE SQL rowid=%r: %r', post.rowid, q)
-        self.run(self.fusion.sql, q)
-        time.sleep(2.0)
+            created = post.datetime_created.timestamp()
+        except (KeyError, ValueError, OverflowError): # no usable date, treat it as old
+            created = 0
+        self._rows.append( (post.id, created, post) )
+
+    def refresh(self, post):
+        'SQL UPDATE the row of `post` with data from live facebook. Returns True if it changed'
+        fresh_fb = fb.getPost(post.id, cached=False) # a cached answer would look like nothing changed
+        change = self.scheduler.observe(post.id, (fresh_fb.like_count, fresh_fb.share_count, fresh_fb.comment_count))
+        values = { col: getattr(fresh_fb, col) for col in self.updateCols }
+        if all(str(v) == str(post.post.get(self._map[col])) for col, v in values.items()):
+            return False # the table has it already, save the Fusion quota too
+        cols = [ " '{}'='{}' ".format(self._map[col], v) for col, v in values.items() ]
+        q = "UPDATE {} SET {} WHERE ROWID='{}'".format(self.tableid, ','.join(cols), post.rowid)
+        logger.debug('about to UPDATE SQL rowid=%r: %r (%s changes since the last refresh)', post.rowid, q, change)
+        self.queue_sql(q)
+        return True
+
+    def finished(self):
+        'Refresh the rows the scheduler picks, then send the UPDATEs'
+        import requests
+        chosen = self.scheduler.select(self._rows, self.budget)
+        updated = errors = 0
+        try:
+            for postid, created, post in chosen:
+                try:
+                    updated += self.refresh(post)
+                except (JanusException, requests.exceptions.RequestException) as e: # timeouts and dropped connections too
+                    errors += 1
+                    logger.exception(e)
+                    report(self, colored.red(repr(e)))
+        finally: # keep what we learned and send what we have, even if we were stopped halfway
+            self.scheduler.save()
+            report(self, colored.green('Refreshed {} of {} posts from Facebook (budget {}): {} rows changed, {} errors'.format(
+                len(chosen), len(self._rows), self.budget if self.budget is not None else 'all', updated, errors)))
+            self._rows = []
+            super().finished()
 
 class JanusFusiontablesUpdateSink(JanusFusiontablesSink):
     'Update an existing fusion table with calculated values from itself'
 
+    transform = None # pushes UPDATEs, not formatted rows
+
     def __init__(self, table, columns, output):
         super().__init__(table, output)
         self.updateCols = [ x.strip() for x in columns.split(',')] # a comma separated list of rules to evaluate
@@ -207,10 +332,9 @@ class JanusFusiontablesUpdateSink(JanusFusiontablesSink):
             if isinstance(val, (datetime.datetime, datetime.date)):
                 val = val.isoformat()
             cols.append(""" '{}'='{}' """.format(newcol, val))
-        q = "UPDATE {} SET {} WHERE ROWID='{}'".format(self.table.tableid, ','.join(cols), post.rowid)
+        q = "UPDATE {} SET {} WHERE ROWID='{}'".format(self.tableid, ','.join(cols), post.rowid)
         logger.debug('about to UPDATE SQL rowid=%r: %r', post.rowid, q)
-        self.run(self.fusion.sql, q)
-        time.sleep(2.0)
+        self.queue_sql(q)
 
 class JanusFusiontablesSource(JanusSource):
 
@@ -219,7 +343,8 @@ class JanusFusiontablesSource(JanusSource):
         super().__init__(output)
         self.table = table
         self.id = table.tableid
-        self.fusion = fusionclient.Fusion()
+        self.fusion = fusion_client()
+        self.where = [] # conditions pushed down from the filter, see .set_filter()
         #self.metadata = self.fusion.run(self.fusion.service.table().get(tableId=tableid))
 
     def __str__(self):
@@ -230,16 +355,22 @@ class JanusFusiontablesSource(JanusSource):
     def autenticate(self):
         raise NotImplementedError # TODO: FIX
 
+    def set_filter(self, flt):
+        'Send what Fusion can do of `flt` with the query, and keep the rest in .residual'
+        self.filter = flt
+        self.where, self.residual = flt.fusion_pushdown() if flt is not None else ([], None)
+        logger.debug('Filter %r: WHERE %r, residual %s', flt, self.where, 'yes' if self.residual else 'no')
+
     def __iter__(self):
         colnames = [ c['name'] for c in self.table.metadata['columns'] ]
-        where = [self.filter,] if self.filter is not None else []
+        where = list(self.where)
         if self.since is not None: # its a datetime.datetime
             where.append(""" 'Dato' >= '{}' """.format(self.since.strftime('%Y.%m.%d')))
         if self.until is not None: # its a datetime.datetime
             where.append(""" 'Dato' <= '{}' """.format(self.until.strftime('%Y.%m.%d')))
             
         q = self.fusion.select(colnames, self.table.tableid, where=where)
-        yield from [ JanusFusiontablePost(q['columns'], post) for post in q['rows'] ]
+        yield from self._keep([ JanusFusiontablePost(q['columns'], post) for post in q.get('rows', []) ])
         
 
 class JanusFusiontable:
@@ -247,7 +378,7 @@ class JanusFusiontable:
 
     def __init__(self, metadata):
         self.metadata = metadata
-        logger.debug('Got table metadata: %r', metadata)
+        logger.debug('Got table metadata: %r', abbrev(metadata))
 
     def __str__(self):
         return self.name
@@ -265,7 +396,7 @@ class JanusFusiontablePost(JanusPost):
 
     def __init__(self, columns, rowdata):
         self.post = { col:data for (col, data) in zip(columns, rowdata) }
-        logger.debug('setting self.post= %r', self.post)
+        logger.debug('setting self.post= %r', abbrev(self.post))
 
     @property
     def id(self):
@@ -295,27 +426,15 @@ class JanusFusiontablePost(JanusPost):
 
     @property
     def comment_count(self):
-        return post['AntallKommentarer']
+        return self.post['AntallKommentarer']
 
     @property
     def comments(self):
         return self.post['Kommentarer']
 
-    def comments_html(self, comments_struct):
+    def comments_html(self, comments_struct, max_bytes=None):
         'Turn a json list of comments into an html string'
-        s = ['<ul>', ]
-        for com in comments_struct:
-            s.append('<li><b>{}</b> (+{}): {}'.format(html.escape(com['from']['name']), 
-                                                      com['like_count'], 
-                                                      html.escape(com['message'])
-                                                      )
-                    )
-            if 'comments' in com:
-                #recurse into nested comment
-                s.append(comments_html(com['comments']['data']))
-            s.append('</li>')
-        s.append('</ul>')
-        return ''.join(s)
+        return render_comments(comments_struct, 'html', max_bytes)
 
     @property
     def message(self):
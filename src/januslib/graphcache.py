@@ -0,0 +1,156 @@
+import collections
+import colorlog
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+import urllib.parse
+
+from .metrics import metrics
+
+logger = colorlog.getLogger('Janus.januslib.graphcache')
+
+GRAPH_CACHE_DIR = os.environ.get('JANUS_GRAPH_CACHE', 'data/graph-cache')
+GRAPH_CACHE_MEMORY = 256 # responses kept in memory, in front of the disk
+GRAPH_CACHE_TTL = { # seconds a response stays fresh, per endpoint
+    'feed': 600, # new posts show up here first
+    'comments': 900,
+    'object': 3600, # a single post, from getPost(cached=True)
+}
+_IGNORED_PARAMS = ('access_token', 'appsecret_proof') # they do not change the response
+
+def graph_endpoint(path):
+    'Which GRAPH_CACHE_TTL entry a Graph path falls under'
+    edge = path.strip('/').rpartition('/')[2]
+    return edge if edge in GRAPH_CACHE_TTL and '/' in path.strip('/') else 'object'
+
+def cache_key(path, params):
+    'Normalize a Graph GET to "path?sorted&params", leaving out the tokens'
+    query = sorted( (k, str(v)) for k, v in (params or {}).items() if k not in _IGNORED_PARAMS )
+    return '/{}?{}'.format(path.strip('/'), urllib.parse.urlencode(query))
+
+class JanusGraphCache:
+    '''Graph GET responses, on disk as gzipped JSON with a small LRU in memory in front.
+
+    Responses are keyed by path and params, and are fresh for GRAPH_CACHE_TTL[endpoint] seconds.
+    Only successful responses are stored. It is off unless `enabled` or turned on with .enabled = True,
+    so nothing reads stale counts without asking for it'''
+
+    def __init__(self, path, memory=GRAPH_CACHE_MEMORY, ttl=None, enabled=False):
+        self.path = path
+        self.memory = memory
+        self.ttl = dict(GRAPH_CACHE_TTL, **(ttl or {}))
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._lru = collections.OrderedDict() # key -> (stored, response)
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        if not self.enabled:
+            return 'graph cache off'
+        return 'graph cache {} hits/{} misses'.format(self.hits, self.misses)
+
+    def _filename(self, key):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest[:2], '{}.json.gz'.format(digest))
+
+    def _remember(self, key, stored, response):
+        'Put a response in the LRU. Call with the lock held'
+        self._lru[key] = (stored, response)
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.memory:
+            self._lru.popitem(last=False)
+
+    def get(self, key, endpoint):
+        'Return the cached response for `key` if it is fresh, else None'
+        if not self.enabled:
+            return None
+        oldest = time.time() - self.ttl.get(endpoint, self.ttl['object'])
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry is not None:
+                self._lru.move_to_end(key)
+        if entry is None:
+            try:
+                with gzip.open(self._filename(key), 'rt', encoding='utf-8') as f:
+                    rec = json.load(f)
+                entry = (rec['stored'], rec['response'])
+                with self._lock:
+                    self._remember(key, *entry)
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError, KeyError) as e: # half written or garbled, fetch it again
+                logger.debug('Ignoring unreadable cache entry for %s: %s', key, e)
+        fresh = entry is not None and entry[0] >= oldest
+        with self._lock:
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+        metrics.inc('janus_graph_cache_total', result='hit' if fresh else 'miss', endpoint=endpoint)
+        return entry[1] if fresh else None
+
+    def put(self, key, response):
+        'Store a response for `key`'
+        if not self.enabled:
+            return
+        stored = time.time()
+        with self._lock:
+            self._remember(key, stored, response)
+        filename = self._filename(key)
+        tmp = '{}.{}.tmp'.format(filename, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with gzip.open(tmp, 'wt', encoding='utf-8') as f:
+                json.dump({'key': key, 'stored': stored, 'response': response}, f, separators=(',', ':'))
+            os.replace(tmp, filename)
+        except OSError as e: # a cache that cannot write is just a slower cache
+            logger.warning('Could not write graph cache entry %s: %s', filename, e)
+
+    def clear(self):
+        'Forget everything, in memory and on disk. Returns the number of files removed'
+        with self._lock:
+            self._lru.clear()
+        removed = 0
+        if os.path.isdir(self.path):
+            for dirpath, _, filenames in os.walk(self.path):
+                for name in filenames:
+                    if name.endswith('.json.gz'):
+                        os.remove(os.path.join(dirpath, name))
+                        removed += 1
+        return removed
+
+class JanusCachedGraph:
+    'A facebook.GraphAPI that answers GETs from a JanusGraphCache when it can'
+
+    def __init__(self, graph, cache=None):
+        self.graph = graph
+        self.cache = cache if cache is not None else graph_cache()
+
+    def __getattr__(self, name): # everything but .request goes straight to the GraphAPI
+        return getattr(self.graph, name)
+
+    def request(self, path, args=None, post_args=None, files=None, method=None):
+        if post_args is not None or files is not None or method not in (None, 'GET'):
+            return self.graph.request(path, args, post_args, files, method)
+        key = cache_key(path, args)
+        endpoint = graph_endpoint(path)
+        response = self.cache.get(key, endpoint)
+        if response is None:
+            response = self.graph.request(path, args)
+            self.cache.put(key, response)
+        return response
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def graph_cache():
+    'Return the process wide JanusGraphCache, in GRAPH_CACHE_DIR. It starts off'
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = JanusGraphCache(GRAPH_CACHE_DIR)
+        return _cache
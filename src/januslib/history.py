@@ -0,0 +1,239 @@
+import bisect
+import colorlog
+import io
+import os
+import threading
+import time
+from datetime import datetime
+
+from . import JanusSink, JanusException, report
+from .metrics import metrics
+
+logger = colorlog.getLogger('Janus.januslib.history')
+
+HISTORY_COUNTERS = ('likes', 'shares', 'comments')
+_PROPERTIES = ('like_count', 'share_count', 'comment_count') # the JanusPost properties behind HISTORY_COUNTERS
+HISTORY_LOG = 'history.log' # one block per run
+HISTORY_POSTS = 'posts.txt' # post ids, the line number is the post index used in the log
+
+def _varint(n, out):
+    'Append unsigned `n` to bytearray `out`, 7 bits at a time'
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def _zigzag(n):
+    'Map signed to unsigned, so small negative deltas stay small'
+    return (n << 1) ^ (n >> 63)
+
+def _unzigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+def _read_varint(buf, pos):
+    'Return (value, position after it) for the varint at buf[pos]'
+    result = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+def _int(v):
+    'Fusion tables hand us numbers as strings, sometimes empty'
+    try:
+        return int(float(v)) if v not in (None, '') else 0
+    except (TypeError, ValueError):
+        return 0
+
+class JanusHistory:
+    '''Engagement history of posts, stored as deltas.
+
+    Each run appends one block to history.log: the seconds since the previous run, then for every post
+    whose counters changed, the post index (delta coded), a bitmask of the changed counters and their
+    zigzag coded deltas, all as varints. Posts with unchanged counters cost nothing.
+    The whole log is replayed into memory on open, so curves and risers never touch the raw posts.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.ids = [] # post index -> post id
+        self.index = {} # post id -> post index
+        self.series = [] # post index -> ([timestamps], [counter tuples]), one entry per change
+        self.last_run = 0 # epoch seconds of the last block
+        self.runs = 0
+        self._good = 0 # length of the log up to the last complete block
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            with io.open(os.path.join(self.path, HISTORY_POSTS), encoding='utf-8') as f:
+                for line in f:
+                    self._intern(line.rstrip('\n'))
+        except FileNotFoundError:
+            return
+        try:
+            with io.open(os.path.join(self.path, HISTORY_LOG), 'rb') as f:
+                buf = f.read()
+        except FileNotFoundError:
+            return
+        pos = 0
+        with metrics.timer('janus_history_load_seconds'):
+            while pos < len(buf):
+                try:
+                    size, start = _read_varint(buf, pos)
+                except IndexError:
+                    break
+                if start + size > len(buf):
+                    break
+                self._replay(buf, start, start + size)
+                pos = self._good = start + size
+        if pos < len(buf):
+            logger.warning('Ignoring %i bytes of an unfinished run at the end of %s', len(buf) - pos, HISTORY_LOG)
+        logger.debug('Loaded history of %i posts over %i runs from %s', len(self.ids), self.runs, self.path)
+
+    def _replay(self, buf, pos, end):
+        gap, pos = _read_varint(buf, pos)
+        ts = self.last_run + gap
+        idx = 0
+        while pos < end:
+            step, pos = _read_varint(buf, pos)
+            idx += step
+            mask = buf[pos]
+            pos += 1
+            times, values = self.series[idx]
+            current = list(values[-1]) if values else [0] * len(HISTORY_COUNTERS)
+            for i in range(len(HISTORY_COUNTERS)):
+                if mask & (1 << i):
+                    delta, pos = _read_varint(buf, pos)
+                    current[i] += _unzigzag(delta)
+            times.append(ts)
+            values.append(tuple(current))
+        self.last_run = ts
+        self.runs += 1
+
+    def _intern(self, postid):
+        try:
+            return self.index[postid]
+        except KeyError:
+            idx = self.index[postid] = len(self.ids)
+            self.ids.append(postid)
+            self.series.append( ([], []) )
+            return idx
+
+    def current(self, postid):
+        'Return the last known counters of a post, as a tuple ordered like HISTORY_COUNTERS'
+        try:
+            values = self.series[self.index[postid]][1]
+        except KeyError:
+            values = None
+        return values[-1] if values else (0,) * len(HISTORY_COUNTERS)
+
+    def append(self, snapshot, timestamp=None):
+        '''Add a run: `snapshot` maps post id -> counter tuple. Only posts whose counters
+        changed since their last record are written. Returns the number of posts written'''
+        ts = int(timestamp if timestamp is not None else time.time())
+        with self._lock:
+            if ts < self.last_run:
+                raise JanusException('Cannot add a run from before the last one')
+            known = len(self.ids)
+            changes = []
+            for postid, values in snapshot.items():
+                idx = self._intern(postid)
+                old = self.current(postid)
+                if tuple(values) != old:
+                    changes.append( (idx, old, tuple(values)) )
+            if len(self.ids) > known: # new post ids go first, a block must never point past them
+                os.makedirs(self.path, exist_ok=True)
+                with io.open(os.path.join(self.path, HISTORY_POSTS), 'a', encoding='utf-8') as f:
+                    f.write(''.join('{}\n'.format(p) for p in self.ids[known:]))
+            if not changes:
+                return 0
+            changes.sort()
+            block = bytearray()
+            _varint(ts - self.last_run, block)
+            previous = 0
+            for idx, old, new in changes:
+                _varint(idx - previous, block)
+                previous = idx
+                mask = 0
+                deltas = bytearray()
+                for i, (a, b) in enumerate(zip(old, new)):
+                    if a != b:
+                        mask |= 1 << i
+                        _varint(_zigzag(b - a), deltas)
+                block.append(mask)
+                block.extend(deltas)
+            record = bytearray()
+            _varint(len(block), record)
+            record.extend(block)
+            logname = os.path.join(self.path, HISTORY_LOG)
+            with io.open(logname, 'ab') as f:
+                if f.tell() > self._good: # drop what a crashed run left behind
+                    f.truncate(self._good)
+                    f.seek(self._good)
+                f.write(record)
+                self._good = f.tell()
+            for idx, old, new in changes:
+                times, values = self.series[idx]
+                times.append(ts)
+                values.append(new)
+            self.last_run = ts
+            self.runs += 1
+            metrics.inc('janus_history_bytes_total', len(record))
+            return len(changes)
+
+    def curve(self, postid):
+        'Return [(datetime, likes, shares, comments), ...] for every run where a counter of `postid` changed'
+        try:
+            times, values = self.series[self.index[postid]]
+        except KeyError:
+            raise JanusException('No history for post {}'.format(postid))
+        return [ (datetime.fromtimestamp(t),) + v for t, v in zip(times, values) ]
+
+    def risers(self, hours=24, counter='likes', top=10, now=None):
+        'Return the `top` posts by growth of `counter` over the last `hours`, as [(post id, growth, now value), ...]'
+        try:
+            col = HISTORY_COUNTERS.index(counter)
+        except ValueError:
+            raise JanusException('Unknown counter {!r}, use one of {}'.format(counter, ', '.join(HISTORY_COUNTERS)))
+        since = (now if now is not None else time.time()) - hours * 3600
+        growth = []
+        for idx, (times, values) in enumerate(self.series):
+            if not times or times[-1] < since: # nothing changed in the window
+                continue
+            i = bisect.bisect_right(times, since)
+            before = values[i - 1][col] if i > 0 else 0
+            growth.append( (values[-1][col] - before, values[-1][col], self.ids[idx]) )
+        growth.sort(reverse=True)
+        return [ (postid, delta, value) for delta, value, postid in growth[:top] ]
+
+class JanusHistorySink(JanusSink):
+    'Record the likes, shares and comments of every post pushed, as one run in a JanusHistory store'
+
+    def __init__(self, path, output):
+        super().__init__(output)
+        self.history = JanusHistory(path)
+        self._snapshot = {}
+
+    def __str__(self):
+        'return pretty name'
+        return '>>>History({})'.format(self._slugify(self.history.path))
+
+    @property
+    def queue_depth(self):
+        return len(self._snapshot)
+
+    def push(self, post):
+        if post.kind != 'post':
+            return
+        self._snapshot[post.id] = tuple(_int(getattr(post, p)) for p in _PROPERTIES)
+
+    def finished(self):
+        if not self._snapshot:
+            return
+        written = self.history.append(self._snapshot)
+        report(self, 'History: {} of {} posts changed since the last run'.format(written, len(self._snapshot)))
+        self._snapshot = {}
@@ -0,0 +1,120 @@
+#-*- enc: utf-8
+
+import colorlog
+import gzip
+import hashlib
+import http.server
+import mimetypes
+import os
+import posixpath
+import socketserver
+import threading
+import urllib.parse
+
+logger = colorlog.getLogger('Janus.januslib.httpserve')
+
+COMPRESSIBLE = ('text/', 'application/json', 'application/javascript', 'image/svg+xml')
+GZIP_MIN_BYTES = 512 # not worth it below this
+
+class StaticCache:
+    'Raw bytes, gzipped bytes and ETag per file, recomputed only when the file changes'
+
+    def __init__(self):
+        self._entries = {} # path -> (mtime, size, etag, raw, gzipped)
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        st = os.stat(path)
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry is not None and entry[0] == st.st_mtime and entry[1] == st.st_size:
+            return entry[2:]
+        with open(path, 'rb') as f:
+            raw = f.read()
+        etag = '"{}"'.format(hashlib.sha1(raw).hexdigest()[:16])
+        ctype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        gzipped = None
+        if len(raw) >= GZIP_MIN_BYTES and ctype.startswith(COMPRESSIBLE):
+            gzipped = gzip.compress(raw, compresslevel=6)
+        with self._lock:
+            self._entries[path] = (st.st_mtime, st.st_size, etag, raw, gzipped)
+        return etag, raw, gzipped
+
+class StaticHandler(http.server.BaseHTTPRequestHandler):
+    'Serve files under server.root with ETag/If-None-Match and gzip, plus any callables in server.routes'
+
+    def _route(self, method):
+        path = urllib.parse.urlsplit(self.path).path
+        for prefix, handler in self.server.routes.items():
+            if path.startswith(prefix):
+                handler(self, method)
+                return True
+        return False
+
+    def _file(self):
+        'Map the request path to a file under server.root, or None'
+        path = posixpath.normpath(urllib.parse.unquote(urllib.parse.urlsplit(self.path).path))
+        parts = [ p for p in path.split('/') if p and p not in ('.', '..') ]
+        full = os.path.join(self.server.root, *parts)
+        if os.path.isdir(full):
+            full = os.path.join(full, 'index.html')
+        return full if os.path.isfile(full) else None
+
+    def _serve(self, head=False):
+        full = self._file()
+        if full is None:
+            self.send_error(404)
+            return
+        etag, raw, gzipped = self.server.cache.get(full)
+        ctype = mimetypes.guess_type(full)[0] or 'application/octet-stream'
+        matches = [ t.strip() for t in self.headers.get('If-None-Match', '').split(',') ]
+        if etag in matches or '*' in matches:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        body = raw
+        self.send_response(200)
+        self.send_header('Content-Type', ctype)
+        self.send_header('ETag', etag)
+        # feeds change under the same name, so make browsers revalidate them. A 304 is cheap
+        self.send_header('Cache-Control', 'no-cache' if ctype == 'application/json' else 'max-age=300')
+        if gzipped is not None:
+            self.send_header('Vary', 'Accept-Encoding')
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                self.send_header('Content-Encoding', 'gzip')
+                body = gzipped
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        if not self._route('GET'):
+            self._serve()
+
+    def do_HEAD(self):
+        self._serve(head=True)
+
+    def do_POST(self):
+        if not self._route('POST'):
+            self.send_error(405)
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+class StaticServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+def run_static_server(root, port=8000, addr='127.0.0.1', routes=None):
+    'Serve the `root` directory at http://addr:port in a background thread. Returns (thread, httpd)'
+    httpd = StaticServer((addr, port), StaticHandler)
+    httpd.root = os.path.abspath(root)
+    httpd.cache = StaticCache()
+    httpd.routes = routes if routes is not None else {} # path prefix -> callable(handler, method)
+    t = threading.Thread(target=httpd.serve_forever)
+    t.daemon = True
+    t.start()
+    logger.debug('Serving %s at http://%s:%s', httpd.root, addr, port)
+    return t, httpd
@@ -0,0 +1,282 @@
+import collections
+import colorlog
+import json
+import threading
+import time
+import urllib.parse
+
+from . import JanusException
+from .metrics import metrics
+from .logutil import abbrev
+from .fusiontables import fusion_client
+
+logger = colorlog.getLogger('Janus.januslib.labelling')
+
+LABEL_PREFETCH = 50 # unlabelled rows to keep buffered per table
+LABEL_LEASE_SECONDS = 600 # a row handed to a labeller is theirs for this long
+LABEL_FLUSH_SIZE = 25 # flush the label queue when it gets this long
+LABEL_FLUSH_INTERVAL = 5.0 # or after this many seconds
+LABEL_RETRY_SECONDS = 30.0 # back off this long after a failed flush
+LABEL_DISPLAY_COLUMNS = ('Melding', 'Kommentarer', 'AntallKommentarer', 'Avsender', 'ID', 'Link',
+                         'Media', 'Delinger', 'Dato', 'Likes', 'Permalink')
+
+def is_binarysort_column(col):
+    'Return True if a Fusion table column is set up for binary classification [0,1]'
+    if col.get('type') != 'NUMBER' or 'columnPropertiesJson' not in col:
+        return False
+    try:
+        return json.loads(col['columnPropertiesJson']).get('binarysort') is True
+    except ValueError:
+        return False
+
+def _quote(value):
+    return "'{}'".format(str(value).replace("'", "\\'"))
+
+class JanusLabelQueue:
+    'Buffered, leased unlabelled rows from one Fusion table, for one set of label columns'
+
+    def __init__(self, service, tableid, columns):
+        self.service = service
+        self.tableid = tableid
+        self.columns = tuple(columns) # the label columns. A row is unlabelled while all of them are empty
+        self.buffer = collections.deque() # rows nobody holds
+        self.leases = {} # rowid -> (labeller, expiry, row)
+        self.pending = set() # rowids labelled, but not yet flushed to Fusion
+        self.exhausted = False # the last refill came back short: no more rows to get
+        self._lock = threading.Lock()
+        self._refill_lock = threading.Lock()
+
+    def _expire(self, now):
+        'Put rows with expired leases back in the buffer. Call with the lock held'
+        for rowid, (labeller, expiry, row) in list(self.leases.items()):
+            if expiry < now:
+                logger.debug('Lease on row %s for %s expired', rowid, labeller)
+                del self.leases[rowid]
+                self.buffer.appendleft(row)
+
+    def refill(self):
+        'Get a new batch of unlabelled rows from Fusion, skipping those we already hold'
+        with self._refill_lock:
+            with self._lock:
+                held = set(self.leases) | self.pending | set(row['rowid'] for row in self.buffer)
+            # the rows we hold are still unlabelled in Fusion, so ask for enough to get past them
+            limit = LABEL_PREFETCH + len(held)
+            response = self.service.fusion.select(list(LABEL_DISPLAY_COLUMNS + self.columns), self.tableid,
+                                                  where=[ "{}=''".format(_quote(c)) for c in self.columns ],
+                                                  limit=limit)
+            if response is None:
+                raise JanusException('Could not get unlabelled rows from {}'.format(self.tableid))
+            cols = [ c.lower() for c in response['columns'] ]
+            rows = response.get('rows', [])
+            with self._lock:
+                held = set(self.leases) | self.pending | set(row['rowid'] for row in self.buffer)
+                fresh = [ dict(zip(cols, r)) for r in rows ]
+                self.buffer.extend(row for row in fresh if row['rowid'] not in held)
+                self.exhausted = len(rows) < limit
+            metrics.inc('janus_label_prefetched_total', len(rows), table=self.tableid)
+            logger.debug('Refilled label buffer for %s: %i rows, %i buffered', self.tableid, len(rows), len(self.buffer))
+
+    def _refill_soon(self):
+        'Top up the buffer in the background, unless a refill is already running'
+        if self._refill_lock.locked():
+            return
+        def refill():
+            try:
+                self.refill()
+            except Exception as e:
+                logger.exception('Background refill of %s failed: %s', self.tableid, e)
+        threading.Thread(target=refill, daemon=True).start()
+
+    def next(self, labeller, n=1):
+        'Lease up to `n` unlabelled rows to `labeller`. Returns a list of rows, empty when there is nothing left'
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            short = len(self.buffer) < n and not self.exhausted
+        if short:
+            self.refill()
+        rows = []
+        with self._lock:
+            while self.buffer and len(rows) < n:
+                row = self.buffer.popleft()
+                self.leases[row['rowid']] = (labeller, now + LABEL_LEASE_SECONDS, row)
+                rows.append(row)
+            low = len(self.buffer) < LABEL_PREFETCH // 2 and not self.exhausted
+        if low:
+            self._refill_soon()
+        metrics.inc('janus_label_leased_total', len(rows), table=self.tableid)
+        return rows
+
+    def label(self, labeller, rowid, labels):
+        'Record `labels` ({column: 0 or 1}) for a row leased to `labeller`, and queue them for writing'
+        unknown = set(labels) - set(self.columns)
+        if unknown:
+            raise JanusException('Not a label column here: {}'.format(', '.join(sorted(unknown))))
+        values = { c: int(labels.get(c, 0)) for c in self.columns }
+        if any(v not in (0, 1) for v in values.values()):
+            raise JanusException('Labels must be 0 or 1')
+        with self._lock:
+            lease = self.leases.get(rowid)
+            if lease is None or lease[0] != labeller:
+                raise JanusException('Row {} is not leased to {}'.format(rowid, labeller))
+            del self.leases[rowid]
+            self.pending.add(rowid)
+        self.service.enqueue(self, rowid, values)
+
+    def flushed(self, rowid):
+        with self._lock:
+            self.pending.discard(rowid)
+
+    def release(self, labeller):
+        'Give back all rows leased to `labeller`, e.g. when they close the page'
+        with self._lock:
+            mine = [ rowid for rowid, lease in self.leases.items() if lease[0] == labeller ]
+            for rowid in mine:
+                self.buffer.appendleft(self.leases.pop(rowid)[2])
+        return len(mine)
+
+class JanusLabelService:
+    '''Hands out unlabelled Fusion table rows to labellers and writes their labels back.
+
+    Rows are prefetched in batches and leased, so two labellers never get the same row.
+    Labels are queued and flushed by a background thread, so labellers never wait on Fusion.'''
+
+    def __init__(self, fusion=None):
+        self._fusion = fusion
+        self.queues = {} # (tableid, label columns) -> JanusLabelQueue
+        self._labels = collections.deque() # (queue, rowid, {column: value})
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+
+    @property
+    def fusion(self):
+        if self._fusion is None:
+            self._fusion = fusion_client()
+        return self._fusion
+
+    @property
+    def queue_depth(self):
+        return len(self._labels)
+
+    def tables(self):
+        'Return the tables that have binarysort columns, as a list of {tableId, name, columns}'
+        tables = []
+        for t in self.fusion.tables():
+            cols = [ c['name'] for c in t.get('columns', []) if is_binarysort_column(c) ]
+            if cols:
+                tables.append({'tableId': t['tableId'], 'name': t['name'], 'columns': cols})
+        return tables
+
+    def queue(self, tableid, columns):
+        if not tableid or not columns:
+            raise JanusException('Need a table and at least one label column')
+        key = (tableid, tuple(sorted(columns)))
+        with self._lock:
+            try:
+                return self.queues[key]
+            except KeyError:
+                q = self.queues[key] = JanusLabelQueue(self, tableid, key[1])
+                return q
+
+    def enqueue(self, queue, rowid, values):
+        with self._lock:
+            self._labels.append( (queue, rowid, values) )
+            if len(self._labels) >= LABEL_FLUSH_SIZE:
+                self._wakeup.set()
+
+    def _update_sql(self, tableid, rowid, values):
+        sets = ', '.join('{}={}'.format(_quote(c), _quote(v)) for c, v in sorted(values.items()))
+        return 'UPDATE {} SET {} WHERE ROWID = {}'.format(tableid, sets, _quote(rowid))
+
+    def flush(self):
+        '''Write queued labels to Fusion. Fusion only updates one ROWID per statement, so this sends
+        the batch back to back from here instead of one round trip per click. Returns rows written'''
+        with self._lock:
+            batch = [ self._labels.popleft() for _ in range(min(LABEL_FLUSH_SIZE, len(self._labels))) ]
+        written = 0
+        for i, (queue, rowid, values) in enumerate(batch):
+            try:
+                status, content = self.fusion.sql(self._update_sql(queue.tableid, rowid, values))
+            except Exception as e:
+                status, content = None, e
+            if status != 200:
+                logger.warning('Could not write labels for row %s in %s: %s %r', rowid, queue.tableid, status, abbrev(content))
+                metrics.inc('janus_label_errors_total', table=queue.tableid)
+                with self._lock:
+                    self._labels.extendleft(reversed(batch[i:])) # keep them, in order, for the next try
+                return written
+            queue.flushed(rowid)
+            written += 1
+        metrics.inc('janus_label_written_total', written)
+        return written
+
+    def _flush_loop(self):
+        while not self._stopping:
+            self._wakeup.wait(LABEL_FLUSH_INTERVAL)
+            self._wakeup.clear()
+            while self._labels:
+                with metrics.timer('janus_label_flush_seconds'):
+                    before = len(self._labels)
+                    self.flush()
+                if len(self._labels) >= before: # nothing went through, back off
+                    self._wakeup.wait(LABEL_RETRY_SECONDS)
+                    break
+
+    def stop(self, flush=True):
+        'Stop the background flusher, writing what is queued first'
+        self._stopping = True
+        self._wakeup.set()
+        self._flusher.join()
+        if flush and self._labels:
+            self.flush()
+        return len(self._labels)
+
+class JanusLabelAPI:
+    '''JSON api for the labelling page, as a route for januslib.httpserve:
+
+        GET  <prefix>tables
+        GET  <prefix>next?table=..&labeller=..&columns=a,b&n=..
+        POST <prefix>submit   {"table", "labeller", "columns", "rowid", "labels": {column: 0|1}}
+        POST <prefix>release  {"table", "labeller", "columns"}'''
+
+    def __init__(self, service, prefix='/api/label/'):
+        self.service = service
+        self.prefix = prefix
+
+    def _reply(self, handler, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Cache-Control', 'no-store')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def _columns(self, value):
+        return value if isinstance(value, list) else [ c for c in value.split(',') if c ]
+
+    def __call__(self, handler, method):
+        url = urllib.parse.urlsplit(handler.path)
+        action = url.path[len(self.prefix):]
+        try:
+            if method == 'GET' and action == 'tables':
+                return self._reply(handler, 200, self.service.tables())
+            elif method == 'GET' and action == 'next':
+                q = dict(urllib.parse.parse_qsl(url.query))
+                rows = self.service.queue(q.get('table'), self._columns(q.get('columns', ''))).next(q['labeller'], int(q.get('n', 1)))
+                return self._reply(handler, 200, rows)
+            elif method == 'POST' and action in ('submit', 'release'):
+                length = int(handler.headers.get('Content-Length', 0))
+                req = json.loads(handler.rfile.read(length).decode('utf-8'))
+                queue = self.service.queue(req.get('table'), self._columns(req.get('columns', [])))
+                if action == 'submit':
+                    queue.label(req['labeller'], req['rowid'], req['labels'])
+                    return self._reply(handler, 202, {'queued': self.service.queue_depth})
+                return self._reply(handler, 200, {'released': queue.release(req['labeller'])})
+        except (JanusException, KeyError, ValueError) as e:
+            logger.debug('Bad labelling request %r: %s', handler.path, e)
+            return self._reply(handler, 400, {'error': str(e)})
+        self._reply(handler, 404, {'error': 'No such endpoint'})
@@ -0,0 +1,105 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+# loggers that log once per post or per row, and how many records per second (per message) they may emit
+# Names match their children too, so list only the chatty ones, never 'Janus' itself
+SAMPLED_LOGGERS = {'Janus.januslib.fusiontables': 10.0,
+                   'Janus.fusionclient': 10.0,
+                   'Janus.januslib.fbcomments': 10.0,
+                   'Janus.posts': 10.0, # the per post messages of janus.py
+                   }
+
+class abbrev:
+    'Wrap a log argument so that it is truncated when, and only if, the record is actually formatted'
+
+    def __init__(self, obj, maxlen=200):
+        self.obj = obj
+        self.maxlen = maxlen
+
+    def _cut(self, s):
+        if len(s) <= self.maxlen: return s
+        return '{}... ({} chars)'.format(s[:self.maxlen], len(s))
+
+    def __str__(self):
+        return self._cut(str(self.obj))
+
+    def __repr__(self):
+        return self._cut(repr(self.obj))
+
+class JanusQueueHandler(logging.handlers.QueueHandler):
+    '''Put records on a queue for a background writer, without formatting them first.
+
+    The stock QueueHandler formats the message in the calling thread. We only render
+    tracebacks (which keep frames alive), and leave the %-formatting of the arguments
+    to the listener thread. Log arguments must therefore not be mutated after logging.'''
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+class JanusSampleFilter(logging.Filter):
+    'Let at most `rate` records per second through for each (logger, message) pair. Warnings and errors always pass'
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates # {logger name prefix: records per second}
+        self._buckets = {} # (logger name, msg) -> [tokens, last refill, suppressed]
+        self._lock = threading.Lock()
+
+    def _rate(self, name):
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition('.')[0]
+        return None
+
+    def filter(self, record):
+        if record.levelno > logging.INFO:
+            return True
+        rate = self._rate(record.name)
+        if rate is None:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [rate, now, 0]
+            # token bucket, refilled at `rate` per second, holding at most one second worth of tokens
+            bucket[0] = min(rate, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if bucket[0] < 1.0:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1.0
+            suppressed, bucket[2] = bucket[2], 0
+        if suppressed:
+            record.msg = '{} [{} similar messages suppressed]'.format(record.msg, suppressed)
+        return True
+
+def setup_file_logging(logger, filename, level=logging.DEBUG, rates=SAMPLED_LOGGERS):
+    '''Log to a rotating `filename` through a queue and a background writer thread.
+
+    Returns the running QueueListener, which is stopped (and flushed) at exit'''
+    q = queue.Queue(-1)
+    fileout = logging.handlers.RotatingFileHandler(filename, maxBytes=5*1024*1024, backupCount=5)
+    fileout.setLevel(level)
+    fileout.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    listener = logging.handlers.QueueListener(q, fileout, respect_handler_level=True)
+    handler = JanusQueueHandler(q)
+    handler.setLevel(level)
+    if rates:
+        handler.addFilter(JanusSampleFilter(rates))
+    logger.addHandler(handler)
+    listener.start()
+    def _flush():
+        if listener._thread is not None: # not already stopped
+            listener.stop()
+    atexit.register(_flush)
+    return listener
@@ -0,0 +1,195 @@
+import bisect
+import colorlog
+import io
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = colorlog.getLogger('Janus.januslib.metrics')
+
+# upper bounds (in seconds) of the latency histogram buckets, prometheus style
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _labelkey(labels):
+    'Turn a dict of labels into a hashable, sorted tuple'
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _promlabels(key, extra=None):
+    'Render a label tuple as a prometheus label set, e.g. {sink="x",le="0.5"}'
+    pairs = list(key)
+    if extra is not None:
+        pairs.extend(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
+
+class JanusHistogram:
+    'A cumulative histogram with fixed buckets'
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def quantile(self, q):
+        'Estimate quantile `q` (0..1) from the bucket counts'
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count,
+                'sum': self.sum,
+                'max': self.max,
+                'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], self.counts)),
+                }
+
+class JanusMetrics:
+    'A registry of counters and histograms, keyed by metric name and labels'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {} # (name, labelkey) -> number
+            self.histograms = {} # (name, labelkey) -> JanusHistogram
+            self.started = time.time()
+
+    def inc(self, name, value=1, **labels):
+        'Add `value` to counter `name`'
+        key = (name, _labelkey(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        'Record `value` in histogram `name`'
+        key = (name, _labelkey(labels))
+        with self._lock:
+            try:
+                h = self.histograms[key]
+            except KeyError:
+                h = self.histograms[key] = JanusHistogram()
+            h.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        'Context manager that records the elapsed wall time in histogram `name`'
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0, **labels)
+
+    def timed_iter(self, iterable, name, **labels):
+        'Wrap `iterable`, recording the time spent waiting for each item in histogram `name`'
+        it = iter(iterable)
+        while True:
+            t0 = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            self.observe(name, time.perf_counter() - t0, **labels)
+            yield item
+
+    def snapshot(self):
+        'Return all metrics as a json serializable dict'
+        with self._lock:
+            counters = [ {'name': n, 'labels': dict(k), 'value': v} for (n, k), v in sorted(self.counters.items()) ]
+            histograms = [ dict(name=n, labels=dict(k), **h.to_dict()) for (n, k), h in sorted(self.histograms.items()) ]
+        return {'started': self.started,
+                'uptime': time.time() - self.started,
+                'counters': counters,
+                'histograms': histograms,
+                }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self):
+        'Render all metrics in the prometheus text exposition format'
+        out = io.StringIO()
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+        typed = set()
+        for (name, key), value in counters:
+            if name not in typed:
+                out.write('# TYPE {} counter\n'.format(name))
+                typed.add(name)
+            out.write('{}{} {}\n'.format(name, _promlabels(key), value))
+        for (name, key), h in histograms:
+            if name not in typed:
+                out.write('# TYPE {} histogram\n'.format(name))
+                typed.add(name)
+            cumulative = 0
+            for le, c in zip([str(b) for b in h.buckets] + ['+Inf'], h.counts):
+                cumulative += c
+                out.write('{}_bucket{} {}\n'.format(name, _promlabels(key, [('le', le)]), cumulative))
+            out.write('{}_sum{} {}\n'.format(name, _promlabels(key), h.sum))
+            out.write('{}_count{} {}\n'.format(name, _promlabels(key), h.count))
+        return out.getvalue()
+
+    def write(self, filename, fmt='prometheus'):
+        'Atomically write metrics to `filename`, as `prometheus` textfile or `json`'
+        if fmt == 'json':
+            data = self.to_json()
+        elif fmt in ('prometheus', 'prom'):
+            data = self.to_prometheus()
+        else:
+            raise ValueError('Unknown metrics format: {!r}'.format(fmt))
+        # the node_exporter textfile collector may read at any time, so never expose a half written file
+        tmp = '{}.{}.tmp'.format(filename, os.getpid())
+        with io.open(tmp, 'w') as f:
+            f.write(data)
+        os.replace(tmp, filename)
+        logger.debug('Wrote %s metrics to %s', fmt, filename)
+        return filename
+
+    def summary(self):
+        'Return a human readable table of all metrics'
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+        for (name, key), h in histograms:
+            lines.append('{}{}: n={} total={:.3f}s mean={:.4f}s p50={}s p95={}s max={:.4f}s'.format(
+                name, _promlabels(key), h.count, h.sum, h.mean, h.quantile(0.5), h.quantile(0.95), h.max))
+        for (name, key), value in counters:
+            lines.append('{}{}: {}'.format(name, _promlabels(key), value))
+        return '\n'.join(lines)
+
+# the process wide registry
+metrics = JanusMetrics()
+
+def sinklabel(sink):
+    '''A short label for a sink, the same every run: its class and the outsink name and args it was made with.
+    Not the sink id, that is random and would give new series for every sink ever added'''
+    spec = getattr(sink, 'spec', None)
+    if spec is None:
+        return sink.__class__.__name__
+    name, args = spec
+    return '{}({})'.format(sink.__class__.__name__, ','.join([name] + [ str(a) for a in args ]))
@@ -0,0 +1,209 @@
+import collections
+import colorlog
+import io
+import json
+import os
+import random
+import threading
+import time
+import uuid
+
+from .metrics import metrics
+from .logutil import abbrev
+
+logger = colorlog.getLogger('Janus.januslib.outbox')
+
+OUTBOX_BACKOFF_MIN = 2.0 # seconds to wait after the first failed attempt
+OUTBOX_BACKOFF_MAX = 300.0 # never wait longer than this between attempts
+OUTBOX_COMPACT_LINES = 5000 # rewrite the log when it has this many lines and nothing is pending
+
+class JanusOutbox:
+    '''A durable queue of writes, delivered in order by a background thread.
+
+    Every write is appended to a JSON lines log, and synced, before anyone tries to send it.
+    Deliveries append a `done` record, permanent failures a `failed` record with the error.
+    After a crash, opening the log again gives back everything that was not done. Those writes are
+    held back, not sent with the new ones, until .replay() queues them.
+    `send(payload)` delivers one write. If it raises one of `retry_on`, the same write is tried
+    again with exponential backoff. Anything else it raises marks the write as failed.'''
+
+    def __init__(self, path, send, retry_on=()):
+        self.path = path
+        self.send = send
+        self.retry_on = retry_on
+        self.pending = collections.OrderedDict() # id -> payload, oldest first
+        self.failed = collections.OrderedDict() # id -> (payload, error)
+        self.held = collections.OrderedDict() # id -> payload, left from an earlier run, see .replay()
+        self.delivered = 0
+        self._lines = 0
+        self._cond = threading.Condition()
+        self._wakeup = threading.Event() # cuts a backoff short
+        self._stopping = False
+        self._thread = None
+        self._load()
+        self.held, self.pending = self.pending, collections.OrderedDict()
+        dirn = os.path.dirname(path)
+        if dirn:
+            os.makedirs(dirn, exist_ok=True)
+        self._f = io.open(path, 'a', encoding='utf-8')
+        if self.held:
+            logger.warning('%i writes left in %s from an earlier run. They are not sent until you use `replay_outbox`', len(self.held), path)
+
+    def _load(self):
+        try:
+            f = io.open(self.path, encoding='utf-8')
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                self._lines += 1
+                try:
+                    rec = json.loads(line)
+                except ValueError: # the last line of a crashed run
+                    logger.warning('Skipping a broken line in %s', self.path)
+                    continue
+                op, rid = rec['op'], rec['id']
+                if op == 'put':
+                    self.pending[rid] = rec['payload']
+                elif op == 'done':
+                    self.pending.pop(rid, None)
+                elif op == 'failed':
+                    payload = self.pending.pop(rid, None)
+                    if payload is not None:
+                        self.failed[rid] = (payload, rec.get('error'))
+                elif op == 'retry':
+                    payload, _ = self.failed.pop(rid, (None, None))
+                    if payload is not None:
+                        self.pending[rid] = payload
+
+    def _append(self, records):
+        'Write records to the log and make sure they are on disk. Call with the lock held'
+        self._f.write(''.join(json.dumps(r, separators=(',', ':')) + '\n' for r in records))
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._lines += len(records)
+
+    def _compact(self):
+        'Rewrite the log with only what still matters. Call with the lock held'
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        records = [ {'op': 'put', 'id': rid, 'payload': p} for rid, p in list(self.held.items()) + list(self.pending.items()) ]
+        for rid, (payload, error) in self.failed.items():
+            records.append({'op': 'put', 'id': rid, 'payload': payload})
+            records.append({'op': 'failed', 'id': rid, 'error': error})
+        with io.open(tmp, 'w', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(r, separators=(',', ':')) + '\n' for r in records))
+            f.flush()
+            os.fsync(f.fileno())
+        self._f.close()
+        os.replace(tmp, self.path)
+        self._f = io.open(self.path, 'a', encoding='utf-8')
+        logger.debug('Compacted %s from %i to %i lines', self.path, self._lines, len(records))
+        self._lines = len(records)
+
+    def put(self, payload):
+        'Store `payload` durably and queue it for delivery. Returns its id'
+        rid = uuid.uuid4().hex
+        with self._cond:
+            self._append([{'op': 'put', 'id': rid, 'ts': time.time(), 'payload': payload}])
+            self.pending[rid] = payload
+            self._cond.notify_all()
+        metrics.inc('janus_outbox_total', result='queued')
+        self.start()
+        return rid
+
+    def start(self):
+        'Start delivering in the background, if we are not already'
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping = False
+                self._thread = threading.Thread(target=self._deliver, name='janus-outbox', daemon=True)
+                self._thread.start()
+
+    def _next(self):
+        with self._cond:
+            while not self.pending and not self._stopping:
+                self._cond.wait()
+            if self._stopping:
+                return None, None
+            return next(iter(self.pending.items()))
+
+    def _settle(self, rid, record):
+        with self._cond:
+            payload = self.pending.pop(rid)
+            self._append([record])
+            if record['op'] == 'failed':
+                self.failed[rid] = (payload, record['error'])
+            if not self.pending and self._lines >= OUTBOX_COMPACT_LINES:
+                self._compact()
+            self._cond.notify_all()
+
+    def _deliver(self):
+        delay = 0
+        while True:
+            rid, payload = self._next()
+            if rid is None:
+                return
+            try:
+                with metrics.timer('janus_outbox_send_seconds'):
+                    self.send(payload)
+            except self.retry_on as e:
+                delay = min(max(delay * 2, OUTBOX_BACKOFF_MIN), OUTBOX_BACKOFF_MAX)
+                wait = delay * random.uniform(0.8, 1.2) # dont retry in lockstep with other clients
+                logger.warning('Write %s will be retried in %.0fs: %s', rid, wait, e)
+                metrics.inc('janus_outbox_total', result='retried')
+                metrics.inc('janus_sleep_seconds_total', wait, reason='outbox_backoff')
+                self._wakeup.wait(wait)
+                self._wakeup.clear()
+                continue
+            except Exception as e:
+                logger.error('Write %s failed for good, it stays in %s: %s %r', rid, self.path, e, abbrev(payload))
+                metrics.inc('janus_outbox_total', result='failed')
+                self._settle(rid, {'op': 'failed', 'id': rid, 'error': '{}: {}'.format(e.__class__.__name__, e)})
+                continue
+            delay = 0
+            self.delivered += 1
+            metrics.inc('janus_outbox_total', result='done')
+            self._settle(rid, {'op': 'done', 'id': rid})
+
+    def drain(self, timeout=None):
+        'Wait until everything queued is delivered (or failed), at most `timeout` seconds. Returns the number still pending'
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self.pending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return len(self.pending)
+
+    def replay(self):
+        'Queue the writes left from an earlier run, ahead of ours. Returns how many'
+        with self._cond:
+            held = list(self.held.items())
+            self.pending = collections.OrderedDict(held + list(self.pending.items()))
+            self.held.clear()
+            self._cond.notify_all()
+        return len(held)
+
+    def retry_failed(self):
+        'Queue the writes that failed for good once more. Returns how many'
+        with self._cond:
+            failed = list(self.failed.items())
+            if failed:
+                self._append([ {'op': 'retry', 'id': rid} for rid, _ in failed ])
+            for rid, (payload, _) in failed:
+                self.pending[rid] = payload
+            self.failed.clear()
+            self._cond.notify_all()
+        self._wakeup.set()
+        return len(failed)
+
+    def stop(self):
+        'Stop delivering. Whatever is pending stays in the log'
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._thread = None
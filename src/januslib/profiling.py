@@ -0,0 +1,133 @@
+import colorlog
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+logger = colorlog.getLogger('Janus.januslib.profiling')
+
+TRACEMALLOC_FRAMES = 10 # deep enough to see which janus module asked for the memory
+
+JANUS_SCRIPTS = ('janus', 'fusionclient', 'console', 'get_comment_feed')
+
+def module_group(filename):
+    'Map a source file name to a short group: a janus module (`fb`, `fusiontables`, ...), a third party package or `stdlib`'
+    norm = filename.replace(os.sep, '/')
+    base = os.path.splitext(os.path.basename(norm))[0]
+    if '/januslib/' in norm:
+        return base if base != '__init__' else 'januslib'
+    if base in JANUS_SCRIPTS:
+        return base
+    for marker in ('site-packages/', 'dist-packages/'):
+        if marker in norm:
+            return norm.split(marker, 1)[1].split('/', 1)[0]
+    return 'stdlib'
+
+def _is_janus(filename):
+    return '/januslib/' in filename.replace(os.sep, '/') or \
+        os.path.splitext(os.path.basename(filename))[0] in JANUS_SCRIPTS
+
+def group_snapshot(snapshot):
+    'Sum the allocations in a tracemalloc snapshot by the innermost janus module on the stack. Returns {group: (size, count)}'
+    groups = {}
+    for stat in snapshot.statistics('traceback'):
+        frames = list(stat.traceback) # innermost frame last
+        group = None
+        for frame in reversed(frames):
+            if _is_janus(frame.filename):
+                group = module_group(frame.filename)
+                break
+        if group is None:
+            group = module_group(frames[-1].filename) if frames else 'unknown'
+        size, count = groups.get(group, (0, 0))
+        groups[group] = (size + stat.size, count + stat.count)
+    return groups
+
+class JanusProfiler:
+    'Run a callable under cProfile, with periodic tracemalloc snapshots grouped by module'
+
+    def __init__(self, outdir, interval=5.0, top=25):
+        self.outdir = outdir
+        self.interval = interval
+        self.top = top
+        self.snapshots = [] # list of (elapsed, {group: (size, count)})
+        self.peak_snapshot = None # the snapshot with the most live memory
+        self.peak_size = -1
+        self._stop = threading.Event()
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        self.pstats_path = os.path.join(outdir, 'pull-{}.pstats'.format(stamp))
+        self.report_path = os.path.join(outdir, 'pull-{}.alloc.txt'.format(stamp))
+
+    def _take_snapshot(self, elapsed):
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+        groups = group_snapshot(snapshot)
+        size = sum(s for s, _ in groups.values())
+        if size > self.peak_size:
+            self.peak_snapshot, self.peak_size = snapshot, size
+        self.snapshots.append( (elapsed, groups) )
+        logger.debug('tracemalloc snapshot at %.1fs: %i traces', elapsed, len(snapshot.traces))
+
+    def _watch(self, t0):
+        while not self._stop.wait(self.interval):
+            self._take_snapshot(time.perf_counter() - t0)
+
+    def run(self, function, *args):
+        'Profile `function(*args)` and write the pstats file and allocation report. Returns what `function` returned'
+        os.makedirs(self.outdir, exist_ok=True)
+        was_tracing = tracemalloc.is_tracing()
+        if not was_tracing:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        profile = cProfile.Profile()
+        t0 = time.perf_counter()
+        watcher = threading.Thread(target=self._watch, args=(t0,), daemon=True)
+        watcher.start()
+        try:
+            profile.enable()
+            try:
+                return function(*args)
+            finally:
+                profile.disable()
+        finally:
+            self._stop.set()
+            watcher.join()
+            self.elapsed = time.perf_counter() - t0
+            self._take_snapshot(self.elapsed)
+            if not was_tracing:
+                tracemalloc.stop()
+            profile.dump_stats(self.pstats_path)
+            self.stats = pstats.Stats(profile)
+            self.write_report()
+
+    def write_report(self):
+        with io.open(self.report_path, 'w') as f:
+            f.write('# Janus allocation report, {:.1f}s run, {} snapshots\n\n'.format(self.elapsed, len(self.snapshots)))
+            groups = sorted({g for _, snap in self.snapshots for g in snap})
+            f.write('## Live memory by module (KiB) over time\n')
+            f.write('{:>8}  {}\n'.format('t(s)', '  '.join('{:>14}'.format(g[:14]) for g in groups)))
+            for elapsed, snap in self.snapshots:
+                f.write('{:>8.1f}  {}\n'.format(elapsed, '  '.join('{:>14.1f}'.format(snap.get(g, (0, 0))[0] / 1024) for g in groups)))
+            f.write('\n## Live memory by module at end of run\n')
+            final = self.snapshots[-1][1] if self.snapshots else {}
+            for group, (size, count) in sorted(final.items(), key=lambda x: -x[1][0]):
+                f.write('{:>20}: {:>12.1f} KiB in {} blocks\n'.format(group, size / 1024, count))
+            f.write('\n## Top {} allocating lines at peak ({:.1f} KiB)\n'.format(self.top, self.peak_size / 1024))
+            if self.peak_snapshot is not None:
+                for stat in self.peak_snapshot.statistics('lineno')[:self.top]:
+                    frame = stat.traceback[0]
+                    f.write('[{}] {}:{}: {:.1f} KiB in {} blocks\n'.format(module_group(frame.filename), frame.filename,
+                                                                          frame.lineno, stat.size / 1024, stat.count))
+        logger.debug('Wrote allocation report to %s', self.report_path)
+
+    def summary(self):
+        'Return the top functions by cumulative time, as a string'
+        out = io.StringIO()
+        self.stats.stream = out
+        self.stats.sort_stats('cumulative').print_stats(self.top)
+        return out.getvalue()
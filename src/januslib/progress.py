@@ -0,0 +1,48 @@
+import colorlog
+import time
+from datetime import timedelta
+
+from .metrics import sinklabel
+
+logger = colorlog.getLogger('Janus.januslib.progress')
+
+class JanusProgress:
+    'A single, throttled status line for a pull: posts/s, ETA, sink queue depths and error count'
+
+    def __init__(self, output, total=None, interval=0.5):
+        self.output = output # duck typed file object
+        self.total = total # number of posts expected, or None if unknown
+        self.interval = interval # minimum seconds between redraws
+        self.started = time.monotonic()
+        self._last = 0.0
+        self._width = 0
+
+    def format_line(self, count, errors, sinks):
+        elapsed = time.monotonic() - self.started
+        rate = count / elapsed if elapsed > 0 else 0.0
+        if self.total and rate > 0:
+            eta = str(timedelta(seconds=int(max(self.total - count, 0) / rate)))
+            done = '{}/{}'.format(count, self.total)
+        else:
+            eta = '?'
+            done = str(count)
+        queues = ' '.join('{}:{}'.format(sinklabel(s), s.queue_depth) for s in sinks)
+        return '{} posts | {:.1f} posts/s | ETA {} | queues [{}] | {} errors'.format(done, rate, eta, queues, errors)
+
+    def update(self, count, errors, sinks, force=False):
+        'Redraw the status line, unless we did so less than `interval` seconds ago'
+        now = time.monotonic()
+        if not force and now - self._last < self.interval:
+            return
+        self._last = now
+        line = self.format_line(count, errors, sinks)
+        # pad with spaces to wipe out any leftovers from a longer, previous line
+        self.output.write('\r' + line.ljust(self._width))
+        self.output.flush()
+        self._width = len(line)
+
+    def finish(self, count, errors, sinks):
+        self.update(count, errors, sinks, force=True)
+        self.output.write('\n')
+        self.output.flush()
+        logger.debug('Progress at finish: %s', self.format_line(count, errors, sinks))
@@ -0,0 +1,55 @@
+import colorlog
+import hashlib
+import io
+import json
+import os
+from datetime import datetime
+
+logger = colorlog.getLogger('Janus.januslib.publish')
+
+PUBLISH_KEEP = 10 # old versions to keep around for dashboards that are mid-refresh
+
+def _write_atomic(path, data):
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with io.open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def _published_version(path):
+    'The version in a published feed, or None'
+    try:
+        with io.open(path, encoding='utf-8') as f:
+            return json.load(f).get('version')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def publish_feed(publishdir, name, rows, meta=None, keep=PUBLISH_KEEP):
+    '''Publish `rows` (a list of json serializable dicts) as a versioned aggregate feed.
+
+    Writes <publishdir>/<name>/<version>.json, where version is a hash of the rows, and
+    <publishdir>/<name>/latest.json with the same content, for dashboards to poll.
+    Unchanged rows leave latest.json alone, so its ETag stays and pollers get a 304.
+    Returns the version'''
+    body = json.dumps(rows, sort_keys=True, separators=(',', ':'))
+    version = hashlib.sha1(body.encode('utf-8')).hexdigest()[:12]
+    feed = dict(meta or {}, name=name, version=version, published=datetime.now().isoformat(), rows=rows)
+    data = json.dumps(feed, separators=(',', ':')).encode('utf-8')
+    feeddir = os.path.join(publishdir, name)
+    os.makedirs(feeddir, exist_ok=True)
+    versioned = os.path.join(feeddir, '{}.json'.format(version))
+    if not os.path.exists(versioned): # same rows, same version: nothing changed
+        _write_atomic(versioned, data)
+    else:
+        os.utime(versioned) # the newest again, dont prune it
+    latest = os.path.join(feeddir, 'latest.json')
+    if _published_version(latest) == version:
+        logger.debug('%s version %s is published already', name, version)
+        return version
+    _write_atomic(latest, data)
+    # prune the oldest versions
+    versions = sorted((e for e in os.scandir(feeddir) if e.name.endswith('.json') and e.name != 'latest.json'),
+                      key=lambda e: e.stat().st_mtime, reverse=True)
+    for old in versions[keep:]:
+        os.remove(old.path)
+    logger.debug('Published %s version %s, %i rows, %i bytes', name, version, len(rows), len(data))
+    return version
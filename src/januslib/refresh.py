@@ -0,0 +1,89 @@
+import colorlog
+import io
+import json
+import os
+import time
+
+from .metrics import metrics
+
+logger = colorlog.getLogger('Janus.januslib.refresh')
+
+REFRESH_BUDGET = 500 # Graph calls per refresh run
+REFRESH_STATE = os.path.join('data', 'refresh-state.json')
+REFRESH_YOUNG_RATE = 50.0 # counter changes per hour we expect from a brand new post, before we have seen it move
+REFRESH_AGE_SCALE = 24.0 # hours. The expected rate falls with the square of the age in these units
+REFRESH_PRIOR_WEIGHT = 2 # how many observations the age based guess is worth against what we have seen
+REFRESH_EWMA = 0.5 # weight of the newest observed rate
+REFRESH_MIN_HOURS = 0.1 # dont divide by tiny intervals
+
+def age_rate(age_hours):
+    'The counter changes per hour we expect from a post of this age, having seen nothing of it'
+    return REFRESH_YOUNG_RATE / (1 + max(age_hours, 0) / REFRESH_AGE_SCALE) ** 2
+
+class JanusRefreshScheduler:
+    '''Decides which posts to refresh from Graph in a run, and remembers what each refresh found.
+
+    The state file keeps, per post id: [last refresh (epoch), likes, shares, comments, observed
+    changes per hour (EWMA), refreshes]. A post's expected change since its last refresh is its
+    estimated rate times the hours since then. The rate is what we observed, pulled towards a guess
+    from the post's age while we have few observations. Each run refreshes the posts with the
+    highest expected change, up to the budget'''
+
+    def __init__(self, path=REFRESH_STATE):
+        self.path = path
+        self.posts = {}
+        try:
+            with io.open(path, encoding='utf-8') as f:
+                self.posts = json.load(f)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            logger.warning('Starting refresh history over, could not read %s: %s', path, e)
+
+    def expected(self, postid, created, now):
+        'Counter changes we expect `postid` (created at epoch `created`) to have had since we last refreshed it'
+        age = (now - created) / 3600
+        prior = age_rate(age)
+        state = self.posts.get(postid)
+        if state is None: # never refreshed, all of its life is unseen
+            return prior * age
+        checked, _, _, _, rate, checks = state
+        rate = (checks * rate + REFRESH_PRIOR_WEIGHT * prior) / (checks + REFRESH_PRIOR_WEIGHT)
+        return rate * (now - checked) / 3600
+
+    def select(self, candidates, budget, now=None):
+        '''Return the `budget` candidates worth refreshing most, highest expected change first.
+        `candidates` is a list of (postid, created epoch, anything). A budget of None takes all'''
+        now = now if now is not None else time.time()
+        ranked = sorted(candidates, key=lambda c: self.expected(c[0], c[1], now), reverse=True)
+        chosen = ranked if budget is None else ranked[:budget]
+        if chosen and len(chosen) < len(ranked):
+            logger.info('Refreshing %i of %i posts. Expected changes: %.1f for the last chosen, %.1f for the first left out',
+                        len(chosen), len(ranked), self.expected(chosen[-1][0], chosen[-1][1], now),
+                        self.expected(ranked[len(chosen)][0], ranked[len(chosen)][1], now))
+        return chosen
+
+    def observe(self, postid, counts, now=None):
+        'Record a refresh of `postid`: counts is (likes, shares, comments). Returns how much they changed since the last one'
+        now = now if now is not None else time.time()
+        counts = [ int(c or 0) for c in counts ]
+        state = self.posts.get(postid)
+        if state is None:
+            self.posts[postid] = [now] + counts + [0.0, 0]
+            return None
+        checked, old, rate, checks = state[0], state[1:4], state[4], state[5]
+        change = sum(abs(a - b) for a, b in zip(counts, old))
+        observed = change / max((now - checked) / 3600, REFRESH_MIN_HOURS)
+        rate = observed if checks == 0 else REFRESH_EWMA * observed + (1 - REFRESH_EWMA) * rate
+        self.posts[postid] = [now] + counts + [rate, checks + 1]
+        metrics.inc('janus_refresh_total', result='changed' if change else 'unchanged')
+        return change
+
+    def save(self):
+        dirn = os.path.dirname(self.path)
+        if dirn:
+            os.makedirs(dirn, exist_ok=True)
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        with io.open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.posts, f, separators=(',', ':'))
+        os.replace(tmp, self.path)
@@ -0,0 +1,86 @@
+import html
+import io
+
+def count_comments(comments):
+    'Count all comments and replies in a Graph comment tree'
+    total = 0
+    stack = [comments]
+    while stack:
+        level = stack.pop()
+        total += len(level)
+        stack.extend(c['comments']['data'] for c in level if 'comments' in c)
+    return total
+
+def _name(com):
+    try:
+        return com['from']['name']
+    except KeyError: # graph hides some authors
+        return 'Unknown'
+
+def _html_item(com, depth):
+    return '<li><b>{}</b> (+{}): {}'.format(html.escape(_name(com)),
+                                           com.get('like_count', 0),
+                                           html.escape(com.get('message', '')))
+
+def _text_item(com, depth):
+    return '{}- {} (+{}): {}\n'.format('  ' * depth,
+                                       _name(com),
+                                       com.get('like_count', 0),
+                                       com.get('message', '').replace('\n', ' '))
+
+def render_comments(comments, fmt='html', max_bytes=None):
+    '''Render a Graph comment tree as nested html lists, or as indented plain text (`fmt`='text').
+
+    Walks the tree without recursion and writes to a single buffer. If `max_bytes` is set,
+    the output (utf-8 encoded) is kept within it, ending with a "N more comments" item.'''
+    text = fmt == 'text'
+    item_for = _text_item if text else _html_item
+    out = io.StringIO()
+    write = out.write
+    used = 0 # bytes written so far
+    rendered = 0
+    total = count_comments(comments) if max_bytes is not None else None
+
+    def tail(depth, remaining):
+        'the "N more comments" item, and whatever is needed to close all open lists at `depth`'
+        if text:
+            return '{}... {} more comments\n'.format('  ' * (depth - 1), remaining)
+        return '<li>{} more comments</li>'.format(remaining) + '</ul></li>' * (depth - 1) + '</ul>'
+
+    if not text:
+        out.write('<ul>')
+        used += 4
+    stack = [iter(comments)]
+    truncated = False
+    while stack:
+        com = next(stack[-1], None)
+        if com is None: # this level is done
+            stack.pop()
+            if not text:
+                closer = '</ul></li>' if stack else '</ul>'
+                write(closer)
+                used += len(closer)
+            continue
+        item = item_for(com, len(stack) - 1)
+        if max_bytes is not None:
+            size = len(item.encode('utf-8'))
+            # always leave room for the tail, sized for the worst case: nothing more gets rendered.
+            # 5 bytes covers the `</li>` or `<ul>` that follows the item
+            if used + size + 5 + len(tail(len(stack) + 1, total)) > max_bytes:
+                truncated = True
+                break
+            used += size
+        write(item)
+        rendered += 1
+        replies = com.get('comments')
+        if replies and replies['data']:
+            if not text:
+                write('<ul>')
+                used += 4
+            stack.append(iter(replies['data']))
+        elif not text:
+            write('</li>')
+            used += 5
+    if truncated:
+        out.write(tail(len(stack), total - rendered))
+    return out.getvalue()
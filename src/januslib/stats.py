@@ -1,6 +1,8 @@
 import colorlog
+import csv
 import io
 import json
+import os
 import os.path
 from datetime import datetime
 import tempfile
@@ -10,18 +12,32 @@ from sortedcontainers import SortedDict # pip install sortedcontainers
 
 logger = colorlog.getLogger('Janus.januslib.stats')
 from . import JanusSink
+from .aggregate import JanusAggregate
+from .publish import publish_feed
 
 class JanusStatsSink(JanusSink):
     
-    def __init__(self, stat_type, output):
+    def __init__(self, stat_type, output, aggregate=None, persist=None, publish=None, feedname=None):
         super().__init__(output)
         self.stat_type = stat_type
+        self.publish = publish # directory to publish versioned json feeds in, for dashboards
+        self.feedname = feedname or stat_type
         self.created_dates = SortedDict()
         self.counted = 0
+        self.recounted = 0 # posts already in a persisted aggregate, skipped
         self.filter = None
+        self.aggregate = aggregate # a JanusAggregate, for stat_type `aggregate`
+        self.persist = persist # path to keep the aggregate in, adding to it on every run
+        if persist is not None and os.path.exists(persist):
+            previous = JanusAggregate.load(persist)
+            previous.merge(self.aggregate) # raises if the grouping differs
+            self.aggregate = previous
+            logger.debug('Continuing aggregate from %s: %i posts so far', persist, previous.counted)
 
     def __str__(self):
         'return pretty name'
+        if self.aggregate is not None:
+            return '<#{} Stats({} {})>'.format(self.id, self.stat_type, self.aggregate)
         return '<#{} Stats({})>'.format(self.id, self.stat_type)
 
     def set_filter(self, cb):
@@ -37,9 +53,20 @@ class JanusStatsSink(JanusSink):
                 self.created_dates[post_date] = 1
             else:
                 self.created_dates[post_date] += 1
+        elif self.stat_type == 'aggregate':
+            if not self.aggregate.add(post): # counted in an earlier run
+                self.recounted += 1
+                return
         self.counted += 1
         
     def finished(self):
+        if self.aggregate is not None:
+            return self._finish_aggregate()
+        if self.publish is not None:
+            version = publish_feed(self.publish, self.feedname,
+                                   [ {'date': dte, 'count': cnt} for dte, cnt in self.created_dates.items() ],
+                                   {'stat_type': self.stat_type, 'total': self.counted})
+            puts('Published {} version {} in {}'.format(self.feedname, version, self.publish))
         with tempfile.NamedTemporaryFile(suffix='.csv', prefix='janus_stats_{}'.format(self.stat_type), delete=False) as f:
             f.write('# Janus Stone stats {} created {}\r\n'.format(self.stat_type, datetime.now().isoformat()).encode())
             f.write('# Total count: {} ({}) \r\n'.format(self.counted, 'filter: {}'.format(self.filter) if self.filter is not None else 'unfiltered').encode())
@@ -47,3 +74,22 @@ class JanusStatsSink(JanusSink):
                 f.write('{};{}\r\n'.format(dte, cnt).encode())
             puts('Finished processing {} posts. Here are the {} stats. Hope you are happy: {}'.format(self.counted, self.stat_type, f.name))
 
+
+    def _finish_aggregate(self):
+        if self.persist is not None:
+            self.aggregate.save(self.persist)
+        if self.publish is not None:
+            version = publish_feed(self.publish, self.feedname, list(self.aggregate.rows()),
+                                   {'stat_type': self.stat_type, 'bucket': self.aggregate.bucket,
+                                    'groupby': self.aggregate.groupby, 'total': self.aggregate.counted})
+            puts('Published {} version {} in {}'.format(self.feedname, version, self.publish))
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.csv', prefix='janus_stats_{}'.format(self.stat_type), delete=False, newline='') as f:
+            f.write('# Janus Stone stats {} {} created {}\r\n'.format(self.stat_type, self.aggregate, datetime.now().isoformat()))
+            f.write('# Total count: {} this run, {} in aggregate, {} counted before ({}) \r\n'.format(self.counted, self.aggregate.counted, self.recounted, 'filter: {}'.format(self.filter) if self.filter is not None else 'unfiltered'))
+            w = None
+            for row in self.aggregate.rows():
+                if w is None:
+                    w = csv.DictWriter(f, fieldnames=list(row.keys()), delimiter=';')
+                    w.writeheader()
+                w.writerow(row)
+            puts('Finished processing {} posts. Here are the {} stats. Hope you are happy: {}'.format(self.counted, self.stat_type, f.name))
@@ -0,0 +1,151 @@
+import colorlog
+import csv
+import io
+import json
+import re
+from pathlib import Path
+
+try:
+    import numpy as np # pip install numpy
+except ImportError:
+    np = None
+
+from . import JanusException
+from .aggregate import BUCKETS
+from .fb import _count
+
+logger = colorlog.getLogger('Janus.januslib.table')
+
+NUMERIC_COLUMNS = ('created', 'likes', 'shares', 'comments')
+POST_HEADER = ('id', 'created', 'author', 'likes', 'shares', 'comments')
+GROUP_HEADER = ('key', 'posts', 'likes', 'shares', 'comments', 'mean_likes')
+CONDITION = re.compile(r'^\s*(\w+)\s*(>=|<=|!=|=|>|<)\s*(.+?)\s*$')
+_OPS = {'=': 'eq', '!=': 'ne', '>': 'gt', '>=': 'ge', '<': 'lt', '<=': 'le'}
+
+def _need_numpy():
+    if np is None:
+        raise JanusException('The post table needs numpy. pip install numpy')
+
+class JanusPostTable:
+    '''Posts as numpy columns: int64 epoch `created`, `likes`, `shares` and `comments`,
+    and `author` as int32 codes into `authors`. Filtering returns a new table sharing the categories'''
+
+    def __init__(self, columns, authors, ids):
+        self.columns = columns # name -> ndarray, all the same length
+        self.authors = authors # author code -> name
+        self.ids = ids # post ids, as an object array
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_cache(cls, cachepath):
+        'Load the JSON posts in `cachepath` (a page directory written by JanusFileSink)'
+        _need_numpy()
+        ids, created, likes, shares, comments, codes = [], [], [], [], [], []
+        authors, authorcodes = [], {}
+        for path in Path(cachepath).glob('*.json'):
+            with path.open() as f:
+                post = json.load(f)
+            ids.append(post['id'])
+            created.append(post['created_time'][:19]) # graph times are always +0000
+            likes.append(_count(post.get('likes')))
+            shares.append(post.get('shares', {}).get('count', 0))
+            comments.append(_count(post.get('comments')))
+            name = post.get('from', {}).get('name', 'Unknown')
+            try:
+                codes.append(authorcodes[name])
+            except KeyError:
+                codes.append(authorcodes.setdefault(name, len(authors)))
+                authors.append(name)
+        columns = {'created': np.array(created, dtype='datetime64[s]').astype(np.int64),
+                   'likes': np.array(likes, dtype=np.int64),
+                   'shares': np.array(shares, dtype=np.int64),
+                   'comments': np.array(comments, dtype=np.int64),
+                   'author': np.array(codes, dtype=np.int32),
+                   }
+        return cls(columns, authors, np.array(ids, dtype=object))
+
+    def save(self, path):
+        'Store the table as a .npz file, for quick reloading'
+        np.savez(path, ids=self.ids.astype(str), authors=np.array(self.authors, dtype=str), **self.columns)
+
+    @classmethod
+    def load(cls, path):
+        _need_numpy()
+        with np.load(path) as data:
+            columns = {name: data[name] for name in NUMERIC_COLUMNS + ('author',)}
+            return cls(columns, [ str(a) for a in data['authors'] ], data['ids'].astype(object))
+
+    def _value(self, column, value):
+        'Turn a condition value into something comparable with `column`'
+        if column == 'created':
+            return np.datetime64(value.replace(' ', 'T'), 's').astype(np.int64)
+        if column == 'author':
+            try:
+                return self.authors.index(value)
+            except ValueError:
+                return -1 # matches nobody
+        return int(value)
+
+    def mask(self, condition):
+        'Return a boolean array for a condition like `likes>10`, `author=NRK` or `created>=2017-01-01`'
+        m = CONDITION.match(condition)
+        if m is None:
+            raise JanusException('Cannot parse condition {!r}, expected <column><op><value>'.format(condition))
+        column, op, value = m.groups()
+        if column not in self.columns:
+            raise JanusException('No such column {!r}, use one of {}'.format(column, ', '.join(self.columns)))
+        if column == 'author' and op not in ('=', '!='):
+            raise JanusException('Authors can only be compared with = and !=')
+        return getattr(self.columns[column], '__{}__'.format(_OPS[op]))(self._value(column, value))
+
+    def filter(self, *conditions):
+        'Return a new table with the rows matching all `conditions`'
+        keep = np.ones(len(self), dtype=bool)
+        for c in conditions:
+            keep &= self.mask(c)
+        return JanusPostTable({k: v[keep] for k, v in self.columns.items()}, self.authors, self.ids[keep])
+
+    def bucket_codes(self, bucket):
+        'Return the time bucket of each row as int64, and a function to turn a code into a label'
+        created = self.columns['created']
+        if bucket == 'hour':
+            return created // 3600, lambda c: str(np.datetime64(int(c), 'h'))
+        elif bucket == 'day':
+            return created // 86400, lambda c: str(np.datetime64(int(c), 'D'))
+        elif bucket == 'week':
+            # epoch day 0 was a thursday, shift to have weeks start on monday
+            return (created // 86400 + 3) // 7, lambda c: str(np.datetime64(int(c) * 7 - 3, 'D'))
+        elif bucket == 'month':
+            return created.astype('datetime64[s]').astype('datetime64[M]').astype(np.int64), lambda c: str(np.datetime64(int(c), 'M'))
+        raise JanusException('Unknown time bucket {!r}, use one of {}'.format(bucket, ', '.join(BUCKETS)))
+
+    def groupby(self, by):
+        '''Group by `author` or a time bucket (hour, day, week, month).
+        Returns a list of rows: (key, posts, likes, shares, comments, mean likes), biggest groups first'''
+        if by == 'author':
+            codes, label = self.columns['author'], lambda c: self.authors[c]
+        else:
+            codes, label = self.bucket_codes(by)
+        if len(codes) == 0:
+            return []
+        keys, inverse = np.unique(codes, return_inverse=True)
+        posts = np.bincount(inverse, minlength=len(keys))
+        sums = {c: np.bincount(inverse, weights=self.columns[c], minlength=len(keys)) for c in ('likes', 'shares', 'comments')}
+        order = np.argsort(-posts, kind='stable') if by == 'author' else np.arange(len(keys))
+        return [ (label(keys[i]), int(posts[i]), int(sums['likes'][i]), int(sums['shares'][i]), int(sums['comments'][i]),
+                  float(sums['likes'][i] / posts[i])) for i in order ]
+
+    def rows(self):
+        'Yield each post as a tuple, for export'
+        created = self.columns['created'].astype('datetime64[s]')
+        for i in range(len(self)):
+            yield (str(self.ids[i]), str(created[i]), self.authors[self.columns['author'][i]],
+                   int(self.columns['likes'][i]), int(self.columns['shares'][i]), int(self.columns['comments'][i]))
+
+def write_csv(filename, header, rows):
+    with io.open(filename, 'w', newline='', encoding='utf-8') as f:
+        w = csv.writer(f)
+        w.writerow(header)
+        w.writerows(rows)
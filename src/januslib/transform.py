@@ -0,0 +1,101 @@
+import collections
+import colorlog
+import io
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from . import JanusException
+from .metrics import metrics
+
+logger = colorlog.getLogger('Janus.januslib.transform')
+
+TRANSFORM_CHUNK = 200 # posts per task. Big enough that pickling is not the bottleneck, small enough to keep all workers busy
+
+def _format_chunk(items, transforms):
+    '''Run in a worker: format each item with every (function, args) in `transforms`.
+    An item is a path to a cached post, raw Graph data, or None for posts the sinks format themselves.
+    Returns one list of rows per item (or None), with a JanusException in place of a row that failed'''
+    out = []
+    for item in items:
+        if item is None:
+            out.append(None)
+            continue
+        try:
+            if isinstance(item, str):
+                with io.open(item, encoding='utf-8') as f:
+                    item = json.load(f)
+        except (OSError, ValueError) as e:
+            out.append([JanusException('Could not read {}: {}'.format(item, e))] * len(transforms))
+            continue
+        rows = []
+        for func, args in transforms:
+            try:
+                rows.append(func(item, *args))
+            except Exception as e: # not every exception pickles, send what it said
+                rows.append(JanusException('{}: {}'.format(e.__class__.__name__, e)))
+        out.append(rows)
+    return out
+
+def _payload(post):
+    'What a worker needs to format `post`: the path of a cached post, else its raw Graph data'
+    from .fb import JanusFacebookPost
+    if not isinstance(post, JanusFacebookPost) or post.kind != 'post':
+        return None
+    if post.path is not None:
+        return str(post.path) # cheaper to send than the parsed post, the worker reads it again
+    return post.post
+
+class JanusTransformStage:
+    '''Format posts for the sinks in a pool of `workers` processes, TRANSFORM_CHUNK posts at a time.
+
+    .map() yields (post, rows) in the order the posts came, with rows lined up with `transforms`,
+    or None for posts that are not raw Facebook posts. At most two chunks per worker are in flight,
+    so a big source is not read into memory ahead of the sinks'''
+
+    def __init__(self, workers, chunksize=TRANSFORM_CHUNK):
+        self.workers = workers
+        self.chunksize = chunksize
+
+    def _chunks(self, posts):
+        chunk = []
+        for post in posts:
+            chunk.append(post)
+            if len(chunk) == self.chunksize:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def map(self, posts, transforms):
+        transforms = list(transforms)
+        pool = ProcessPoolExecutor(max_workers=self.workers)
+        pending = collections.deque() # (posts, future, submitted at)
+        formatted = 0
+        t0 = time.perf_counter()
+        try:
+            for chunk in self._chunks(posts):
+                pending.append( (chunk, pool.submit(_format_chunk, [ _payload(p) for p in chunk ], transforms), time.perf_counter()) )
+                if len(pending) >= 2 * self.workers:
+                    formatted += yield from self._collect(pending.popleft())
+            while pending:
+                formatted += yield from self._collect(pending.popleft())
+        finally:
+            for _, future, _ in pending: # stopped early, dont format what nobody will read
+                future.cancel()
+            pool.shutdown(wait=True)
+        elapsed = time.perf_counter() - t0
+        logger.info('Formatted %i posts in %i processes, %.0f posts/s', formatted, self.workers, formatted / elapsed if elapsed else 0)
+
+    def _collect(self, entry):
+        chunk, future, submitted = entry
+        results = future.result()
+        metrics.observe('janus_transform_chunk_seconds', time.perf_counter() - submitted)
+        for post, rows in zip(chunk, results):
+            yield post, rows
+        return sum(1 for rows in results if rows is not None)
+
+def default_workers():
+    'One worker per core, leaving one for the main process to read posts and feed the sinks'
+    return max(1, (os.cpu_count() or 2) - 1)
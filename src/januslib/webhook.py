@@ -0,0 +1,270 @@
+#-*- enc: utf-8
+
+import collections
+import colorlog
+import hashlib
+import hmac
+import http.server
+import json
+import os
+import socketserver
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from . import JanusException
+from .fb import JanusFacebookPost, fields_for, FB_DEFAULT_PROFILE, FB_TIMEOUT
+from .metrics import metrics
+
+logger = colorlog.getLogger('Janus.januslib.webhook')
+
+WEBHOOK_PATH = '/webhook'
+WEBHOOK_BATCH = 50 # post ids per Graph request, the most ?ids= takes
+WEBHOOK_LINGER = 1.0 # seconds to wait for more events after the first, to fill a batch
+WEBHOOK_MAX_BODY = 1024*1024 # bytes. Facebook batches events, but never this many
+
+def signature_ok(secret, body, headers):
+    'Check X-Hub-Signature-256 (or the older sha1 X-Hub-Signature) against the app secret'
+    for header, digest in (('X-Hub-Signature-256', hashlib.sha256), ('X-Hub-Signature', hashlib.sha1)):
+        given = headers.get(header)
+        if given is None:
+            continue
+        algo, _, signature = given.partition('=')
+        if algo != digest().name:
+            return False
+        expected = hmac.new(secret.encode('utf-8'), body, digest).hexdigest()
+        return hmac.compare_digest(expected, signature)
+    return False
+
+def sign(secret, body):
+    'Return the headers Facebook would sign `body` with'
+    return {'X-Hub-Signature': 'sha1=' + hmac.new(secret.encode('utf-8'), body, hashlib.sha1).hexdigest(),
+            'X-Hub-Signature-256': 'sha256=' + hmac.new(secret.encode('utf-8'), body, hashlib.sha256).hexdigest()}
+
+def feed_changes(payload):
+    '''Yield (post id, verb, item) for each page feed change in a webhook payload.
+    Comments and reactions come with the id of their post, which is the one we want to fetch again'''
+    if payload.get('object') != 'page':
+        return
+    for entry in payload.get('entry', []):
+        for change in entry.get('changes', []):
+            if change.get('field') != 'feed':
+                continue
+            value = change.get('value', {})
+            if value.get('post_id'):
+                yield value['post_id'], value.get('verb'), value.get('item')
+
+def fetch_posts(ids, profile=FB_DEFAULT_PROFILE):
+    '''Get posts from Graph, WEBHOOK_BATCH per request, straight from Graph and not the response cache.
+    Returns a list of JanusFacebookPost, leaving out posts that are gone'''
+    import facebook
+    graph = facebook.GraphAPI(access_token=os.environ.get('FB_APP_TOKEN'), version='2.8', timeout=FB_TIMEOUT)
+    params = {'fields': fields_for(profile)}
+    posts = []
+    for i in range(0, len(ids), WEBHOOK_BATCH):
+        batch = ids[i:i+WEBHOOK_BATCH]
+        try:
+            with metrics.timer('janus_http_request_seconds', service='graph', endpoint='ids'):
+                found = graph.request('', dict(params, ids=','.join(batch)))
+        except facebook.GraphAPIError as e: # one deleted post fails the lot, ask one by one
+            logger.debug('Batch of %i posts failed (%s), fetching them one at a time', len(batch), e)
+            found = {}
+            for postid in batch:
+                try:
+                    found[postid] = graph.request(postid, params)
+                except facebook.GraphAPIError as e:
+                    logger.info('Skipping post %s from a webhook event: %s', postid, e)
+        posts.extend( JanusFacebookPost(found[postid]) for postid in batch if postid in found )
+    return posts
+
+class JanusWebhookIngest:
+    '''Queue of post ids from webhook events, fetched in batches and handed to `deliver(posts)` by a background thread.
+
+    A batch is sent WEBHOOK_LINGER seconds after its first event, or when it is full. Ids queued
+    twice before their batch goes are fetched once'''
+
+    def __init__(self, deliver, fetch=fetch_posts):
+        self.deliver = deliver
+        self.fetch = fetch
+        self.received = collections.OrderedDict() # post id -> when we first heard of it, oldest first
+        self.delivered = 0
+        self.latency = None # seconds from event to sinks, for the last batch
+        self._cond = threading.Condition()
+        self._busy = False
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='janus-webhook', daemon=True)
+        self._thread.start()
+
+    def put(self, postids):
+        now = time.time()
+        with self._cond:
+            for postid in postids:
+                self.received.setdefault(postid, now)
+            self._cond.notify_all()
+        metrics.inc('janus_webhook_posts_total', len(postids), result='queued')
+
+    def _batch(self):
+        with self._cond:
+            while not self.received and not self._stopping:
+                self._cond.wait()
+            if self._stopping:
+                return None
+            first = next(iter(self.received.values()))
+            while len(self.received) < WEBHOOK_BATCH and not self._stopping:
+                left = first + WEBHOOK_LINGER - time.time()
+                if left <= 0:
+                    break
+                self._cond.wait(left)
+            batch = list(self.received.items())[:WEBHOOK_BATCH]
+            for postid, _ in batch:
+                del self.received[postid]
+            self._busy = True
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._batch()
+            if batch is None:
+                return
+            try:
+                posts = self.fetch([ postid for postid, _ in batch ])
+                self.deliver(posts)
+                now = time.time()
+                for _, received in batch:
+                    metrics.observe('janus_webhook_latency_seconds', now - received)
+                self.latency = now - batch[0][1]
+                self.delivered += len(posts)
+                logger.info('Pushed %i posts from webhook events, %.1fs after the first event', len(posts), self.latency)
+            except Exception as e:
+                metrics.inc('janus_webhook_posts_total', len(batch), result='failed')
+                logger.exception('Could not fetch or push %i posts from webhook events: %s', len(batch), e)
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def wait(self, timeout=None):
+        'Wait until everything queued is pushed, at most `timeout` seconds. Returns True if it was'
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self.received or self._busy:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def stop(self):
+        'Stop the background thread. Ids not yet fetched are dropped, and returned'
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._thread.join()
+        return list(self.received)
+
+class JanusWebhookReceiver:
+    '''Facebook page webhooks at WEBHOOK_PATH:
+
+        GET   answers the subscription challenge, if hub.verify_token is ours
+        POST  checks the payload signature with the app secret, and queues feed changes with `ingest`'''
+
+    def __init__(self, verify_token, secret, ingest):
+        if not verify_token or not secret:
+            raise JanusException('Webhooks need FB_VERIFY_TOKEN and FB_APP_SECRET in the environment (or .env)')
+        self.verify_token = verify_token
+        self.secret = secret
+        self.ingest = ingest
+        self.events = 0
+
+    def _reply(self, handler, status, body=b'', ctype='text/plain'):
+        handler.send_response(status)
+        handler.send_header('Content-Type', ctype)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def __call__(self, handler, method):
+        url = urllib.parse.urlsplit(handler.path)
+        if url.path != WEBHOOK_PATH:
+            return self._reply(handler, 404)
+        if method == 'GET':
+            q = dict(urllib.parse.parse_qsl(url.query))
+            if q.get('hub.mode') == 'subscribe' and hmac.compare_digest(q.get('hub.verify_token', ''), self.verify_token):
+                logger.info('Webhook subscription verified')
+                return self._reply(handler, 200, q.get('hub.challenge', '').encode('utf-8'))
+            logger.warning('Refused a webhook subscription with the wrong verify token')
+            return self._reply(handler, 403)
+        length = int(handler.headers.get('Content-Length', 0))
+        if length > WEBHOOK_MAX_BODY:
+            return self._reply(handler, 413)
+        body = handler.rfile.read(length)
+        if not signature_ok(self.secret, body, handler.headers):
+            metrics.inc('janus_webhook_events_total', result='bad_signature')
+            logger.warning('Refused a webhook event with a bad signature from %s', handler.address_string())
+            return self._reply(handler, 403)
+        try:
+            payload = json.loads(body.decode('utf-8'))
+        except ValueError:
+            return self._reply(handler, 400)
+        fetch, removed = [], 0
+        for postid, verb, item in feed_changes(payload):
+            if verb == 'remove' and item in ('status', 'post', 'photo', 'video', 'link', 'share'):
+                removed += 1 # the post itself is gone, nothing to fetch
+            elif postid not in fetch:
+                fetch.append(postid)
+        self.events += 1
+        metrics.inc('janus_webhook_events_total', result='ok')
+        if removed:
+            logger.info('%i posts were removed from the page', removed)
+        if fetch:
+            self.ingest.put(fetch)
+        self._reply(handler, 200) # answer at once, Facebook retries slow endpoints
+
+class WebhookHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.receiver(self, 'GET')
+
+    def do_POST(self):
+        self.server.receiver(self, 'POST')
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+class WebhookServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+def run_webhook_server(receiver, port=8090, addr='0.0.0.0'):
+    'Receive webhooks at http://addr:port/webhook in a background thread. Returns (thread, httpd)'
+    httpd = WebhookServer((addr, port), WebhookHandler)
+    httpd.receiver = receiver
+    t = threading.Thread(target=httpd.serve_forever)
+    t.daemon = True
+    t.start()
+    logger.debug('Webhook endpoint live at http://%s:%s%s', addr, port, WEBHOOK_PATH)
+    return t, httpd
+
+def simulate_subscribe(url, verify_token, challenge='janus-challenge'):
+    'Do what Facebook does when subscribing `url`. Returns True if the challenge came back'
+    query = urllib.parse.urlencode({'hub.mode': 'subscribe', 'hub.verify_token': verify_token, 'hub.challenge': challenge})
+    try:
+        with urllib.request.urlopen('{}?{}'.format(url, query), timeout=10) as r:
+            return r.read().decode('utf-8') == challenge
+    except urllib.error.HTTPError:
+        return False
+
+def simulate_event(url, secret, postids, verb='edited', item='status', pageid='0'):
+    'POST a signed page feed event for `postids` to `url`, like Facebook does. Returns the http status'
+    now = int(time.time())
+    payload = {'object': 'page', 'entry': [{'id': pageid, 'time': now, 'changes': [
+        {'field': 'feed', 'value': {'item': item, 'verb': verb, 'post_id': postid, 'created_time': now}}
+        for postid in postids ]}]}
+    body = json.dumps(payload).encode('utf-8')
+    headers = dict(sign(secret, body), **{'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=body, headers=headers), timeout=10) as r:
+            return r.status
+    except urllib.error.HTTPError as e:
+        return e.code